@@ -1,25 +1,38 @@
-from flask import Flask, render_template_string, request, jsonify, url_for
-import json
-import math
+from flask import Flask, render_template, request, jsonify, url_for
+
+from search import SearchIndex
+from catalog import load_catalog, ProductStore
 
 app = Flask(__name__)
 
 # Load JSON file
-with open("meta_Appliances.json", "r", encoding="utf-8") as f:
-    products = [json.loads(line) for line in f]
-
-# Home page (grid view with pagination + search bar)
-@app.route("/")
-def home():
-    per_page = 40
-    page = request.args.get("page", 1, type=int)
-    total_pages = math.ceil(len(products) / per_page)
-
-    start = (page - 1) * per_page
-    end = start + per_page
-    page_products = products[start:end]
-
-    template = """
+products = load_catalog("meta_Appliances.json")
+store = ProductStore(products)
+search_index = SearchIndex(products)
+
+# View-models: the values the templates print, derived once per product at
+# startup so that rendering does no per-request defaulting or key filtering
+SHOWN_FIELDS = ['title', 'brand', 'asin', 'category', 'price', 'date', 'feature', 'description', 'rank', 'tech1', 'imageURLHighRes']
+
+def listing_view(product):
+    return {'asin': product['asin'], 'title': product.get('title', 'No Title'), 'brand': product.get('brand', 'Unknown'),
+            'image': (product.get('imageURLHighRes') or [None])[0], 'price': product.get('price', 'Price not available')}
+
+def detail_view(product):
+    view = listing_view(product)
+    view.update(brand=product.get('brand', 'N/A'), category=' > '.join(map(str, product.get('category', []))),
+                price=product.get('price', 'Not available'), date=product.get('date', 'N/A'),
+                features=product.get('feature', []), description=' '.join(map(str, product.get('description', []))),
+                rank=product.get('rank', []), tech1=product.get('tech1', 'N/A'),
+                details=[(key, value) for key, value in product.items() if key not in SHOWN_FIELDS])
+    return view
+
+listing_views = {asin: listing_view(product) for asin, product in store.by_asin.items()}
+detail_views = {asin: detail_view(product) for asin, product in store.by_asin.items()}
+
+# Home page (grid view with pagination + search bar). Templates are compiled
+# once at startup instead of on every render_template_string call.
+home_template = app.jinja_env.from_string("""
     <!doctype html>
     <html lang="en">
     <head>
@@ -74,16 +87,16 @@ def home():
                     <div class="col-md-3">
                         <div class="card h-100 shadow-sm">
                             <div class="image-box">
-                                {% if product.get('imageURLHighRes') %}
-                                    <img src="{{ product.imageURLHighRes[0] }}" alt="Product Image">
+                                {% if product.image %}
+                                    <img src="{{ product.image }}" alt="Product Image">
                                 {% else %}
                                     <span>No Image Available</span>
                                 {% endif %}
                             </div>
                             <div class="card-body">
-                                <h6 class="card-title">{{ product.get('title', 'No Title') }}</h6>
-                                <p class="text-muted">{{ product.get('brand', 'Unknown') }}</p>
-                                <p class="fw-bold">{{ product.get('price', 'Price not available') }}</p>
+                                <h6 class="card-title">{{ product.title }}</h6>
+                                <p class="text-muted">{{ product.brand }}</p>
+                                <p class="fw-bold">{{ product.price }}</p>
                                 <a href="{{ url_for('product_detail', asin=product.asin) }}" class="btn btn-primary btn-sm">View Details</a>
                             </div>
                         </div>
@@ -95,11 +108,11 @@ def home():
             <nav class="mt-4">
                 <ul class="pagination justify-content-center">
                     {% if page > 1 %}
-                        <li class="page-item"><a class="page-link" href="{{ url_for('home', page=page-1) }}">Previous</a></li>
+                        <li class="page-item"><a class="page-link" href="{{ url_for('home', page=page-1, brand=brand, category=category) }}">Previous</a></li>
                     {% endif %}
                     <li class="page-item disabled"><a class="page-link">Page {{ page }} of {{ total_pages }}</a></li>
                     {% if page < total_pages %}
-                        <li class="page-item"><a class="page-link" href="{{ url_for('home', page=page+1) }}">Next</a></li>
+                        <li class="page-item"><a class="page-link" href="{{ url_for('home', page=page+1, brand=brand, category=category) }}">Next</a></li>
                     {% endif %}
                 </ul>
             </nav>
@@ -127,22 +140,26 @@ def home():
         </script>
     </body>
     </html>
-    """
-    return render_template_string(template, products=page_products, page=page, total_pages=total_pages)
+    """)
 
+@app.route("/")
+def home():
+    per_page = 40
+    page = request.args.get("page", 1, type=int)
+    brand = request.args.get("brand") or None
+    category = request.args.get("category") or None
+    page_products, total_pages = store.page(page, per_page, brand, category)
+    page_views = [listing_views[product['asin']] for product in page_products if 'asin' in product]
+    return render_template(home_template, products=page_views, page=page, total_pages=total_pages,
+                           brand=brand, category=category)
 
-# Product detail page
-@app.route("/product/<asin>")
-def product_detail(asin):
-    product = next((p for p in products if p["asin"] == asin), None)
-    if not product:
-        return "Product not found", 404
 
-    template = """
+# Product detail page
+product_template = app.jinja_env.from_string("""
     <!doctype html>
     <html lang="en">
     <head>
-        <title>{{ product.get('title', 'No Title') }}</title>
+        <title>{{ product.title }}</title>
         <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css">
     </head>
     <body class="bg-light">
@@ -152,44 +169,44 @@ def product_detail(asin):
                 <div class="row">
                     <div class="col-md-5">
                         <div class="image-box">
-                            {% if product.get('imageURLHighRes') %}
-                                <img src="{{ product.imageURLHighRes[0] }}" class="img-fluid">
+                            {% if product.image %}
+                                <img src="{{ product.image }}" class="img-fluid">
                             {% else %}
                                 <span>No Image Available</span>
                             {% endif %}
                         </div>
                     </div>
                     <div class="col-md-7">
-                        <h3>{{ product.get('title', 'No Title') }}</h3>
-                        <p><strong>ASIN:</strong> {{ product.get('asin', 'N/A') }}</p>
-                        <p><strong>Brand:</strong> {{ product.get('brand', 'N/A') }}</p>
-                        <p><strong>Category:</strong> {{ product.get('category', []) | join(' > ') }}</p>
-                        <p><strong>Price:</strong> {{ product.get('price', 'Not available') }}</p>
-                        <p><strong>Date:</strong> {{ product.get('date', 'N/A') }}</p>
+                        <h3>{{ product.title }}</h3>
+                        <p><strong>ASIN:</strong> {{ product.asin }}</p>
+                        <p><strong>Brand:</strong> {{ product.brand }}</p>
+                        <p><strong>Category:</strong> {{ product.category }}</p>
+                        <p><strong>Price:</strong> {{ product.price }}</p>
+                        <p><strong>Date:</strong> {{ product.date }}</p>
 
                         <h5>Features:</h5>
                         <ul>
-                            {% for f in product.get('feature', []) %}
+                            {% for f in product.features %}
                                 <li>{{ f }}</li>
                             {% endfor %}
                         </ul>
 
                         <h5>Description:</h5>
-                        <p>{{ product.get('description', []) | join(' ') }}</p>
+                        <p>{{ product.description }}</p>
 
                         <h5>Rank:</h5>
                         <ul>
-                            {% for r in product.get('rank', []) %}
+                            {% for r in product.rank %}
                                 <li>{{ r }}</li>
                             {% endfor %}
                         </ul>
 
                         <h5>Technical Details:</h5>
-                        <pre>{{ product.get('tech1', 'N/A') }}</pre>
+                        <pre>{{ product.tech1 }}</pre>
 
                         <h5>Other Details:</h5>
                         <ul>
-                        {% for key, value in product.items() if key not in ['title','brand','asin','category','price','date','feature','description','rank','tech1','imageURLHighRes'] %}
+                        {% for key, value in product.details %}
                             <li><strong>{{ key }}:</strong> {{ value }}</li>
                         {% endfor %}
                         </ul>
@@ -199,21 +216,21 @@ def product_detail(asin):
         </div>
     </body>
     </html>
-    """
-    return render_template_string(template, product=product)
+    """)
+
+@app.route("/product/<asin>")
+def product_detail(asin):
+    product = detail_views.get(asin)
+    if not product:
+        return "Product not found", 404
+    return render_template(product_template, product=product)
 
 
 # Search API (AJAX endpoint)
 @app.route("/search")
 def search():
-    query = request.args.get("query", "").lower()
-    results = []
-    if query:
-        for p in products:
-            title = p.get("title", "")
-            if query in title.lower():
-                results.append({"asin": p.get("asin"), "title": title})
-    return jsonify(results[:10])  # return top 10 matches
+    query = request.args.get("query", "")
+    return jsonify(search_index.search(query, 10))  # return top 10 matches
 
 
 if __name__ == "__main__":
@@ -0,0 +1,318 @@
+import os
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import platform
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Tuple, Optional
+
+import numpy as np
+
+from catalog import load_catalog, INDEX_FIELDS
+from recommender import (prepare_data, batch_similar, hybrid_similar, hybrid_scores, check_weights, jaccard_similarity,
+                         pairwise_jaccard, FieldIndex, FIELDS, HYBRID, SCORING_MODES)
+
+# Per-candidate scoring as the product page used to do it: LSH.query, then
+# jaccard_similarity for every candidate but the product's own duplicate group
+def loop_similar(index: FieldIndex, asin: str, k: int = 10) -> List[Tuple[str, float]]:
+    shingles = index.shingles(asin)
+    if not len(shingles):
+        return []
+    own = index.asins[index.representatives[index.asin_to_index[asin]]]
+    scores = []
+    for cand in index.asins[index.lsh.query(index.signature(asin))].tolist():
+        if cand != own:
+            cand_shingles = index.shingles(cand)
+            if len(cand_shingles):
+                scores.append((cand, jaccard_similarity(shingles, cand_shingles)))
+    return sorted(scores, key=lambda x: -x[1])[:k]
+
+# Share of the exact top-k found by a result. A returned neighbor counts as a hit
+# when its exact score reaches the k-th best exact score, so ties do not matter.
+def recall_at_k(index: FieldIndex, asin: str, result: List[Tuple[str, float]], exact: List[Tuple[str, float]]) -> float:
+    if not exact:
+        return 1.0
+    threshold = exact[-1][1]
+    shingles = index.shingles(asin)
+    hits = sum(1 for cand, _ in result if jaccard_similarity(shingles, index.shingles(cand)) >= threshold)
+    return min(hits, len(exact)) / len(exact)
+
+def benchmark_scoring(index: FieldIndex, asins: List[str], k: int = 10) -> Dict[str, Dict]:
+    exact = {asin: loop_similar(index, asin, k) for asin in asins}
+    runs = {'exact-loop': lambda asin: loop_similar(index, asin, k)}
+    for mode in SCORING_MODES:
+        runs[mode] = lambda asin, mode=mode: batch_similar(index, [asin], k, mode)[asin]
+
+    report = {}
+    for name, run in runs.items():
+        latencies, recalls = [], []
+        for asin in asins:
+            start = time.perf_counter()
+            result = run(asin)
+            latencies.append(time.perf_counter() - start)
+            recalls.append(recall_at_k(index, asin, result, exact[asin]))
+        latencies = np.array(latencies) * 1000
+        report[name] = {'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+                        'mean_ms': float(latencies.mean()), 'recall_at_k': float(np.mean(recalls))}
+    return report
+
+# Benchmark suite
+#
+# Every run builds the index for one catalog at one scale and one (bands, rows)
+# setting and reports, per field: candidates per query, latency of LSH.query
+# and of a top-k query (batch_similar, exact scoring) and recall@k against
+# brute-force Jaccard over the whole catalog. The hybrid similarity is reported
+# like a field. Runs happen in a freshly spawned process so that peak RSS
+# covers only that run's loading and building.
+
+# Synthetic catalog of n products in clusters of near-duplicates: variants of
+# one base title and description with about a fifth of the words replaced, so
+# that every product has true neighbors. A tenth of the products have no
+# description, as in the real catalog. Deterministic in seed.
+def synthetic_catalog(n: int, seed: int = 0, cluster_size: int = 11, vocab_size: int = 20000) -> List[Dict]:
+    rng = random.Random(seed)
+    vocab = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))) for _ in range(vocab_size)]
+
+    def variant(words: List[str]) -> str:
+        return ' '.join(rng.choice(vocab) if rng.random() < 0.2 else word for word in words)
+
+    products = []
+    while len(products) < n:
+        title = rng.choices(vocab, k=rng.randint(4, 12))
+        description = rng.choices(vocab, k=rng.randint(10, 80))
+        for _ in range(min(cluster_size, n - len(products))):
+            product = {'asin': 'S%09d' % len(products), 'title': variant(title).title()}
+            if rng.random() >= 0.1:
+                product['description'] = [variant(description)]
+            products.append(product)
+    return products
+
+# Exact top-k by Jaccard against every other duplicate group (see
+# recommender.FieldIndex), best first
+def brute_force_similar(index: FieldIndex, asin: str, k: int = 10) -> List[Tuple[str, float]]:
+    c = index.asin_to_index[asin]
+    if not len(index.shingles(asin)):
+        return []
+    reps = np.asarray(index.representatives)
+    others = np.flatnonzero((reps == np.arange(len(reps))) & (reps != reps[c]))
+    scores = pairwise_jaccard(index.indptr, index.indices, np.full(len(others), c), others)
+    top = np.argsort(-scores, kind='stable')[:k]
+    return [(index.asins[others[i]], float(scores[i])) for i in top.tolist() if scores[i] > 0]
+
+# Exact top-k by hybrid score (default weights) against every other hybrid
+# duplicate group (see recommender.hybrid_top_k_columns), each represented by
+# its first column
+def brute_force_hybrid(indexes: Dict[str, FieldIndex], asin: str, k: int = 10) -> List[Tuple[str, float]]:
+    index = indexes[FIELDS[0]]
+    c = index.asin_to_index[asin]
+    groups = np.column_stack([np.asarray(indexes[field].representatives) for field in check_weights(indexes, None)])
+    _, first = np.unique(groups, axis=0, return_index=True)
+    others = np.sort(first[(groups[first] != groups[c]).any(axis=1)])
+    scores = hybrid_scores(indexes, check_weights(indexes, None), np.full(len(others), c), others)
+    top = np.argsort(-scores, kind='stable')[:k]
+    return [(index.asins[others[i]], float(scores[i])) for i in top.tolist() if scores[i] > 0]
+
+# recall_at_k for the hybrid score
+def hybrid_recall_at_k(indexes: Dict[str, FieldIndex], asin: str, result: List[Tuple[str, float]],
+                       exact: List[Tuple[str, float]]) -> float:
+    if not exact:
+        return 1.0
+    index = indexes[FIELDS[0]]
+    cands = np.array([index.asin_to_index[cand] for cand, _ in result], dtype=np.int64)
+    scores = hybrid_scores(indexes, check_weights(indexes, None), np.full(len(cands), index.asin_to_index[asin]), cands)
+    return min(int(np.sum(scores >= exact[-1][1])), len(exact)) / len(exact)
+
+def percentiles(values: List[float]) -> Tuple[float, float]:
+    return float(np.percentile(values, 50)), float(np.percentile(values, 99))
+
+def benchmark_field(index: FieldIndex, asins: List[str], k: int = 10) -> Dict[str, float]:
+    candidates, lsh_ms, query_ms, recalls = [], [], [], []
+    for asin in asins:
+        signature = index.signature(asin)
+        start = time.perf_counter()
+        candidates.append(len(index.lsh.query(signature)))
+        lsh_ms.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        result = batch_similar(index, [asin], k).get(asin, [])
+        query_ms.append((time.perf_counter() - start) * 1000)
+        recalls.append(recall_at_k(index, asin, result, brute_force_similar(index, asin, k)))
+    (lsh_p50, lsh_p99), (query_p50, query_p99) = percentiles(lsh_ms), percentiles(query_ms)
+    return {'candidates_mean': float(np.mean(candidates)), 'candidates_p99': float(np.percentile(candidates, 99)),
+            'lsh_query_p50_ms': lsh_p50, 'lsh_query_p99_ms': lsh_p99, 'query_p50_ms': query_p50, 'query_p99_ms': query_p99,
+            'recall_at_k': float(np.mean(recalls))}
+
+# benchmark_field for the hybrid similarity; candidates are the union of the
+# fields' LSH candidates
+def benchmark_hybrid(indexes: Dict[str, FieldIndex], asins: List[str], k: int = 10) -> Dict[str, float]:
+    candidates, lsh_ms, query_ms, recalls = [], [], [], []
+    for asin in asins:
+        start = time.perf_counter()
+        cands = [indexes[field].lsh.query(indexes[field].signature(asin)) for field in FIELDS if len(indexes[field].shingles(asin))]
+        candidates.append(len(np.unique(np.concatenate(cands))) if cands else 0)
+        lsh_ms.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        result = hybrid_similar(indexes, [asin], k).get(asin, [])
+        query_ms.append((time.perf_counter() - start) * 1000)
+        recalls.append(hybrid_recall_at_k(indexes, asin, result, brute_force_hybrid(indexes, asin, k)))
+    (lsh_p50, lsh_p99), (query_p50, query_p99) = percentiles(lsh_ms), percentiles(query_ms)
+    return {'candidates_mean': float(np.mean(candidates)), 'candidates_p99': float(np.percentile(candidates, 99)),
+            'lsh_query_p50_ms': lsh_p50, 'lsh_query_p99_ms': lsh_p99, 'query_p50_ms': query_p50, 'query_p99_ms': query_p99,
+            'recall_at_k': float(np.mean(recalls))}
+
+def peak_rss_mb() -> float:
+    # On Linux ru_maxrss survives exec, so a spawned run would report the peak
+    # of the process that started it; VmHWM is the peak of this process only
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1 << 20) if sys.platform == 'darwin' else maxrss / 1024
+
+# One suite run: source is 'synthetic' or the path of a catalog, of which the
+# first n products are used. max_bucket and max_candidates bound the queries
+# (see LSH); recall is still measured against brute force.
+def run_benchmark(source: str, n: int, bands: int, rows: int, queries: int, k: int, seed: int,
+                  max_bucket: Optional[int] = None, max_candidates: Optional[int] = None) -> Dict:
+    start = time.perf_counter()
+    if source == 'synthetic':
+        products = synthetic_catalog(n, seed)
+    else:
+        products = load_catalog(source, INDEX_FIELDS, limit=n, progress=False)
+    load_s = time.perf_counter() - start
+    start = time.perf_counter()
+    indexes = prepare_data(products, n_hashes=bands * rows, bands=bands, rows=rows)
+    build_s = time.perf_counter() - start
+    peak = peak_rss_mb()
+
+    rng = random.Random(seed)
+    fields = {}
+    for field in FIELDS:
+        index = indexes[field]
+        index.lsh.max_bucket, index.lsh.max_candidates = max_bucket, max_candidates
+        asins = index.asins.tolist()
+        fields[field] = benchmark_field(index, rng.sample(asins, min(queries, len(asins))), k)
+        stats = index.lsh.bucket_stats()
+        fields[field].update(bucket_max=stats.get('max', 0), bucket_p99=stats.get('p99', 0.0),
+                             oversized_buckets=stats.get('oversized', 0))
+    asins = indexes[FIELDS[0]].asins.tolist()
+    fields[HYBRID] = benchmark_hybrid(indexes, rng.sample(asins, min(queries, len(asins))), k)
+    return {'source': source, 'products': len(products), 'bands': bands, 'rows': rows, 'max_bucket': max_bucket,
+            'max_candidates': max_candidates, 'load_s': load_s, 'build_s': build_s, 'peak_rss_mb': peak, 'fields': fields}
+
+# A forked child starts with the memory, and so the peak RSS, of its parent:
+# runs go to a spawned interpreter
+def run_isolated(*args) -> Dict:
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(run_benchmark, *args).result()
+
+# caps is a list of (max_bucket, max_candidates) settings to run, (None, None)
+# for unbounded queries
+def run_suite(sources: List[str], scales: List[int], settings: List[Tuple[int, int]], queries: int = 100, k: int = 10,
+              seed: int = 0, caps: Optional[List[Tuple[Optional[int], Optional[int]]]] = None) -> Dict:
+    runs = []
+    for source in sources:
+        for n in scales:
+            for bands, rows in settings:
+                for max_bucket, max_candidates in caps or [(None, None)]:
+                    run = run_isolated(source, n, bands, rows, queries, k, seed, max_bucket, max_candidates)
+                    runs.append(run)
+                    print_run(run, k)
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count(), 'queries': queries, 'k': k, 'seed': seed, 'runs': runs}
+
+def print_run(run: Dict, k: int):
+    print("%s  n=%d  bands=%d rows=%d  max_bucket=%s max_candidates=%s  build %.2fs  peak RSS %.0f MB"
+          % (run['source'], run['products'], run['bands'], run['rows'], run['max_bucket'], run['max_candidates'],
+             run['build_s'], run['peak_rss_mb']))
+    for field, row in run['fields'].items():
+        print("  %-12s candidates %8.1f  lsh p50 %7.3f ms p99 %7.3f ms  query p50 %7.3f ms p99 %7.3f ms  recall@%d %.3f"
+              % (field, row['candidates_mean'], row['lsh_query_p50_ms'], row['lsh_query_p99_ms'], row['query_p50_ms'],
+                 row['query_p99_ms'], k, row['recall_at_k']))
+
+# Relative change of the headline numbers of every run also present in baseline
+def compare_reports(baseline: Dict, report: Dict):
+    def key(run):
+        return run['source'], run['products'], run['bands'], run['rows'], run.get('max_bucket'), run.get('max_candidates')
+    old_runs = {key(run): run for run in baseline['runs']}
+    for run in report['runs']:
+        old = old_runs.get(key(run))
+        if old is None:
+            continue
+        print("%s n=%d %dx%d caps %s/%s: build %+.0f%%  peak RSS %+.0f%%" % (key(run) + (
+              100 * (run['build_s'] / max(old['build_s'], 1e-9) - 1), 100 * (run['peak_rss_mb'] / max(old['peak_rss_mb'], 1e-9) - 1))))
+        for field, row in run['fields'].items():
+            if field in old['fields']:
+                before = old['fields'][field]
+                print("  %-12s query p99 %+.0f%%  recall %+.3f" % (field, 100 * (row['query_p99_ms'] / max(before['query_p99_ms'], 1e-9) - 1),
+                                                                   row['recall_at_k'] - before['recall_at_k']))
+
+def parse_caps(text: str) -> Tuple[Optional[int], Optional[int]]:
+    if text.lower() == 'none':
+        return None, None
+    max_bucket, max_candidates = text.split('/')
+    return (None if max_bucket.lower() == 'none' else int(max_bucket),
+            None if max_candidates.lower() == 'none' else int(max_candidates))
+
+def parse_setting(text: str) -> Tuple[int, int]:
+    bands, rows = text.lower().split('x')
+    return int(bands), int(rows)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare latency and recall of the similarity scoring modes, "
+                                                 "or with --suite benchmark index build and queries at several scales")
+    parser.add_argument("source", nargs="?", default="meta_Appliances.json")
+    parser.add_argument("--limit", type=int, default=20000, help="number of products to index")
+    parser.add_argument("--queries", type=int, default=200, help="number of products to query per field")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--suite", action="store_true",
+                        help="run the benchmark suite instead: build time, peak RSS, candidates, latency and recall "
+                             "on synthetic catalogs and samples of source at every scale")
+    parser.add_argument("--scales", default="1000,5000,20000", help="suite: catalog sizes, comma separated")
+    parser.add_argument("--lsh", default="20x5", help="suite: BANDSxROWS settings, comma separated")
+    parser.add_argument("--baseline", help="suite: earlier --json output to compare against")
+    parser.add_argument("--caps", default="none",
+                        help="suite: MAX_BUCKET/MAX_CANDIDATES query limits to compare, comma separated, e.g. none,1000/500")
+    args = parser.parse_args()
+
+    if args.suite:
+        sources = ['synthetic'] + ([args.source] if os.path.exists(args.source) else [])
+        report = run_suite(sources, [int(n) for n in args.scales.split(',')], [parse_setting(s) for s in args.lsh.split(',')],
+                           args.queries, args.k, args.seed, [parse_caps(c) for c in args.caps.split(',')])
+        if args.baseline:
+            with open(args.baseline) as f:
+                compare_reports(json.load(f), report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+        sys.exit(0)
+
+    products = load_catalog(args.source, INDEX_FIELDS, limit=args.limit)
+    indexes = prepare_data(products)
+    rng = random.Random(args.seed)
+
+    results = {}
+    for field in FIELDS:
+        asins = indexes[field].asins.tolist()
+        sample = rng.sample(asins, min(args.queries, len(asins)))
+        results[field] = benchmark_scoring(indexes[field], sample, args.k)
+        print(field)
+        for name, row in results[field].items():
+            print("  %-10s p50 %8.3f ms  p99 %8.3f ms  mean %8.3f ms  recall@%d %.3f"
+                  % (name, row['p50_ms'], row['p99_ms'], row['mean_ms'], args.k, row['recall_at_k']))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'source': args.source, 'products': len(products), 'queries': args.queries, 'k': args.k,
+                       'fields': results}, f, indent=2)
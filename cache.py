@@ -0,0 +1,94 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+# Rough size in bytes of a cached value: strings, numbers and the lists, tuples
+# and dicts built from them (recommendation lists, rendered pages)
+def approx_size(value: Any) -> int:
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(approx_size(item) for item in value)
+    elif isinstance(value, dict):
+        size += sum(approx_size(key) + approx_size(item) for key, item in value.items())
+    return size
+
+# Thread-safe LRU cache bounded by entry count and (approximate) memory, with an
+# optional time-to-live per entry.
+#
+# Values are tied to an index version: sync_version() drops every entry as soon
+# as the version it is given differs from the one the entries were cached under,
+# so a rebuilt or reloaded index never serves stale results.
+class LRUCache:
+    def __init__(self, max_entries: int = 10000, max_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version = None
+        self.entries = OrderedDict()  # key -> (value, size, expires)
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, size, expires = entry
+            if expires is not None and time.monotonic() >= expires:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        size = approx_size(value) if self.max_bytes is not None else 0
+        # A value larger than the whole budget is not worth evicting everything for
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, expires)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    # Drop all entries when version differs from the one they were cached under
+    def sync_version(self, version: Hashable):
+        with self.lock:
+            if version == self.version:
+                return
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.bytes = 0
+            self.version = version
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'bytes': self.bytes, 'max_entries': self.max_entries,
+                    'max_bytes': self.max_bytes, 'ttl': self.ttl, 'version': self.version,
+                    'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'expirations': self.expirations, 'invalidations': self.invalidations}
@@ -0,0 +1,279 @@
+import os
+import sys
+import copy
+import json
+import math
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Dict, Set, Tuple, Optional, Iterator, Iterable, Union
+
+from metrics import REGISTRY
+
+CATALOG_LOAD_SECONDS = REGISTRY.gauge('catalog_load_seconds', 'Duration of the last catalog load.')
+CATALOG_PRODUCTS = REGISTRY.gauge('catalog_products', 'Products read by the last catalog load.')
+
+# orjson parses the catalog several times faster when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Fields each consumer reads from a product. Projecting to them right after
+# parsing keeps only what is used instead of every full product dict.
+LISTING_FIELDS = ['asin', 'title', 'brand', 'price', 'imageURLHighRes']
+DETAIL_FIELDS = LISTING_FIELDS + ['category', 'date', 'feature', 'description', 'also_buy', 'also_view']
+INDEX_FIELDS = ['asin', 'title', 'description']
+
+# Parse one chunk of JSON lines, keeping only fields (all of them when None)
+def parse_chunk(chunk: bytes, fields: Optional[List[str]] = None) -> List[Dict]:
+    products = []
+    for line in chunk.splitlines():
+        if not line.strip():
+            continue
+        product = json_loads(line)
+        if fields is not None:
+            product = {key: product[key] for key in fields if key in product}
+        products.append(product)
+    return products
+
+# Blocks of about chunk_bytes that always end on a line boundary
+def read_chunks(path: str, chunk_bytes: int) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_bytes)
+            if not chunk:
+                return
+            yield chunk + f.readline()
+
+# Load a JSON-lines catalog. The file is streamed in chunks that are parsed by
+# a pool of worker processes (at most 2 chunks per worker in flight, so memory
+# stays bounded) and reassembled in file order. With workers=1, or where fork
+# is not available, chunks are parsed in this process. Progress and timing go
+# to stderr unless progress is False.
+def load_catalog(path: str, fields: Optional[List[str]] = None, workers: Optional[int] = None,
+                 chunk_bytes: int = 8 << 20, limit: Optional[int] = None, progress: bool = True) -> List[Dict]:
+    start = time.perf_counter()
+    total_bytes = os.path.getsize(path)
+    workers = workers or os.cpu_count() or 1
+    if total_bytes <= chunk_bytes or 'fork' not in multiprocessing.get_all_start_methods():
+        workers = 1
+
+    products, done_bytes, last_report = [], 0, start
+
+    def collect(chunk_size: int, parsed: List[Dict]) -> bool:
+        nonlocal done_bytes, last_report
+        products.extend(parsed)
+        done_bytes += chunk_size
+        # At most one progress line per second
+        if progress and time.perf_counter() - last_report >= 1.0:
+            last_report = time.perf_counter()
+            elapsed = last_report - start
+            print("\rloading %s: %5.1f%%  %d products  %.1fs" % (path, 100 * done_bytes / max(total_bytes, 1),
+                  len(products), elapsed), end='', file=sys.stderr, flush=True)
+        return limit is not None and len(products) >= limit
+
+    if workers == 1:
+        for chunk in read_chunks(path, chunk_bytes):
+            if collect(len(chunk), parse_chunk(chunk, fields)):
+                break
+    else:
+        # fork so the workers do not re-import the calling module, which may be
+        # an app that loads the catalog at import time
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            pending, stop = [], False
+            for chunk in read_chunks(path, chunk_bytes):
+                pending.append((len(chunk), pool.submit(parse_chunk, chunk, fields)))
+                if len(pending) >= 2 * workers:
+                    size, future = pending.pop(0)
+                    stop = collect(size, future.result())
+                    if stop:
+                        break
+            while pending and not stop:
+                size, future = pending.pop(0)
+                stop = collect(size, future.result())
+            for _, future in pending:
+                future.cancel()
+
+    if limit is not None:
+        del products[limit:]
+    elapsed = time.perf_counter() - start
+    CATALOG_LOAD_SECONDS.set(elapsed)
+    CATALOG_PRODUCTS.set(len(products))
+    if progress:
+        print("\rloaded %d products from %s in %.2fs (%.1f MB/s, %d worker%s)" % (
+              len(products), path, elapsed, done_bytes / 1e6 / max(elapsed, 1e-9), workers, '' if workers == 1 else 's'),
+              file=sys.stderr)
+    return products
+
+# Catalog changes from JSON lines, in batches of at most batch_size lines. A
+# line is {"op": "delete", "asin": ...}, {"op": "upsert", "product": {...}} or a
+# bare product, which is an upsert; products are projected to fields like in
+# load_catalog. Within a batch the last change of an asin wins. Yields
+# (upserted products by asin, deleted asins).
+def parse_delta(lines: Iterable[Union[bytes, str]], fields: Optional[List[str]] = None,
+                batch_size: int = 10000) -> Iterator[Tuple[Dict[str, Dict], Set[str]]]:
+    upserts, deletes, count = {}, set(), 0
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        change = json_loads(line)
+        op = change.get('op') if isinstance(change, dict) else None
+        product = change.get('product') if op == 'upsert' else change if op is None else None
+        asin = change.get('asin') if op == 'delete' else product.get('asin') if isinstance(product, dict) else None
+        if not isinstance(asin, str):
+            raise ValueError("line %d: expected a product with an asin or {\"op\": \"delete\", \"asin\": ...}" % number)
+        if op == 'delete':
+            upserts.pop(asin, None)
+            deletes.add(asin)
+        else:
+            deletes.discard(asin)
+            upserts[asin] = {key: product[key] for key in fields if key in product} if fields is not None else product
+        count += 1
+        if count >= batch_size:
+            yield upserts, deletes
+            upserts, deletes, count = {}, set(), 0
+    if count:
+        yield upserts, deletes
+
+def read_delta(path: str, fields: Optional[List[str]] = None, batch_size: int = 10000) -> Iterator[Tuple[Dict[str, Dict], Set[str]]]:
+    with open(path, 'rb') as f:
+        yield from parse_delta(f, fields, batch_size)
+
+# Keys of a product in the brand and category lookups of ProductStore
+def brand_keys(product: Dict) -> List[str]:
+    return [product['brand']] if product.get('brand') else []
+
+def category_keys(product: Dict) -> List[str]:
+    return list(dict.fromkeys(product.get('category', [])))
+
+# lookup (key -> products in catalog order) after the products of replaced,
+# (old product, new product or None when deleted) pairs, were replaced in place
+# and added appended. Only the lists of keys these products have, before or
+# after, are copied; products joining a list are placed by their position in
+# the product list the lookup was built from, which positions() returns (by id
+# of product).
+def updated_lookup(lookup: Dict[str, List[Dict]], keys: Callable[[Dict], List[str]], positions: Callable[[], Dict[int, int]],
+                   replaced: List[Tuple[Dict, Optional[Dict]]], added: List[Dict]) -> Dict[str, List[Dict]]:
+    # Per key: what each of its replaced products becomes (None when it leaves
+    # the list), the products joining it and those appended to it
+    staying, joining, appended = {}, {}, {}
+    for old, new in replaced:
+        old_keys, new_keys = keys(old), keys(new) if new is not None else []
+        for key in old_keys:
+            staying.setdefault(key, {})[id(old)] = new if key in new_keys else None
+        for key in new_keys:
+            if key not in old_keys:
+                joining.setdefault(key, []).append((old, new))
+    for product in added:
+        for key in keys(product):
+            appended.setdefault(key, []).append(product)
+
+    lookup = dict(lookup)
+    for key in set(staying) | set(joining) | set(appended):
+        changes, olds = staying.get(key, {}), lookup.get(key, [])
+        products = [changes.get(id(old), old) for old in olds]
+        if key in joining:
+            position = positions()
+            # Binary search of each joining product's place among olds; the
+            # last go in first so the places of the others do not move
+            for old, new in sorted(joining[key], key=lambda entry: position[id(entry[0])], reverse=True):
+                lo, hi = 0, len(olds)
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if position[id(olds[mid])] < position[id(old)]:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                products.insert(lo, new)
+        if changes:
+            products = [product for product in products if product is not None]
+        products += appended.get(key, [])
+        if products:
+            lookup[key] = products
+        else:
+            lookup.pop(key, None)
+    return lookup
+
+# Products with O(1) lookup by ASIN, optional secondary indexes by brand and by
+# category (every level of a product's category path), and page slices for the
+# listing grid. When an ASIN occurs more than once the first product wins, as
+# with the linear scan this replaces.
+class ProductStore:
+    def __init__(self, products: List[Dict], index_brand: bool = True, index_category: bool = True):
+        self.products = products
+        self.by_asin = {}
+        self.by_brand = {} if index_brand else None
+        self.by_category = {} if index_category else None
+        for product in products:
+            if 'asin' in product:
+                self.by_asin.setdefault(product['asin'], product)
+            if index_brand:
+                for brand in brand_keys(product):
+                    self.by_brand.setdefault(brand, []).append(product)
+            if index_category:
+                for category in category_keys(product):
+                    self.by_category.setdefault(category, []).append(product)
+
+    # A new store with upserts (products by asin) and deletes (asins) applied,
+    # the same as a store built from the changed product list: an upsert
+    # replaces every product with its asin in place and new products go at the
+    # end. This store is not modified and shares every unchanged lookup list.
+    def updated(self, upserts: Dict[str, Dict], deletes: Set[str]) -> 'ProductStore':
+        store = copy.copy(self)
+        store.products, replaced = [], []
+        for product in self.products:
+            asin = product.get('asin')
+            if asin in upserts or asin in deletes:
+                replaced.append((product, upserts.get(asin)))
+                if asin not in upserts:
+                    continue
+                product = upserts[asin]
+            store.products.append(product)
+        added = [product for asin, product in upserts.items() if asin not in self.by_asin]
+        store.products += added
+        store.by_asin = dict(self.by_asin)
+        for asin in deletes:
+            store.by_asin.pop(asin, None)
+        store.by_asin.update(upserts)
+        position = {}
+
+        def positions():
+            if not position:
+                position.update(zip(map(id, self.products), range(len(self.products))))
+            return position
+
+        if self.by_brand is not None:
+            store.by_brand = updated_lookup(self.by_brand, brand_keys, positions, replaced, added)
+        if self.by_category is not None:
+            store.by_category = updated_lookup(self.by_category, category_keys, positions, replaced, added)
+        return store
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def get(self, asin: str) -> Optional[Dict]:
+        return self.by_asin.get(asin)
+
+    # Products matching all given filters, in catalog order
+    def filter(self, brand: Optional[str] = None, category: Optional[str] = None) -> List[Dict]:
+        selected = self.products
+        if brand:
+            selected = self.by_brand.get(brand, []) if self.by_brand is not None else [p for p in selected if p.get('brand') == brand]
+        if category:
+            if self.by_category is not None and not brand:
+                selected = self.by_category.get(category, [])
+            else:
+                selected = [p for p in selected if category in p.get('category', [])]
+        return selected
+
+    # Products on a 1-based page of the (filtered) listing and the page count
+    def page(self, page: int, per_page: int, brand: Optional[str] = None, category: Optional[str] = None) -> Tuple[List[Dict], int]:
+        selected = self.filter(brand, category)
+        total_pages = math.ceil(len(selected) / per_page)
+        if page < 1:
+            return [], total_pages
+        start = (page - 1) * per_page
+        return selected[start:start + per_page], total_pages
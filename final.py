@@ -1,171 +1,429 @@
-from flask import Flask, render_template_string, request, jsonify, url_for
+import os
+import copy
 import json
-import math
-import re
+import gzip
+import hmac
+import time
 import hashlib
-import random
-from collections import defaultdict
-from typing import List, Set, Dict, Tuple
-
-app = Flask(__name__)
-
-# Load JSON file
-with open("meta_Appliances.json", "r", encoding="utf-8") as f:
-    products = [json.loads(line) for line in f]
-
-# Data cleaning
-def clean_text(text: str) -> str:
-    # Remove HTML tags
-    text = re.sub(r'<[^<]+?>', '', text)
-    # Remove extra whitespace
-    text = re.sub(r'\s+', ' ', text).strip()
-    # Lowercase
-    return text.lower()
-
-def get_product_text(product: Dict, field: str) -> str:
-    if field == 'title':
-        return clean_text(product.get('title', ''))
-    elif field == 'description':
-        desc = product.get('description', [])
-        if isinstance(desc, list):
-            return ' '.join(clean_text(d) for d in desc)
-        else:
-            return clean_text(desc)
-    elif field == 'hybrid':
-        title = get_product_text(product, 'title')
-        desc = get_product_text(product, 'description')
-        return title + ' ' + desc
-    return ''
-
-# Shingling
-def get_shingles(text: str, k: int = 3) -> Set[str]:
-    if not text or text.isspace():  # Check for empty string or only spaces
-        return set()
-    if len(text) < k:
-        return set([text])
-    return set(text[i:i+k] for i in range(len(text) - k + 1))
-
-# MinHash
-class MinHash:
-    def __init__(self, n_hashes: int = 100, seed: int = 42):
-        random.seed(seed)
-        self.n_hashes = n_hashes
-        self.a = [random.randint(1, 2**32 - 1) for _ in range(n_hashes)]
-        self.b = [random.randint(0, 2**32 - 1) for _ in range(n_hashes)]
-        self.prime = 2**61 - 1  # Large Mersenne prime
-
-    def compute_hi(self, r: int) -> List[int]:
-        return [(self.a[i] * r + self.b[i]) % self.prime for i in range(self.n_hashes)]
-
-# LSH
-class LSH:
-    def __init__(self, n_hashes: int, bands: int, rows: int):
-        assert n_hashes == bands * rows
-        self.bands = bands
-        self.rows = rows
-        self.buckets = [defaultdict(list) for _ in range(bands)]
-
-    def add(self, item_id: str, signature: List[int]):
-        for band_idx in range(self.bands):
-            start = band_idx * self.rows
-            end = start + self.rows
-            band = tuple(signature[start:end])
-            bucket_key = hash(band)
-            self.buckets[band_idx][bucket_key].append(item_id)
-
-    def query(self, signature: List[int]) -> Set[str]:
-        candidates = set()
-        for band_idx in range(self.bands):
-            start = band_idx * self.rows
-            end = start + self.rows
-            band = tuple(signature[start:end])
-            bucket_key = hash(band)
-            if bucket_key in self.buckets[band_idx]:
-                candidates.update(self.buckets[band_idx][bucket_key])
-        return candidates
-
-# Jaccard Similarity
-def jaccard_similarity(set1: Set[str], set2: Set[str]) -> float:
-    if not set1 or not set2:
-        return 0.0
-    intersection = len(set1 & set2)
-    union = len(set1 | set2)
-    return intersection / union
-
-# Precompute data
-def prepare_data(k_shingle: int = 3, n_hashes: int = 100, bands: int = 20, rows: int = 5, seed: int = 42):
-    asin_to_product = {p['asin']: p for p in products if 'asin' in p}
-    asin_to_shingles = {'title': {}, 'description': {}, 'hybrid': {}}
-    lshs = {'title': LSH(n_hashes, bands, rows), 'description': LSH(n_hashes, bands, rows), 'hybrid': LSH(n_hashes, bands, rows)}
-    asin_to_signature = {'title': {}, 'description': {}, 'hybrid': {}}
-
-    for asin, product in asin_to_product.items():
-        for field in ['title', 'description', 'hybrid']:
-            text = get_product_text(product, field)
-            shingles = get_shingles(text, k_shingle)
-            asin_to_shingles[field][asin] = shingles
-
-    # For each field, compute MinHash signatures using row-major pseudo-code
-    for field in ['title', 'description', 'hybrid']:
-        # Collect unique shingles and map to indices (rows)
-        all_shingles = set()
-        for shingles in asin_to_shingles[field].values():
-            all_shingles.update(shingles)
-        shingle_list = list(all_shingles)
-        shingle_to_index = {sh: idx for idx, sh in enumerate(shingle_list)}
-
-        # Map shingles to list of asins (columns that have 1 in that row)
-        shingle_to_asins = defaultdict(list)
-        for asin, shingles in asin_to_shingles[field].items():
-            for sh in shingles:
-                shingle_to_asins[sh].append(asin)
-
-        # Map asins to column indices
-        asins = list(asin_to_shingles[field].keys())
-        asin_to_index = {asin: idx for idx, asin in enumerate(asins)}
-        num_columns = len(asins)
-
-        # Initialize MinHash and signature matrix M (n_hashes rows, num_columns columns)
-        minhasher = MinHash(n_hashes, seed)
-        M = [[minhasher.prime + 1] * num_columns for _ in range(n_hashes)]
-
-        # Follow pseudo-code: for each row r (shingle)
-        for sh in shingle_list:
-            r = shingle_to_index[sh]
-            # Compute hi(r) for all hash functions
-            h_values = minhasher.compute_hi(r)
-            # For each column c that has 1 in row r
-            for asin in shingle_to_asins[sh]:
-                c = asin_to_index[asin]
-                # For each hash function i
-                for i in range(n_hashes):
-                    if h_values[i] < M[i][c]:
-                        M[i][c] = h_values[i]
-
-        # Extract signatures for each asin
-        for asin in asins:
-            c = asin_to_index[asin]
-            signature = [M[i][c] for i in range(n_hashes)]
-            asin_to_signature[field][asin] = signature
-            lshs[field].add(asin, signature)
-
-    return asin_to_product, asin_to_shingles, lshs, asin_to_signature
-
-# Precompute at startup
-asin_to_product, asin_to_shingles, lshs, asin_to_signature = prepare_data()
+import threading
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from flask import Flask, current_app, g, render_template, request, jsonify, url_for
+
+from cache import LRUCache
+from metrics import REGISTRY, SamplingProfiler
+from search import SearchIndex
+from catalog import load_catalog, parse_delta, ProductStore, DETAIL_FIELDS
+from recommender import load_or_build_index, update_indexes, similar_by_field, precomputed, FIELDS, HYBRID, SCORING_MODES
+
+# Brotli compresses pages better than gzip when the module is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Concurrency model
+#
+# create_app() loads the catalog and returns. The LSH indexes are loaded (or,
+# on the first start for a catalog, built in this one process) by a warm-up
+# thread and published as a new ServingState once complete. Until then the
+# listing and search are served, product pages show no similar products, the
+# similarity and delta APIs answer 503, and GET /ready reports the progress of
+# every field.
+#
+# With create_app(background=False) everything is loaded before it returns.
+# That is the mode for servers that fork their workers from a loaded app
+# (gunicorn --preload, see wsgi.py): the workers share that memory
+# copy-on-write, and a warm-up thread would not survive the fork anyway. The
+# snapshot arrays are memory-mapped read-only, so their pages are shared
+# through the page cache in either mode.
+#
+# Within a process, requests run on threads. Everything a request reads is in
+# one ServingState, which is never modified once published: a request reads
+# serving.state once and uses only that object. Catalog deltas build a new
+# ServingState aside (one writer at a time, under Serving.lock) and publish it
+# with a single attribute assignment, so requests in flight finish on the state
+# they started with and new requests see the new one; no request ever mixes
+# the products of one state with the indexes of another. Cached results and
+# pages are keyed by the state's version for the same reason.
+#
+# Lookups in the precomputed neighbor tables are answered on the request
+# thread. Similarity scored on the fly (minhash and rerank scoring, hybrid, or
+# more neighbors than the table holds) runs in a pool of scoring_workers
+# threads, so a few slow candidate sets cannot occupy every request thread; a
+# request waiting longer than scoring_timeout seconds gets a 503 while its
+# batch finishes in the background and fills the result cache.
+#
+# Deltas only change the process that receives them. With several worker
+# processes, change the catalog file and restart the workers instead.
+
+# Bound the work of queries scored on the fly (minhash and rerank scoring, or
+# more neighbors than the precomputed table holds): at most MAX_BUCKET postings
+# per hot bucket and the MAX_CANDIDATES columns with the most band collisions
+MAX_BUCKET = 1000
+MAX_CANDIDATES = 500
+
+# Each field gets the (bands, rows) setting that finds 90% of the pairs with
+# Jaccard >= 0.5 at the fewest candidates per query (at most 200 if possible).
+LSH_TUNING = {'threshold': 0.5, 'recall': 0.9, 'max_candidates': 200}
+
+def limit_queries(indexes):
+    for index in indexes.values():
+        index.lsh.max_bucket, index.lsh.max_candidates = MAX_BUCKET, MAX_CANDIDATES
+
+# Similarity types shown on the product page and the field each one uses
+field_map = {'pst': 'title', 'psd': 'description', 'pstd': HYBRID}
+
+# View-models: the values the templates print, derived once per product at
+# startup so that rendering does no per-request defaulting or key filtering
+def listing_view(product):
+    title = product.get('title', 'No Title')
+    price = product.get('price', '')
+    return {'asin': product['asin'], 'title': title, 'short_title': title[:50], 'brand': product.get('brand', 'Unknown'),
+            'image': (product.get('imageURLHighRes') or [None])[0], 'price': price if price.startswith('$') else ''}
+
+def detail_view(product):
+    view = listing_view(product)
+    view.update(brand=product.get('brand', 'N/A'), category=' > '.join(map(str, product.get('category', []))),
+                date=product.get('date', 'N/A'), features=product.get('feature', []),
+                description=' '.join(map(str, product.get('description', []))),
+                details=[(key, value) for key, value in product.items() if key in ('also_buy', 'also_view')])
+    return view
+
+def indexes_version(indexes):
+    return '/'.join(indexes[field].version for field in sorted(indexes))
+
+# Products, their lookups, search index, view-models and LSH indexes, as one
+# unit that requests read and deltas replace (see the concurrency model above).
+# indexes is empty until the warm-up publishes them. catalog_version
+# identifies the catalog file and modified is when the state's content last
+# changed (a Unix time); with version they are the HTTP validators of every
+# page (see HTTP caching below).
+class ServingState:
+    def __init__(self, products, indexes, catalog_version='', modified=None):
+        self.products = products
+        self.catalog_version = catalog_version
+        self.modified = modified if modified is not None else time.time()
+        self.store = ProductStore(products)
+        self.search_index = SearchIndex(products)
+        self.indexes = indexes
+        self.listing_views = {asin: listing_view(product) for asin, product in self.store.by_asin.items()}
+        self.detail_views = {asin: detail_view(product) for asin, product in self.store.by_asin.items()}
+        self.version = indexes_version(indexes)
+
+    # View-model of a product of the listing. Views are kept per asin, of the
+    # first product with it; a repeated asin's other products are rendered
+    # from their own data.
+    def listing_row(self, product):
+        if self.store.by_asin.get(product['asin']) is product:
+            return self.listing_views[product['asin']]
+        return listing_view(product)
+
+    # The same products with other indexes, built at modified (by default the
+    # state's own time)
+    def with_indexes(self, indexes, modified=None):
+        state = copy.copy(self)
+        state.indexes, state.version = indexes, indexes_version(indexes)
+        state.modified = max(self.modified, modified or 0)
+        return state
+
+    # New state with one batch of upserts and deletes applied, and the number
+    # of products actually deleted. Only the changed products are re-indexed:
+    # the store, search index and view-models share everything else with this
+    # state, which is not modified.
+    def updated(self, upserts, deletes):
+        deletes = {asin for asin in deletes if asin in self.store.by_asin}
+        state = copy.copy(self)
+        state.indexes = update_indexes(self.indexes, upserts, deletes)
+        state.version, state.modified = indexes_version(state.indexes), time.time()
+        state.store = self.store.updated(upserts, deletes)
+        state.products = state.store.products
+        state.search_index = self.search_index.updated(upserts, deletes)
+        state.listing_views, state.detail_views = dict(self.listing_views), dict(self.detail_views)
+        for asin in deletes:
+            del state.listing_views[asin], state.detail_views[asin]
+        for asin, product in upserts.items():
+            state.listing_views[asin], state.detail_views[asin] = listing_view(product), detail_view(product)
+        return state, len(deletes)
+
+class ScoringTimeout(Exception):
+    pass
+
+class IndexNotReady(Exception):
+    pass
+
+# Per-app serving machinery around the current ServingState: the caches, the
+# scoring pool and the delta writer lock. Similar-product lists, rendered pages
+# of popular products and search results are served from bounded LRU caches,
+# emptied whenever the state version changes. Search results have a small
+# cache of their own, so that the many distinct typeahead queries do not evict
+# hot pages. A cached page keeps its compressed bodies next to it, each
+# encoding compressed on first request. With page_cache=False pages and search
+# results are always rendered and compressed.
+class Serving:
+    def __init__(self, state, scoring_workers=4, scoring_timeout=10.0, page_cache=True):
+        self.state = state
+        self.lock = threading.Lock()
+        self.result_cache = LRUCache(max_entries=20000, max_bytes=64 << 20, ttl=3600)
+        self.page_cache = LRUCache(max_entries=2000, max_bytes=128 << 20, ttl=600) if page_cache else None
+        self.search_cache = LRUCache(max_entries=1000, max_bytes=8 << 20, ttl=300) if page_cache else None
+        self.scoring_workers = scoring_workers
+        self.scoring_timeout = scoring_timeout
+        self.pool_lock = threading.Lock()
+        self.pool_pid, self.scoring_pool = None, None
+        # Phase of the index build (see recommender.BUILD_PHASE_SECONDS) and
+        # the fraction of it done, per field, until the indexes are published
+        self.warmup = {field: {'phase': 'pending', 'progress': 0.0} for field in FIELDS}
+        self.warmup_error = None
+
+    # Load or build the indexes for the state's products and publish them.
+    # workers is the number of build processes (see recommender.prepare_data).
+    def warm_up(self, catalog_path, snapshot_dir, workers=None):
+        def progress(field, phase, fraction):
+            self.warmup[field] = {'phase': phase, 'progress': round(fraction, 3)}
+
+        try:
+            indexes = load_or_build_index(catalog_path, self.state.products, snapshot_dir, workers=workers, tuning=LSH_TUNING,
+                                          progress=progress)
+        except Exception as e:
+            self.warmup_error = '%s: %s' % (type(e).__name__, e)
+            for field in FIELDS:
+                self.warmup[field] = dict(self.warmup[field], phase='failed')
+            raise
+        limit_queries(indexes)
+        # Pages with similar products date from the snapshot
+        manifest = os.path.join(snapshot_dir, indexes[FIELDS[0]].version, 'manifest.json')
+        modified = os.path.getmtime(manifest) if os.path.exists(manifest) else None
+        with self.lock:
+            self.state = self.state.with_indexes(indexes, modified)
+        for field in FIELDS:
+            self.warmup[field] = {'phase': 'ready', 'progress': 1.0}
+
+    def field_ready(self, state, field):
+        return all(name in state.indexes for name in (FIELDS if field == HYBRID else [field]))
+
+    def readiness(self):
+        state = self.state
+        fields = {field: dict(self.warmup[field], ready=field in state.indexes) for field in FIELDS}
+        return {'ready': all(field['ready'] for field in fields.values()), 'fields': fields, 'error': self.warmup_error}
+
+    # The scoring pool of this process. Threads do not survive a fork, so a
+    # worker forked after create_app starts its own pool on first use.
+    def pool(self):
+        if self.pool_pid != os.getpid():
+            with self.pool_lock:
+                if self.pool_pid != os.getpid():
+                    self.scoring_pool = ThreadPoolExecutor(self.scoring_workers, thread_name_prefix='scoring')
+                    self.pool_pid = os.getpid()
+        return self.scoring_pool
+
+    # Pages are dicts of the content type and the body per content coding
+    # ('identity' for the uncompressed bytes), cached by key: ('search', query)
+    # in the search cache, other keys in the page cache
+    def cache_of(self, key):
+        return self.search_cache if key[0] == 'search' else self.page_cache
+
+    def cached_page(self, state, key):
+        cache = self.cache_of(key)
+        if cache is None:
+            return None
+        cache.sync_version(state.version)
+        return cache.get(key + (state.version,))
+
+    def store_page(self, state, key, body, content_type="text/html; charset=utf-8"):
+        page = {'content_type': content_type, 'identity': body.encode('utf-8')}
+        if self.cache_of(key) is not None:
+            self.cache_of(key).put(key + (state.version,), page)
+        return page
+
+    # The body of page in encoding, compressed once per cached page
+    def encoded(self, state, key, page, encoding):
+        body = page.get(encoding)
+        if body is None:
+            body = compress(page['identity'], encoding)
+            page = dict(page, **{encoding: body})
+            if self.cache_of(key) is not None:
+                self.cache_of(key).put(key + (state.version,), page)
+        return body
+
+    # similar_by_field through the result cache: only the asins without a
+    # cached list are queried, in one batch, in the scoring pool unless the
+    # neighbor table has the answer. weights only apply to HYBRID. Raises
+    # IndexNotReady until the field's index is published.
+    def similar(self, state, field, asins, k, scoring, weights=None):
+        if not self.field_ready(state, field):
+            raise IndexNotReady(field)
+        version = state.version
+        self.result_cache.sync_version(version)
+        key = (field, k, scoring, tuple(sorted(weights.items())) if weights else None, version)
+        results, missing = {}, []
+        for asin in dict.fromkeys(asins):
+            neighbors = self.result_cache.get((asin,) + key)
+            if neighbors is None:
+                missing.append(asin)
+            else:
+                results[asin] = neighbors
+        if missing:
+            if field != HYBRID and precomputed(state.indexes[field], k, scoring):
+                found = similar_by_field(state.indexes, field, missing, k, scoring)
+                self.cache_similar(found, key)
+            else:
+                # A batch that outlives the request still fills the cache for a retry
+                def done(future):
+                    if future.exception() is None:
+                        self.cache_similar(future.result(), key)
+
+                future = self.pool().submit(similar_by_field, state.indexes, field, missing, k, scoring, weights)
+                future.add_done_callback(done)
+                try:
+                    found = future.result(self.scoring_timeout)
+                except concurrent.futures.TimeoutError:
+                    # Only the builtin TimeoutError from Python 3.11 on
+                    raise ScoringTimeout()
+            results.update(found)
+        return {asin: results[asin] for asin in dict.fromkeys(asins) if asin in results}
+
+    def cache_similar(self, found, key):
+        for asin, neighbors in found.items():
+            self.result_cache.put((asin,) + key, neighbors)
+
+    def apply_delta(self, lines):
+        upserted = deleted = 0
+        with self.lock:
+            if not self.state.indexes:
+                raise IndexNotReady()
+            for upserts, deletes in parse_delta(lines, DETAIL_FIELDS):
+                self.state, n_deleted = self.state.updated(upserts, deletes)
+                upserted += len(upserts)
+                deleted += n_deleted
+            state = self.state
+        return {"upserted": upserted, "deleted": deleted, "products": len(state.store.by_asin), "index_version": state.version}
+
+def serving():
+    return current_app.extensions['serving']
+
+# Metrics
+#
+# GET /metrics serves the metrics of this process in the Prometheus text
+# format: request latency per route, template rendering time, the stage timers
+# and candidate counts of similarity queries and the index build phases (see
+# recommender), the catalog load, the size of every index structure and the
+# caches. Setting PROFILE_REQUESTS=1 lets a request add ?profile=1 to get, in
+# place of its response, the collapsed stacks sampled while it ran (for
+# flamegraph.pl or speedscope); the parameter is ignored otherwise.
+REQUEST_SECONDS = REGISTRY.histogram('http_request_duration_seconds', 'Request latency by route, method and status.',
+                                     ['route', 'method', 'status'])
+RENDER_SECONDS = REGISTRY.histogram('template_render_seconds', 'Page template rendering time.', ['template'])
+
+def index_structure_bytes(state):
+    for field, index in state.indexes.items():
+        lsh, table = index.lsh, index.neighbors
+        structures = {'asins': [index.asins], 'shingles': [index.indptr, index.indices], 'signatures': [index.signatures],
+                      'buckets': [lsh.band_ptr, lsh.keys, lsh.offsets, lsh.postings],
+                      'duplicate_groups': [index.content_hashes, index.representatives],
+                      'neighbors': [table.neighbors, table.scores] if table is not None else []}
+        for structure, arrays in structures.items():
+            # Snapshot arrays are memory-mapped: their pages are shared between
+            # processes and only resident while used
+            storage = 'mmap' if any(isinstance(array, np.memmap) for array in arrays) else 'heap'
+            yield (field, structure, storage), sum(array.nbytes for array in arrays)
+
+def register_metrics(app_serving):
+    REGISTRY.gauge('index_structure_bytes', 'Size of each index structure.', ['field', 'structure', 'storage'],
+                   collect=lambda: list(index_structure_bytes(app_serving.state)))
+    REGISTRY.gauge('index_ready', 'Whether the index of each field is loaded.', ['field'],
+                   collect=lambda: [((field,), float(field in app_serving.state.indexes)) for field in FIELDS])
+    REGISTRY.gauge('search_index_documents', 'Titles in the typeahead index.',
+                   collect=lambda: [((), len(app_serving.state.search_index))])
+
+    def cache_stat(name):
+        return lambda: [((cache,), lru.stats()[name]) for cache, lru in
+                        (('results', app_serving.result_cache), ('pages', app_serving.page_cache),
+                         ('search', app_serving.search_cache)) if lru is not None]
+
+    for name, kind in [('entries', 'gauge'), ('bytes', 'gauge'), ('hits', 'counter'), ('misses', 'counter'),
+                       ('evictions', 'counter'), ('invalidations', 'counter')]:
+        metric_name = 'cache_%s%s' % (name, '_total' if kind == 'counter' else '')
+        getattr(REGISTRY, kind)(metric_name, 'Cache %s.' % name, ['cache'], collect=cache_stat(name))
+
+def start_request():
+    g.request_start = time.perf_counter()
+    if current_app.config['PROFILE_REQUESTS'] and request.args.get("profile"):
+        g.profiler = SamplingProfiler(threading.get_ident())
+        g.profiler.start()
+
+def finish_request(response):
+    # Routes are labelled by rule, not path, so the number of series stays bounded
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, route=route, method=request.method,
+                            status=response.status_code)
+    if not response.is_streamed:
+        RESPONSE_BYTES.inc(len(response.get_data()), route=route, encoding=response.content_encoding or 'identity')
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        return current_app.response_class(profiler.stop(), mimetype="text/plain")
+    return response
+
+def metrics():
+    return current_app.response_class(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+# HTTP caching
+#
+# The listing, product pages and search results carry validators derived from
+# the serving state: a weak ETag hashing the catalog and index versions with
+# the page's key, and Last-Modified, the state's modified time. A request whose
+# If-None-Match (or, without it, If-Modified-Since) still matches gets a 304
+# before anything is looked up or rendered. CACHE_CONTROL is the policy of each
+# route; product pages still waiting for the index are sent with no-store and
+# no validators. Bodies of at least MIN_COMPRESS_BYTES are sent brotli- or
+# gzip-compressed, whichever the client accepts (brotli first, when the
+# module is installed); the compressed bodies of cached pages are kept with
+# them (see Serving.encoded).
+CACHE_CONTROL = {'home': 'public, max-age=60', 'product': 'public, max-age=60', 'search': 'public, max-age=300'}
+MIN_COMPRESS_BYTES = 1024
+ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+RESPONSE_BYTES = REGISTRY.counter('http_response_body_bytes_total', 'Response body bytes sent, by route and content coding.',
+                                  ['route', 'encoding'])
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+def page_etag(state, key):
+    return hashlib.blake2b(repr((state.catalog_version, state.version, key)).encode('utf-8'), digest_size=12).hexdigest()
+
+def not_modified(state, key):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(page_etag(state, key))
+    since = request.if_modified_since
+    return since is not None and int(state.modified) <= since.timestamp()
+
+def set_validators(response, state, key, policy):
+    response.set_etag(page_etag(state, key), weak=True)
+    response.last_modified = int(state.modified)
+    response.headers['Cache-Control'] = CACHE_CONTROL[policy]
+    response.vary.add('Accept-Encoding')
+    return response
+
+def not_modified_response(state, key, policy):
+    return set_validators(current_app.response_class(status=304), state, key, policy)
+
+# The page in the best encoding the client accepts, with its validators
+def page_response(app_serving, state, key, page, policy):
+    encoding = None
+    if len(page['identity']) >= MIN_COMPRESS_BYTES:
+        encoding = next((encoding for encoding in ENCODINGS if request.accept_encodings[encoding] > 0), None)
+    body = page['identity'] if encoding is None else app_serving.encoded(state, key, page, encoding)
+    response = current_app.response_class(body, content_type=page['content_type'])
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    return set_validators(response, state, key, policy)
 
 # Home page (grid view with pagination + search bar)
-@app.route("/")
-def home():
-    per_page = 40
-    page = request.args.get("page", 1, type=int)
-    total_pages = math.ceil(len(products) / per_page)
-
-    start = (page - 1) * per_page
-    end = start + per_page
-    page_products = products[start:end]
-
-    template = """
+HOME_TEMPLATE = """
     <!doctype html>
     <html lang="en">
     <head>
@@ -220,18 +478,18 @@ def home():
                     <div class="col-md-3">
                         <div class="card h-100 shadow-sm">
                             <div class="image-box">
-                                {% if product.get('imageURLHighRes') %}
-                                    <img src="{{ product.imageURLHighRes[0] }}" alt="Product Image">
+                                {% if product.image %}
+                                    <img src="{{ product.image }}" alt="Product Image">
                                 {% else %}
                                     <span>No Image Available</span>
                                 {% endif %}
                             </div>
                             <div class="card-body">
-                                <h6 class="card-title">{{ product.get('title', 'No Title') }}</h6>
-                                <p class="text-muted">{{ product.get('brand', 'Unknown') }}</p>
+                                <h6 class="card-title">{{ product.title }}</h6>
+                                <p class="text-muted">{{ product.brand }}</p>
                                 <p class="fw-bold">
-                                  {% if product.get('price', '').startswith('$') %}
-                                    {{ product['price'] }}
+                                  {% if product.price %}
+                                    {{ product.price }}
                                   {% endif %}
                                 </p>
                                 <a href="{{ url_for('product_detail', asin=product.asin) }}" class="btn btn-primary btn-sm">View Details</a>
@@ -245,11 +503,11 @@ def home():
             <nav class="mt-4">
                 <ul class="pagination justify-content-center">
                     {% if page > 1 %}
-                        <li class="page-item"><a class="page-link" href="{{ url_for('home', page=page-1) }}">Previous</a></li>
+                        <li class="page-item"><a class="page-link" href="{{ url_for('home', page=page-1, brand=brand, category=category) }}">Previous</a></li>
                     {% endif %}
                     <li class="page-item disabled"><a class="page-link">Page {{ page }} of {{ total_pages }}</a></li>
                     {% if page < total_pages %}
-                        <li class="page-item"><a class="page-link" href="{{ url_for('home', page=page+1) }}">Next</a></li>
+                        <li class="page-item"><a class="page-link" href="{{ url_for('home', page=page+1, brand=brand, category=category) }}">Next</a></li>
                     {% endif %}
                 </ul>
             </nav>
@@ -278,39 +536,34 @@ def home():
     </body>
     </html>
     """
-    return render_template_string(template, products=page_products, page=page, total_pages=total_pages)
 
-# Product detail page
-@app.route("/product/<asin>")
-def product_detail(asin):
-    product = next((p for p in products if p["asin"] == asin), None)
-    if not product:
-        return "Product not found", 404
+def home():
+    per_page = 40
+    page = request.args.get("page", 1, type=int)
+    brand = request.args.get("brand") or None
+    category = request.args.get("category") or None
+    app_serving = serving()
+    state = app_serving.state
+    key = ("home", page, brand, category)
+    if not_modified(state, key):
+        return not_modified_response(state, key, 'home')
+    cached = app_serving.cached_page(state, key)
+    if cached is not None:
+        return page_response(app_serving, state, key, cached, 'home')
+    page_products, total_pages = state.store.page(page, per_page, brand, category)
+
+    page_views = [state.listing_row(product) for product in page_products if 'asin' in product]
+    with RENDER_SECONDS.time(template="home"):
+        html = render_template(current_app.config['HOME_TEMPLATE'], products=page_views, page=page, total_pages=total_pages,
+                               brand=brand, category=category)
+    return page_response(app_serving, state, key, app_serving.store_page(state, key, html), 'home')
 
-    similarity_type = request.args.get("similarity", None)
-    similar_products = []
-    if similarity_type in ['pst', 'psd', 'pstd']:
-        field_map = {'pst': 'title', 'psd': 'description', 'pstd': 'hybrid'}
-        field = field_map[similarity_type]
-        shingles = asin_to_shingles[field].get(asin, set())
-        if shingles:
-            sig = asin_to_signature[field].get(asin, [])
-            candidates = lshs[field].query(sig)
-            scores = []
-            for cand in candidates:
-                if cand != asin:
-                    cand_shingles = asin_to_shingles[field].get(cand, set())
-                    if cand_shingles:  # Check if candidate shingles are non-empty
-                        jacc = jaccard_similarity(shingles, cand_shingles)
-                        scores.append((cand, jacc))
-            top_similar = sorted(scores, key=lambda x: -x[1])[:10]
-            similar_products = [(asin_to_product.get(cand, {}), score * 100) for cand, score in top_similar]
-
-    template = """
+# Product detail page
+PRODUCT_TEMPLATE = """
     <!doctype html>
     <html lang="en">
     <head>
-        <title>{{ product.get('title', 'No Title') }}</title>
+        <title>{{ product.title }}</title>
         <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css">
         <style>
             .image-box {
@@ -337,39 +590,39 @@ def product_detail(asin):
                 <div class="row">
                     <div class="col-md-5">
                         <div class="image-box">
-                            {% if product.get('imageURLHighRes') %}
-                                <img src="{{ product.imageURLHighRes[0] }}" class="img-fluid">
+                            {% if product.image %}
+                                <img src="{{ product.image }}" class="img-fluid">
                             {% else %}
                                 <span>No Image Available</span>
                             {% endif %}
                         </div>
                     </div>
                     <div class="col-md-7">
-                        <h3>{{ product.get('title', 'No Title') }}</h3>
-                        <p><strong>ASIN:</strong> {{ product.get('asin', 'N/A') }}</p>
-                        <p><strong>Brand:</strong> {{ product.get('brand', 'N/A') }}</p>
-                        <p><strong>Category:</strong> {{ product.get('category', []) | join(' > ') }}</p>
-                        <p><strong>Price:</strong> {% if product.get('price', '').startswith('$') %}
-                                    {{ product['price'] }}
+                        <h3>{{ product.title }}</h3>
+                        <p><strong>ASIN:</strong> {{ product.asin }}</p>
+                        <p><strong>Brand:</strong> {{ product.brand }}</p>
+                        <p><strong>Category:</strong> {{ product.category }}</p>
+                        <p><strong>Price:</strong> {% if product.price %}
+                                    {{ product.price }}
                                   {% else %}
                                     $
                                   {% endif %} </p>
-                        <p><strong>Date:</strong> {{ product.get('date', 'N/A') }}</p>
+                        <p><strong>Date:</strong> {{ product.date }}</p>
 
                         <h5>Features:</h5>
                         <ul>
-                            {% for f in product.get('feature', []) %}
+                            {% for f in product.features %}
                                 <li>{{ f }}</li>
                             {% endfor %}
                         </ul>
 
                         <h5>Description:</h5>
-                        <p>{{ product.get('description', []) | join(' ') }}</p>
+                        <p>{{ product.description }}</p>
 
 
                         <h5>Other Details:</h5>
                         <ul>
-                        {% for key, value in product.items() if key in ['also_buy','also_view'] %}
+                        {% for key, value in product.details %}
                             <li><strong>{{ key }}:</strong> {{ value }}</li>
                         {% endfor %}
                         </ul>
@@ -387,19 +640,20 @@ def product_detail(asin):
 
             {% if similar_products %}
                 <h5>Top 10 Similar Products</h5>
+                <p class="text-muted small">Scoring: {{ scoring }}</p>
                 <div class="row g-4">
                     {% for sim_product, similarity_score in similar_products %}
                         <div class="col-md-3">
                             <div class="card h-100 shadow-sm similar-card">
                                 <div class="image-box">
-                                    {% if sim_product.get('imageURLHighRes') %}
-                                        <img src="{{ sim_product.imageURLHighRes[0] }}" alt="Product Image">
+                                    {% if sim_product.image %}
+                                        <img src="{{ sim_product.image }}" alt="Product Image">
                                     {% else %}
                                         <span>No Image</span>
                                     {% endif %}
                                 </div>
                                 <div class="card-body">
-                                    <h6 class="card-title">{{ sim_product.get('title', 'No Title')[:50] }}...</h6>
+                                    <h6 class="card-title">{{ sim_product.short_title }}...</h6>
                                     <p class="text-muted">Similarity: {{ '%.2f' % similarity_score }}%</p>
                                     <a href="{{ url_for('product_detail', asin=sim_product.asin) }}" class="btn btn-primary btn-sm">View Details</a>
                                 </div>
@@ -407,24 +661,193 @@ def product_detail(asin):
                         </div>
                     {% endfor %}
                 </div>
+            {% elif similarity_pending %}
+                <p class="text-muted">Similar products are still being indexed, try again in a moment.</p>
             {% endif %}
         </div>
     </body>
     </html>
     """
-    return render_template_string(template, product=product, similar_products=similar_products)
 
-# Search API (AJAX endpoint)
-@app.route("/search")
-def search():
-    query = request.args.get("query", "").lower()
-    results = []
-    if query:
-        for p in products:
-            title = p.get("title", "")
-            if query in title.lower():
-                results.append({"asin": p.get("asin"), "title": title})
-    return jsonify(results[:10])  # return top 10 matches
+def product_detail(asin):
+    app_serving = serving()
+    state = app_serving.state
+    product = state.detail_views.get(asin)
+    if not product:
+        return "Product not found", 404
 
+    similarity_type = request.args.get("similarity", None)
+    scoring = request.args.get("scoring", "exact")
+    if scoring not in SCORING_MODES:
+        scoring = "exact"
+    page_key = ("product", asin, similarity_type if similarity_type in field_map else None, scoring)
+    if not_modified(state, page_key):
+        return not_modified_response(state, page_key, 'product')
+    cached = app_serving.cached_page(state, page_key)
+    if cached is not None:
+        return page_response(app_serving, state, page_key, cached, 'product')
+    similar_products, similarity_pending = [], False
+    if similarity_type in field_map:
+        field = field_map[similarity_type]
+        try:
+            # Exact scores are served from the precomputed neighbor table
+            top_similar = app_serving.similar(state, field, [asin], 10, scoring).get(asin, [])
+        except IndexNotReady:
+            # Still warming up: the page without similar products, not cached
+            top_similar, similarity_pending = [], True
+        similar_products = [(state.listing_views[cand], score * 100) for cand, score in top_similar if cand in state.listing_views]
+
+    with RENDER_SECONDS.time(template="product"):
+        html = render_template(current_app.config['PRODUCT_TEMPLATE'], product=product, similar_products=similar_products,
+                               scoring=scoring, similarity_pending=similarity_pending)
+    if similarity_pending:
+        return html, 200, {"Cache-Control": "no-store"}
+    return page_response(app_serving, state, page_key, app_serving.store_page(state, page_key, html), 'product')
+
+# Search API (AJAX endpoint); the typeahead repeats queries, so results are
+# cached like pages, in the search cache
+def search():
+    query = request.args.get("query", "")
+    app_serving = serving()
+    state = app_serving.state
+    key = ("search", query)
+    if not_modified(state, key):
+        return not_modified_response(state, key, 'search')
+    cached = app_serving.cached_page(state, key)
+    if cached is None:
+        results = state.search_index.search(query, 10)  # return top 10 matches
+        cached = app_serving.store_page(state, key, json.dumps(results), "application/json")
+    return page_response(app_serving, state, key, cached, 'search')
+
+# Batch similarity API (JSON): POST {"asins": [...], "field": "title", "k": 10, "scoring": "exact"}.
+# field is title, description or hybrid (or pst, psd, pstd); scoring is exact,
+# minhash or rerank; scores are (estimated) Jaccard in [0, 1]. For hybrid,
+# "weights": {"title": 0.7, "description": 0.3} overrides the default weights
+# of the two fields. One request queues at most MAX_BATCH_ASINS queries of at
+# most MAX_K neighbors for scoring.
+MAX_BATCH_ASINS = 1000
+MAX_K = 100
+
+def similar_batch():
+    app_serving = serving()
+    state = app_serving.state
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        payload = {}
+    field = payload.get("field")
+    field = field_map.get(field, field) if isinstance(field, str) else None
+    asins = payload.get("asins")
+    k = payload.get("k", 10)
+    scoring = payload.get("scoring", "exact")
+    weights = payload.get("weights")
+    if field not in FIELDS + [HYBRID] or not isinstance(asins, list) or len(asins) > MAX_BATCH_ASINS \
+            or not all(isinstance(asin, str) for asin in asins) \
+            or not isinstance(k, int) or isinstance(k, bool) or not 1 <= k <= MAX_K \
+            or scoring not in SCORING_MODES or not (weights is None or field == HYBRID and valid_weights(weights)):
+        return jsonify({"error": "expected {\"asins\": [...], \"field\": \"title|description|hybrid\", \"k\": 10, \"scoring\": \"exact|minhash|rerank\", "
+                                 "\"weights\": {\"title\": 0.5, \"description\": 0.5} (hybrid only)}, "
+                                 "with at most %d asins and k at most %d" % (MAX_BATCH_ASINS, MAX_K)}), 400
+
+    # Raises IndexNotReady (503) while the field's index warms up
+    results = app_serving.similar(state, field, asins, k, scoring, weights)
+    return jsonify({
+        "field": field,
+        "k": k,
+        "scoring": scoring,
+        "results": {asin: [{"asin": cand, "score": score} for cand, score in neighbors]
+                    for asin, neighbors in results.items()},
+        "not_found": [asin for asin in asins if asin not in results],
+    })
+
+def valid_weights(weights):
+    return isinstance(weights, dict) and any(weights.values()) and all(
+        field in FIELDS and isinstance(weight, (int, float)) and not isinstance(weight, bool) and weight >= 0
+        for field, weight in weights.items())
+
+def scoring_busy(error):
+    return jsonify({"error": "similarity scoring is taking too long, retry shortly"}), 503, {"Retry-After": "1"}
+
+def index_not_ready(error):
+    return jsonify({"error": "the similarity index is still warming up", "readiness": serving().readiness()}), 503, \
+        {"Retry-After": "5"}
+
+# Liveness: the process is up and serving requests
+def health():
+    return jsonify({"status": "ok"})
+
+# Readiness: 200 once every field's index is loaded, 503 before, with each
+# field's build phase and progress
+def ready():
+    readiness = serving().readiness()
+    return jsonify(readiness), 200 if readiness['ready'] else 503
+
+# Catalog deltas
+#
+# POST /api/catalog/delta with a JSON-lines body (see catalog.parse_delta)
+# applies product upserts and deletes to the running process. The LSH indexes
+# are updated incrementally and a new ServingState is published once per
+# batch. The endpoint is disabled unless CATALOG_DELTA_TOKEN is set, and
+# callers send that token in X-Delta-Token. Changes are kept in memory only:
+# the next start loads the index of the catalog file on disk.
+def catalog_delta():
+    token = os.environ.get("CATALOG_DELTA_TOKEN")
+    if not token or not hmac.compare_digest(request.headers.get("X-Delta-Token", ""), token):
+        return jsonify({"error": "catalog deltas are disabled or the token is wrong"}), 403
+    try:
+        # The body is parsed line by line as it is read
+        return jsonify(serving().apply_delta(request.stream))
+    except ValueError as e:
+        # Batches before the bad line stay applied
+        return jsonify({"error": str(e)}), 400
+
+# Cache counters (hits, misses, evictions, invalidations) and sizes
+def cache_stats():
+    app_serving = serving()
+    return jsonify({"index_version": app_serving.state.version, "results": app_serving.result_cache.stats(),
+                    "pages": app_serving.page_cache.stats() if app_serving.page_cache is not None else None,
+                    "search": app_serving.search_cache.stats() if app_serving.search_cache is not None else None})
+
+# Build the app: load the catalog (only the fields the pages show) and start
+# loading the index snapshot for it, building the snapshot on first start. With
+# background=False the indexes are loaded before returning.
+def create_app(catalog_path="meta_Appliances.json", snapshot_dir="index_snapshot", scoring_workers=4, scoring_timeout=10.0,
+               page_cache=True, background=True):
+    app = Flask(__name__)
+    products = load_catalog(catalog_path, DETAIL_FIELDS)
+    stat = os.stat(catalog_path)
+    state = ServingState(products, {}, catalog_version='%d-%d' % (stat.st_size, stat.st_mtime_ns), modified=stat.st_mtime)
+    app_serving = Serving(state, scoring_workers, scoring_timeout, page_cache)
+    app.extensions['serving'] = app_serving
+    if background:
+        # Forking build workers from a process that is already serving on
+        # other threads could deadlock them on a lock held at the fork, so
+        # the background build runs in this process
+        threading.Thread(target=app_serving.warm_up, args=(catalog_path, snapshot_dir, 1), name='index-warmup',
+                         daemon=True).start()
+    else:
+        app_serving.warm_up(catalog_path, snapshot_dir)
+
+    # Templates are compiled once instead of on every render_template_string call
+    app.config['HOME_TEMPLATE'] = app.jinja_env.from_string(HOME_TEMPLATE)
+    app.config['PRODUCT_TEMPLATE'] = app.jinja_env.from_string(PRODUCT_TEMPLATE)
+    app.config['PROFILE_REQUESTS'] = os.environ.get("PROFILE_REQUESTS") == "1"
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.register_error_handler(ScoringTimeout, scoring_busy)
+    app.register_error_handler(IndexNotReady, index_not_ready)
+    app.add_url_rule("/", "home", home)
+    app.add_url_rule("/product/<asin>", "product_detail", product_detail)
+    app.add_url_rule("/search", "search", search)
+    app.add_url_rule("/api/similar", "similar_batch", similar_batch, methods=["POST"])
+    app.add_url_rule("/api/catalog/delta", "catalog_delta", catalog_delta, methods=["POST"])
+    app.add_url_rule("/api/cache", "cache_stats", cache_stats)
+    app.add_url_rule("/metrics", "metrics", metrics)
+    app.add_url_rule("/health", "health", health)
+    app.add_url_rule("/ready", "ready", ready)
+    register_metrics(app_serving)
+    return app
+
+# Development server; see wsgi.py for serving with several worker processes
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True, threaded=True)
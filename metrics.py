@@ -0,0 +1,194 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# In-process metrics, rendered in the Prometheus text format by
+# Registry.render(). Every metric has a fixed list of label names; values are
+# kept per combination of label values. Metrics created with collect are
+# computed when they are rendered: collect returns (label values, value) pairs.
+# Each process keeps its own values, so with several worker processes every one
+# of them is scraped separately.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+def escape_label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = ['%s="%s"' % (name, escape_label(value)) for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{%s}' % ','.join(parts) if parts else ''
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 collect: Optional[Callable[[], Iterable[Tuple[Tuple, float]]]] = None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> Iterator[Tuple[str, Tuple, float]]:
+        values = list(self.collect()) if self.collect is not None else list(self.values.items())
+        for key, value in values:
+            yield self.name, tuple(key), value
+
+    def render(self) -> List[str]:
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for name, key, value in self.samples():
+            lines.append('%s%s %s' % (name, format_labels(self.labels, key), repr(float(value))))
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    # Set the gauge to the duration of the block, in seconds
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.set(time.perf_counter() - start, **labels)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = np.array(sorted(buckets), dtype=np.float64)
+
+    def observe(self, value: float, **labels):
+        self.observe_many(np.array([value], dtype=np.float64), **labels)
+
+    # Record every value of an array at once
+    def observe_many(self, values: np.ndarray, **labels):
+        if not len(values):
+            return
+        counts = np.bincount(np.searchsorted(self.buckets, values, side='left'), minlength=len(self.buckets) + 1)
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [np.zeros(len(self.buckets) + 1, dtype=np.int64), 0.0]
+            entry[0] += counts
+            entry[1] += float(np.sum(values))
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            values = [(key, counts.copy(), total) for key, (counts, total) in self.values.items()]
+        for key, counts, total in values:
+            cumulative = np.cumsum(counts)
+            for bound, count in zip(self.buckets.tolist() + ['+Inf'], cumulative.tolist()):
+                le = 'le="%s"' % (bound if bound == '+Inf' else repr(float(bound)))
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels, key, le), count))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(self.labels, key), repr(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, key), cumulative[-1]))
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    # Metrics that keep values are shared by everyone registering the name; a
+    # metric computed by collect replaces the earlier one (e.g. of a previous
+    # app instance)
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            if metric.collect is not None:
+                self.metrics[metric.name] = metric
+                return metric
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = (), collect=None) -> Counter:
+        return self.register(Counter(name, help, labels, collect))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = (), collect=None) -> Gauge:
+        return self.register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+REGISTRY = Registry()
+
+# Resident memory of this process, from /proc where available
+def resident_memory_bytes() -> Iterable[Tuple[Tuple, float]]:
+    try:
+        with open('/proc/self/statm') as f:
+            return [((), int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE'))]
+    except (OSError, ValueError, IndexError):
+        return []
+
+REGISTRY.gauge('process_resident_memory_bytes', 'Resident memory size in bytes.', collect=resident_memory_bytes)
+
+# Statistical profiler for one thread: a background thread records the stack of
+# the profiled thread every interval seconds. stop() returns the samples as
+# collapsed stacks ("outer;...;inner count" per line), the input format of
+# flamegraph.pl and speedscope.
+class SamplingProfiler:
+    def __init__(self, thread_id: int, interval: float = 0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = StackCounter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self) -> str:
+        self.stopped.set()
+        self.thread.join()
+        return ''.join('%s %d\n' % (stack, count) for stack, count in self.samples.most_common())
@@ -0,0 +1,1516 @@
+import os
+import re
+import json
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import zlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Callable, List, Set, Dict, Tuple, Optional
+
+import numpy as np
+
+from catalog import load_catalog, read_delta, read_chunks, parse_chunk, INDEX_FIELDS
+from metrics import REGISTRY, COUNT_BUCKETS
+
+BUILD_PHASE_SECONDS = REGISTRY.gauge('index_build_phase_seconds', 'Duration of the last run of each index build phase.', ['phase'])
+STAGE_SECONDS = REGISTRY.histogram('similarity_stage_seconds', 'Time per stage of similarity batches (online queries or neighbor table builds).',
+                                   ['mode', 'stage'])
+CANDIDATES_PER_QUERY = REGISTRY.histogram('lsh_candidates_per_query', 'LSH candidates scored per queried product.', ['mode'], COUNT_BUCKETS)
+
+# Data cleaning
+def clean_text(text: str) -> str:
+    # Remove HTML tags
+    text = re.sub(r'<[^<]+?>', '', text)
+    # Remove extra whitespace
+    text = re.sub(r'\s+', ' ', text).strip()
+    # Lowercase
+    return text.lower()
+
+def get_product_text(product: Dict, field: str) -> str:
+    if field == 'title':
+        return clean_text(product.get('title', ''))
+    elif field == 'description':
+        desc = product.get('description', [])
+        if isinstance(desc, list):
+            return ' '.join(clean_text(d) for d in desc)
+        else:
+            return clean_text(desc)
+    elif field == 'hybrid':
+        title = get_product_text(product, 'title')
+        desc = get_product_text(product, 'description')
+        return title + ' ' + desc
+    return ''
+
+# Shingling
+#
+# A shingle is encoded as a 32-bit hash of its k code points: a polynomial
+# rolling hash over the whole text at once, finished with a 64-to-32-bit mix.
+# The id of a shingle depends only on its characters, never on the rest of the
+# catalog or on the process, so products whose text did not change keep their
+# signatures across rebuilds. Ids are below 2**32 as MinHash requires.
+_SHINGLE_PRIME = np.uint64(0x100000001b3)
+_SHINGLE_MIX = np.uint64(0xff51afd7ed558ccd)
+_SHIFT32, _SHIFT33 = np.uint64(32), np.uint64(33)
+
+# Sorted distinct shingle ids of text
+def get_shingle_ids(text: str, k: int = 3) -> np.ndarray:
+    if not text or text.isspace():  # Check for empty string or only spaces
+        return np.empty(0, dtype=np.uint32)
+    code_points = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    k = min(k, len(code_points))  # a text shorter than k is a single shingle
+    count = len(code_points) - k + 1
+    h = np.zeros(count, dtype=np.uint64)
+    for j in range(k):
+        h *= _SHINGLE_PRIME
+        h += code_points[j:j + count]
+    h ^= h >> _SHIFT33
+    h *= _SHINGLE_MIX
+    h ^= h >> _SHIFT33
+    return np.unique((h >> _SHIFT32).astype(np.uint32))
+
+# MinHash
+class MinHash:
+    def __init__(self, n_hashes: int = 100, seed: int = 42):
+        random.seed(seed)
+        self.n_hashes = n_hashes
+        self.a = [random.randint(1, 2**32 - 1) for _ in range(n_hashes)]
+        self.b = [random.randint(0, 2**32 - 1) for _ in range(n_hashes)]
+        self.prime = 2**61 - 1  # Large Mersenne prime
+        # uint64 copies for the vectorized path. a * r + b stays below 2**64 for any
+        # row index r < 2**32, so the modular arithmetic below is exact.
+        self.a_arr = np.array(self.a, dtype=np.uint64)
+        self.b_arr = np.array(self.b, dtype=np.uint64)
+
+    def compute_hi(self, r: int) -> List[int]:
+        return [(self.a[i] * r + self.b[i]) % self.prime for i in range(self.n_hashes)]
+
+    def compute_hi_matrix(self, rows: np.ndarray) -> np.ndarray:
+        # h_i(r) for every row in rows and every hash function: shape (len(rows), n_hashes)
+        r = rows.astype(np.uint64)[:, None]
+        return (r * self.a_arr + self.b_arr) % np.uint64(self.prime)
+
+    def signatures(self, indptr: np.ndarray, indices: np.ndarray, chunk_nnz: int = 1 << 16) -> np.ndarray:
+        # Signature matrix (num_columns, n_hashes) from a CSR shingle-by-document incidence:
+        # the rows of column c are indices[indptr[c]:indptr[c+1]]. Columns without any
+        # shingle keep prime + 1, same as the initial value of the row-major algorithm.
+        num_columns = len(indptr) - 1
+        M = np.full((num_columns, self.n_hashes), self.prime + 1, dtype=np.uint64)
+        start = 0
+        while start < num_columns:
+            # Take as many columns as fit in chunk_nnz (at least one) to bound memory
+            end = int(np.searchsorted(indptr, indptr[start] + chunk_nnz, side='right')) - 1
+            end = min(max(end, start + 1), num_columns)
+            lengths = np.diff(indptr[start:end + 1])
+            nonempty = np.flatnonzero(lengths)
+            if len(nonempty):
+                h_values = self.compute_hi_matrix(indices[indptr[start]:indptr[end]])
+                offsets = indptr[start:end][nonempty] - indptr[start]
+                M[start + nonempty] = np.minimum.reduceat(h_values, offsets, axis=0)
+            start = end
+        return M
+
+# Deterministic 64-bit key of every band of every signature: shape (n, bands).
+# Each row is multiplied by its own odd constant, the products are XOR-folded
+# and passed through the splitmix64 finalizer. The top 6 bits hold the band
+# index, so keys sorted as one array fall into contiguous per-band runs and all
+# bands can be looked up with one searchsorted. Only the first bands * rows
+# hash values of a signature are used.
+_MIX1, _MIX2 = np.uint64(0xbf58476d1ce4e5b9), np.uint64(0x94d049bb133111eb)
+_SHIFT6, _SHIFT27, _SHIFT30, _SHIFT31 = np.uint64(6), np.uint64(27), np.uint64(30), np.uint64(31)
+
+@lru_cache(maxsize=None)
+def _band_constants(bands: int, rows: int) -> Tuple[np.ndarray, np.ndarray]:
+    assert bands <= 64
+    multipliers = np.array([((j + 1) * 0x9E3779B97F4A7C15 | 1) % 2**64 for j in range(rows)], dtype=np.uint64)
+    tags = np.arange(bands, dtype=np.uint64) << np.uint64(58)
+    return multipliers, tags
+
+def band_hashes(signatures: np.ndarray, bands: int, rows: int) -> np.ndarray:
+    multipliers, tags = _band_constants(bands, rows)
+    sig = np.asarray(signatures, dtype=np.uint64)[..., :bands * rows].reshape(-1, bands, rows)
+    h = np.bitwise_xor.reduce(sig * multipliers, axis=2)
+    h ^= h >> _SHIFT30
+    h *= _MIX1
+    h ^= h >> _SHIFT27
+    h *= _MIX2
+    h ^= h >> _SHIFT31
+    return (h >> _SHIFT6) | tags
+
+# LSH
+#
+# Buckets are stored in CSR form over integer column ids. Band b owns the sorted
+# bucket keys keys[band_ptr[b]:band_ptr[b+1]] (the band index is part of the
+# key, so self.keys is sorted as a whole); bucket i holds the columns
+# postings[offsets[i]:offsets[i+1]], in ascending order.
+#
+# Queries can be bounded for hot buckets (generic descriptions that thousands of
+# products share). max_bucket caps the postings taken from any one bucket (a
+# single cap or one per band): an oversized bucket contributes an evenly spaced
+# sample of max_bucket columns, each collision weighted max_bucket / size.
+# max_candidates then keeps, per query, the columns with the most (weighted)
+# band collisions, the query's own column included. Both default to None, which
+# returns every colliding column.
+class LSH:
+    def __init__(self, n_hashes: int, bands: int, rows: int):
+        assert bands * rows <= n_hashes
+        self.bands = bands
+        self.rows = rows
+        self.max_bucket = None
+        self.max_candidates = None
+        self.band_ptr = np.zeros(bands + 1, dtype=np.int64)
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.postings = np.empty(0, dtype=np.int32)
+
+    # cols, if given, are the (ascending) column ids of the signatures; by
+    # default they are columns 0 to n - 1
+    def build(self, signatures: np.ndarray, cols: Optional[np.ndarray] = None):
+        self.build_from_blocks([self.sort_block(signatures, cols=cols)])
+
+    # Band keys of a block of signatures whose first column is offset (or whose
+    # columns are cols, ascending), sorted per band, and the columns in that
+    # order: shape (n, bands) each. Blocks can be sorted by separate workers
+    # and combined with build_from_blocks.
+    def sort_block(self, signatures: np.ndarray, offset: int = 0, cols: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        hashes = band_hashes(signatures, self.bands, self.rows)
+        # Stable sort keeps the columns of each bucket in ascending order
+        order = np.argsort(hashes, axis=0, kind='stable')
+        columns = order + offset if cols is None else np.asarray(cols)[order]
+        return np.take_along_axis(hashes, order, axis=0), columns.astype(np.int32)
+
+    # The entries of a sorted block (see sort_block) whose column is in keep, a
+    # boolean mask over column ids
+    @staticmethod
+    def filter_block(block: Tuple[np.ndarray, np.ndarray], keep: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        block_keys, block_cols = block
+        mask = keep[block_cols].T
+        count = int(mask[0].sum())
+        return block_keys.T[mask].reshape(len(mask), count).T, block_cols.T[mask].reshape(len(mask), count).T
+
+    # Build the buckets from sorted blocks covering consecutive column ranges, in
+    # column order. The stable sort of the concatenated blocks is a merge of
+    # already sorted runs and ties keep ascending columns, so the result is the
+    # same however the columns were split into blocks.
+    def build_from_blocks(self, blocks: List[Tuple[np.ndarray, np.ndarray]]):
+        n = sum(len(block_keys) for block_keys, _ in blocks)
+        keys, offsets, postings = [], [], []
+        for band_idx in range(self.bands):
+            band_keys = np.concatenate([block_keys[:, band_idx] for block_keys, _ in blocks])
+            band_cols = np.concatenate([block_cols[:, band_idx] for _, block_cols in blocks])
+            if len(blocks) > 1:
+                order = np.argsort(band_keys, kind='stable')
+                band_keys, band_cols = band_keys[order], band_cols[order]
+            starts = np.flatnonzero(np.r_[True, band_keys[1:] != band_keys[:-1]]) if n else np.empty(0, dtype=np.int64)
+            keys.append(band_keys[starts])
+            offsets.append(starts + band_idx * n)
+            postings.append(band_cols)
+            self.band_ptr[band_idx + 1] = self.band_ptr[band_idx] + len(starts)
+        # int32 offsets halve their size whenever the postings allow it
+        offset_dtype = np.int32 if self.bands * n < 2**31 else np.int64
+        self.keys = np.concatenate(keys)
+        self.offsets = np.concatenate(offsets + [[self.bands * n]]).astype(offset_dtype)
+        self.postings = np.concatenate(postings).astype(np.int32)
+
+    # Buckets after the columns changed, without rehashing the unchanged ones:
+    # old column c becomes column old_to_new[c] (-1 drops it) and the columns
+    # cols are (re)inserted with the given signatures. Returns a new LSH, equal
+    # to one built from scratch over the new columns; self is left untouched.
+    def updated(self, old_to_new: np.ndarray, signatures: np.ndarray, cols: np.ndarray) -> 'LSH':
+        keys = np.repeat(self.keys, np.diff(self.offsets))
+        postings = old_to_new[self.postings]
+        kept = postings >= 0
+        keys = np.concatenate([keys[kept], band_hashes(signatures, self.bands, self.rows).ravel()])
+        postings = np.concatenate([postings[kept], np.repeat(cols, self.bands)]).astype(np.int32)
+        order = np.lexsort((postings, keys))
+        keys, postings = keys[order], postings[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.empty(0, dtype=np.int64)
+        lsh = LSH(self.bands * self.rows, self.bands, self.rows)
+        lsh.keys = keys[starts]
+        lsh.band_ptr = np.r_[np.searchsorted(lsh.keys, np.arange(self.bands, dtype=np.uint64) << np.uint64(58)),
+                             len(lsh.keys)].astype(np.int64)
+        lsh.offsets = np.r_[starts, len(keys)].astype(np.int32 if len(keys) < 2**31 else np.int64)
+        lsh.postings = postings
+        lsh.max_bucket, lsh.max_candidates = self.max_bucket, self.max_candidates
+        return lsh
+
+    # Summary of the bucket sizes, overall and per band, and how many buckets
+    # and postings exceed max_bucket
+    def bucket_stats(self, chunk: int = 1 << 22) -> Dict:
+        # Bucket sizes are read chunk buckets at a time into a histogram of
+        # sizes, which the percentiles are taken from (linear interpolation,
+        # as np.percentile)
+        buckets = len(self.offsets) - 1
+        if not buckets:
+            return {'buckets': 0, 'postings': 0}
+        caps = np.broadcast_to(np.asarray(self.max_bucket if self.max_bucket is not None else -1), (self.bands,))
+        histogram, band_max = np.zeros(1, dtype=np.int64), []
+        oversized = oversized_postings = 0
+        for band_idx in range(self.bands):
+            top = 0
+            for start in range(int(self.band_ptr[band_idx]), int(self.band_ptr[band_idx + 1]), chunk):
+                sizes = np.diff(np.asarray(self.offsets[start:min(start + chunk, self.band_ptr[band_idx + 1]) + 1], dtype=np.int64))
+                counts = np.bincount(sizes)
+                if len(counts) > len(histogram):
+                    histogram = np.r_[histogram, np.zeros(len(counts) - len(histogram), dtype=np.int64)]
+                histogram[:len(counts)] += counts
+                top = max(top, int(sizes.max()))
+                if self.max_bucket is not None:
+                    over = sizes[sizes > caps[band_idx]]
+                    oversized, oversized_postings = oversized + len(over), oversized_postings + int(over.sum())
+            band_max.append(top)
+        cumulative = np.cumsum(histogram)
+
+        def percentile(q: float) -> float:
+            position = (buckets - 1) * (q / 100)
+            below = int(np.floor(position))
+            low, high = np.searchsorted(cumulative, [below, min(below + 1, buckets - 1)], side='right')
+            t, d = position - below, float(high - low)
+            return float(high - d * (1 - t) if t >= 0.5 else low + d * t)
+
+        stats = {'buckets': buckets, 'postings': int(self.offsets[-1] - self.offsets[0]), 'max': int(len(histogram) - 1),
+                 'p50': percentile(50), 'p99': percentile(99), 'p999': percentile(99.9), 'band_max': band_max}
+        if self.max_bucket is not None:
+            stats.update(oversized=oversized, oversized_postings=oversized_postings)
+        return stats
+
+    # Bucket numbers (positions in self.keys) for every band of every signature;
+    # -1 where the band has no bucket with that key. Shape (n, bands).
+    def lookup(self, signatures: np.ndarray) -> np.ndarray:
+        keys = band_hashes(signatures, self.bands, self.rows)
+        if not len(self.keys):
+            return np.full(keys.shape, -1, dtype=np.int64)
+        i = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[i] == keys, i, -1)
+
+    # Postings of every bucket the signature falls into, one per matching band.
+    # These are views into self.postings, nothing is copied.
+    def query_buckets(self, signature: np.ndarray) -> List[np.ndarray]:
+        offsets = self.offsets
+        return [self.postings[offsets[i]:offsets[i + 1]] for i in self.lookup(signature)[0].tolist() if i >= 0]
+
+    # Sorted, distinct column ids of all items sharing at least one band
+    # (within the limits of max_bucket and max_candidates)
+    def query(self, signature: np.ndarray) -> np.ndarray:
+        if self.max_bucket is not None or self.max_candidates is not None:
+            return self.query_pairs(np.asarray(signature).reshape(1, -1))[1].astype(np.int32)
+        matched = self.query_buckets(signature)
+        if not matched:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate(matched))
+
+    # Distinct (query, column) candidate pairs for a batch of signatures, sorted by
+    # query then column; query is the row number in signatures. With capped
+    # False, max_bucket and max_candidates are ignored.
+    def query_pairs(self, signatures: np.ndarray, capped: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        if capped and (self.max_bucket is not None or self.max_candidates is not None):
+            return self.query_votes(signatures)[:2]
+        buckets = self.lookup(signatures)
+        query, band = np.nonzero(buckets >= 0)
+        bucket = buckets[query, band]
+        starts, ends = self.offsets[bucket], self.offsets[bucket + 1]
+        # Pairs are encoded as query * n + column; columns are int32
+        n = 1 << 31
+        positions, owner = expand_ranges(starts, ends)
+        pairs = np.unique(query[owner].astype(np.int64) * n + self.postings[positions])
+        return pairs // n, pairs % n
+
+    # query_pairs with the (weighted) band collisions of each pair, the ranking
+    # used by max_candidates
+    def query_votes(self, signatures: np.ndarray, capped: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        buckets = self.lookup(signatures)
+        query, band = np.nonzero(buckets >= 0)
+        bucket = buckets[query, band]
+        starts, ends = self.offsets[bucket], self.offsets[bucket + 1]
+        # Pairs are encoded as query * n + column; columns are int32
+        n = 1 << 31
+        sizes = (ends - starts).astype(np.int64)
+        taken = sizes
+        if capped and self.max_bucket is not None:
+            taken = np.minimum(sizes, np.broadcast_to(np.asarray(self.max_bucket), (self.bands,))[band])
+        local, owner = expand_ranges(np.zeros_like(taken), taken)
+        positions = starts[owner] + local * sizes[owner] // taken[owner]
+        pairs, inverse = np.unique(query[owner].astype(np.int64) * n + self.postings[positions], return_inverse=True)
+        votes = np.bincount(inverse.ravel(), weights=(taken / np.maximum(sizes, 1))[owner], minlength=len(pairs))
+        pair_query, pair_col = pairs // n, pairs % n
+        if capped and self.max_candidates is not None:
+            order = np.lexsort((pair_col, -votes, pair_query))
+            keep = np.sort(order[rank_in_group(pair_query[order]) < self.max_candidates])
+            pair_query, pair_col, votes = pair_query[keep], pair_col[keep], votes[keep]
+        return pair_query, pair_col, votes
+
+    @classmethod
+    def from_arrays(cls, rows: int, band_ptr: np.ndarray, keys: np.ndarray, offsets: np.ndarray, postings: np.ndarray) -> 'LSH':
+        bands = len(band_ptr) - 1
+        lsh = cls(bands * rows, bands, rows)
+        lsh.band_ptr, lsh.keys, lsh.offsets, lsh.postings = band_ptr, keys, offsets, postings
+        return lsh
+
+# Concatenation of the index ranges [starts[i], ends[i]) and, for every
+# position, the i it came from
+def expand_ranges(starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    lengths = (ends - starts).astype(np.int64)
+    owner = np.repeat(np.arange(len(lengths)), lengths)
+    first = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum(), dtype=np.int64) - first[owner] + starts[owner], owner
+
+# Jaccard Similarity of two sorted arrays of distinct shingle ids
+def jaccard_similarity(shingles1: np.ndarray, shingles2: np.ndarray) -> float:
+    if not len(shingles1) or not len(shingles2):
+        return 0.0
+    intersection = len(np.intersect1d(shingles1, shingles2, assume_unique=True))
+    union = len(shingles1) + len(shingles2) - intersection
+    return intersection / union
+
+# Indexed fields. The hybrid similarity is computed from these at query time
+# (see hybrid_similar) and has no index of its own.
+FIELDS = ['title', 'description']
+
+# Everything needed to answer similarity queries for one field. Columns are
+# asins; shingles are kept as the CSR incidence (sorted shingle ids per column)
+# instead of per-asin Python sets. version identifies the index contents (the
+# snapshot key when loaded from a snapshot, a random token otherwise), so
+# caches of query results can tell when the index was rebuilt or reloaded.
+# params are the build parameters (k, n_hashes, bands, rows, seed), needed to
+# shingle and sign products added later.
+#
+# Products whose cleaned text is identical form a duplicate group (see
+# content_hash): content_hashes holds the hash of each column's text and
+# representatives the first column of each column's group. Only
+# representatives are in the buckets, so a group is found, scored and listed
+# once, as its representative, and a product's own group is never among its
+# neighbors.
+class FieldIndex:
+    def __init__(self, asins: np.ndarray, indptr: np.ndarray, indices: np.ndarray, signatures: np.ndarray, lsh: LSH,
+                 neighbors: Optional['NeighborTable'] = None, version: Optional[str] = None, params: Optional[Dict] = None,
+                 content_hashes: Optional[np.ndarray] = None, representatives: Optional[np.ndarray] = None):
+        self.asins = asins
+        self.content_hashes = content_hashes
+        self.representatives = representatives if representatives is not None else group_representatives(content_hashes)
+        self.version = version or os.urandom(8).hex()
+        self.params = params
+        self.asin_to_index = {asin: c for c, asin in enumerate(asins.tolist())}
+        self.indptr = indptr
+        self.indices = indices
+        self.signatures = signatures
+        self.lsh = lsh
+        self.neighbors = neighbors
+        self.members = None
+
+    # Columns of the duplicate groups of the representatives reps, as
+    # (position in reps, column) pairs, representatives first; with limit, at
+    # most limit columns of each group, spread evenly over it. With queries
+    # (the query of each of reps, in runs) and max_total, at most max_total
+    # columns per query, taken from its groups in the order of reps.
+    def group_members(self, reps: np.ndarray, limit: Optional[int] = None, queries: Optional[np.ndarray] = None,
+                      max_total: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        if self.members is None:
+            order = np.argsort(self.representatives, kind='stable')
+            self.members = (np.asarray(self.representatives)[order], order)
+        sorted_reps, order = self.members
+        starts, ends = np.searchsorted(sorted_reps, reps), np.searchsorted(sorted_reps, reps, side='right')
+        sizes = ends - starts
+        taken = sizes if limit is None else np.minimum(sizes, limit)
+        if max_total is not None and len(taken):
+            # Columns already taken for the same query before each group
+            before = np.cumsum(taken) - taken
+            first = np.r_[0, np.flatnonzero(np.diff(queries)) + 1]
+            before -= np.repeat(before[first], np.diff(np.r_[first, len(taken)]))
+            taken = np.clip(max_total - before, 0, taken)
+        local, owner = expand_ranges(np.zeros_like(taken), taken)
+        return owner, order[starts[owner] + local * sizes[owner] // taken[owner]]
+
+    def shingles(self, asin: str) -> np.ndarray:
+        c = self.asin_to_index.get(asin)
+        if c is None:
+            return np.empty(0, dtype=np.uint32)
+        return self.indices[self.indptr[c]:self.indptr[c + 1]]
+
+    def signature(self, asin: str) -> np.ndarray:
+        c = self.asin_to_index.get(asin)
+        if c is None:
+            return np.empty(0, dtype=np.uint64)
+        return self.signatures[c]
+
+# Shingle-by-document incidence in CSR form: column c (an asin) has a 1 in
+# rows indices[indptr[c]:indptr[c+1]], which are its sorted distinct shingle ids.
+def build_incidence(columns: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    indptr = np.zeros(len(columns) + 1, dtype=np.int64)
+    np.cumsum([len(rows) for rows in columns], out=indptr[1:])
+    indices = np.concatenate(columns) if columns else np.empty(0, dtype=np.uint32)
+    return indptr, indices
+
+# Duplicate groups
+#
+# Copies of a product and boilerplate descriptions give many columns the same
+# cleaned text. Each distinct text is shingled and signed once (sign_texts) and
+# its columns form a group, represented by the first of them.
+
+# 64-bit hash of a cleaned text (get_product_text)
+def content_hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+# First column of the group of every column: columns with equal hashes
+def group_representatives(content_hashes: np.ndarray) -> np.ndarray:
+    _, first, inverse = np.unique(content_hashes, return_index=True, return_inverse=True)
+    return first[inverse.ravel()].astype(np.int64)
+
+# Content hashes, shingle ids (CSR) and signatures of texts; each distinct
+# text is shingled and signed once and copied to its duplicates
+def sign_texts(texts: List[str], k_shingle: int, minhasher: MinHash,
+               chunk_nnz: int = 1 << 16) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    hashes = np.array([content_hash(text) for text in texts], dtype=np.uint64)
+    _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    indptr, indices = build_incidence([get_shingle_ids(texts[i], k_shingle) for i in first.tolist()])
+    signatures = minhasher.signatures(indptr, indices, chunk_nnz)
+    positions, _ = expand_ranges(indptr[inverse], indptr[inverse + 1])
+    column_indptr = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(np.diff(indptr)[inverse], out=column_indptr[1:])
+    return hashes, column_indptr, indices[positions], signatures[inverse]
+
+# Shingles, signatures and sorted band keys of every field for one shard of
+# the catalog, whose first column is offset
+def build_shard(products: List[Dict], offset: int, k_shingle: int, n_hashes: int, bands: int, rows: int,
+                seed: int) -> Dict[str, Tuple]:
+    texts = {field: [get_product_text(product, field) for product in products] for field in FIELDS}
+
+    minhasher = MinHash(n_hashes, seed)
+    lsh = LSH(n_hashes, bands, rows)
+    shard = {}
+    for field in FIELDS:
+        # Columns are asins; build the incidence matrix and reduce all hash
+        # functions over each distinct text's rows at once
+        hashes, indptr, indices, M = sign_texts(texts[field], k_shingle, minhasher)
+        # Duplicates within the shard are left out of the buckets right away
+        local = np.flatnonzero(group_representatives(hashes) == np.arange(len(hashes)))
+        shard[field] = (np.diff(indptr), indices, M, lsh.sort_block(M[local], cols=local + offset), hashes)
+    return shard
+
+def _build_shard_args(args: Tuple) -> Dict[str, Tuple]:
+    return build_shard(*args)
+
+# Precompute data
+#
+# With workers > 1 the catalog is split into contiguous shards that are built
+# by a pool of worker processes (fork, like catalog.load_catalog) and merged in
+# column order. Shards smaller than min_shard are not worth a process; the
+# index is bit-identical for any number of workers. Duplicate groups span
+# shards, so the buckets keep the representatives once the shards are merged.
+def prepare_data(products: List[Dict], k_shingle: int = 3, n_hashes: int = 100, bands: int = 20, rows: int = 5, seed: int = 42,
+                 workers: Optional[int] = 1, min_shard: int = 5000) -> Dict[str, FieldIndex]:
+    params = {'k': k_shingle, 'n_hashes': n_hashes, 'bands': bands, 'rows': rows, 'seed': seed}
+    asin_to_product = {p['asin']: p for p in products if 'asin' in p}
+    asins = np.array(list(asin_to_product.keys()))
+    # Workers only need the text fields
+    texts = [{'title': p.get('title', ''), 'description': p.get('description', [])} for p in asin_to_product.values()]
+
+    workers = workers or os.cpu_count() or 1
+    n_shards = max(1, min(workers, len(texts) // min_shard))
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        n_shards = 1
+    bounds = [len(texts) * i // n_shards for i in range(n_shards + 1)]
+    jobs = [(texts[bounds[i]:bounds[i + 1]], bounds[i], k_shingle, n_hashes, bands, rows, seed) for i in range(n_shards)]
+    with BUILD_PHASE_SECONDS.time(phase='shingle_minhash'):
+        if n_shards == 1:
+            shards = [build_shard(*jobs[0])]
+        else:
+            with ProcessPoolExecutor(n_shards, mp_context=multiprocessing.get_context('fork')) as pool:
+                shards = list(pool.map(_build_shard_args, jobs))
+
+    indexes = {}
+    with BUILD_PHASE_SECONDS.time(phase='merge_buckets'):
+        for field in FIELDS:
+            indptr = np.zeros(len(texts) + 1, dtype=np.int64)
+            np.cumsum(np.concatenate([shard[field][0] for shard in shards]), out=indptr[1:])
+            indices = np.concatenate([shard[field][1] for shard in shards])
+            M = np.concatenate([shard[field][2] for shard in shards])
+            hashes = np.concatenate([shard[field][4] for shard in shards])
+            reps = group_representatives(hashes)
+            is_rep = reps == np.arange(len(reps))
+            lsh = LSH(n_hashes, bands, rows)
+            lsh.build_from_blocks([LSH.filter_block(shard[field][3], is_rep) for shard in shards])
+            indexes[field] = FieldIndex(asins, indptr, indices, M, lsh, params=params, content_hashes=hashes, representatives=reps)
+
+    return indexes
+
+# Batch similarity
+
+# Exact Jaccard of the columns left[i] and right[i] of a CSR incidence, for all
+# pairs at once. Shingle ids of both sides are tagged with their pair number and
+# sorted together; since ids are distinct within a column, every adjacent
+# duplicate is one shared shingle. Pairs are processed in chunks of about
+# chunk_nnz gathered ids to bound memory.
+def pairwise_jaccard(indptr: np.ndarray, indices: np.ndarray, left: np.ndarray, right: np.ndarray, chunk_nnz: int = 1 << 22) -> np.ndarray:
+    len_left = indptr[left + 1] - indptr[left]
+    len_right = indptr[right + 1] - indptr[right]
+    scores = np.zeros(len(left), dtype=np.float64)
+    vocab = int(indices.max()) + 1 if len(indices) else 1
+    cost = np.cumsum(len_left + len_right)
+    start = 0
+    while start < len(left):
+        base = cost[start - 1] if start else 0
+        end = max(int(np.searchsorted(cost, base + chunk_nnz, side='right')), start + 1)
+        tagged = []
+        for cols in (left[start:end], right[start:end]):
+            positions, owner = expand_ranges(indptr[cols], indptr[cols + 1])
+            tagged.append(owner * vocab + indices[positions])
+        merged = np.sort(np.concatenate(tagged))
+        shared = merged[1:][merged[1:] == merged[:-1]] // vocab
+        intersection = np.bincount(shared, minlength=end - start)
+        union = len_left[start:end] + len_right[start:end] - intersection
+        nonempty = (len_left[start:end] > 0) & (len_right[start:end] > 0)
+        scores[start:end] = np.where(nonempty, intersection / np.maximum(union, 1), 0.0)
+        start = end
+    return scores
+
+# Estimated Jaccard of the columns left[i] and right[i]: the fraction of MinHash
+# rows on which their signatures agree. Processed chunk_pairs pairs at a time.
+def estimate_jaccard(signatures: np.ndarray, left: np.ndarray, right: np.ndarray, chunk_pairs: int = 1 << 15) -> np.ndarray:
+    scores = np.empty(len(left), dtype=np.float64)
+    for start in range(0, len(left), chunk_pairs):
+        end = start + chunk_pairs
+        scores[start:end] = (signatures[left[start:end]] == signatures[right[start:end]]).mean(axis=1)
+    return scores
+
+# How candidates are scored:
+#   exact   - Jaccard of the shingle sets
+#   minhash - Jaccard estimated from the signatures
+#   rerank  - minhash for every candidate, then exact Jaccard for the best
+#             rerank_depth * k of each query
+SCORING_MODES = ['exact', 'minhash', 'rerank']
+
+# Best k of (query, cand, scores) per query, sorted by query, then by
+# descending score
+def top_k_pairs(query: np.ndarray, cand: np.ndarray, scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    order = np.lexsort((-scores, query))
+    query, cand, scores = query[order], cand[order], scores[order]
+    top = rank_in_group(query) < k
+    return query[top], cand[top], scores[top]
+
+# Top-k neighbors of the columns cols, scored over the whole batch at once. The
+# rules match the single-product page: columns without shingles get no
+# neighbors, the column's own duplicate group and candidates without shingles
+# are skipped. Candidates are group representatives (see FieldIndex).
+# Returns (position in cols, neighbor column, score) sorted by position, then
+# by descending score.
+def top_k_columns(index: FieldIndex, cols: np.ndarray, k: int, scoring: str = 'exact',
+                  rerank_depth: int = 3, capped: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    sizes = np.diff(index.indptr)
+    queried = np.flatnonzero(sizes[cols] > 0)
+    if not len(queried):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+    # Online queries apply the candidate caps, neighbor table builds do not
+    mode = 'online' if capped else 'table'
+    with STAGE_SECONDS.time(mode=mode, stage='candidates'):
+        query, cand = index.lsh.query_pairs(index.signatures[cols[queried]], capped)
+        query = queried[query]
+        keep = (cand != index.representatives[cols[query]]) & (sizes[cand] > 0)
+        query, cand = query[keep], cand[keep]
+    CANDIDATES_PER_QUERY.observe_many(np.bincount(query, minlength=len(cols))[queried], mode=mode)
+    if scoring == 'exact':
+        with STAGE_SECONDS.time(mode=mode, stage='exact_jaccard'):
+            scores = pairwise_jaccard(index.indptr, index.indices, cols[query], cand)
+        with STAGE_SECONDS.time(mode=mode, stage='rank'):
+            return top_k_pairs(query, cand, scores, k)
+
+    with STAGE_SECONDS.time(mode=mode, stage='minhash_estimate'):
+        scores = estimate_jaccard(index.signatures, cols[query], cand)
+    with STAGE_SECONDS.time(mode=mode, stage='rank'):
+        if scoring == 'minhash':
+            return top_k_pairs(query, cand, scores, k)
+        query, cand, _ = top_k_pairs(query, cand, scores, rerank_depth * k)
+    with STAGE_SECONDS.time(mode=mode, stage='exact_jaccard'):
+        scores = pairwise_jaccard(index.indptr, index.indices, cols[query], cand)
+    with STAGE_SECONDS.time(mode=mode, stage='rank'):
+        return top_k_pairs(query, cand, scores, k)
+
+# Position of each element within its run of equal values in a sorted array
+def rank_in_group(sorted_values: np.ndarray) -> np.ndarray:
+    return np.arange(len(sorted_values)) - np.searchsorted(sorted_values, sorted_values)
+
+# Top-k neighbors with their (exact or estimated, see SCORING_MODES) Jaccard
+# similarity for each asin in asins, computed on the fly for the whole batch.
+# Unknown asins are left out.
+def batch_similar(index: FieldIndex, asins: List[str], k: int = 10, scoring: str = 'exact') -> Dict[str, List[Tuple[str, float]]]:
+    found = [asin for asin in dict.fromkeys(asins) if asin in index.asin_to_index]
+    cols = np.array([index.asin_to_index[asin] for asin in found], dtype=np.int64)
+    results = {asin: [] for asin in found}
+    query, cand, scores = top_k_columns(index, cols, k, scoring)
+    cand_asins = index.asins[cand].tolist()
+    for q, neighbor, score in zip(query.tolist(), cand_asins, scores.tolist()):
+        results[found[q]].append((neighbor, score))
+    return results
+
+# Precomputed neighbors
+#
+# Row c of the table holds the top-k neighbor columns of column c and their
+# Jaccard scores, best first; unused slots are -1. Scores are float64, the
+# same values scoring on the fly gives. Lookups are O(1) and the table is
+# stored in the snapshot next to the index it was computed from.
+class NeighborTable:
+    def __init__(self, neighbors: np.ndarray, scores: np.ndarray):
+        self.neighbors = neighbors
+        self.scores = scores
+
+    @property
+    def k(self) -> int:
+        return self.neighbors.shape[1]
+
+    def row(self, index: FieldIndex, c: int) -> List[Tuple[str, float]]:
+        neighbors = self.neighbors[c]
+        filled = neighbors >= 0
+        return list(zip(index.asins[neighbors[filled]].tolist(), self.scores[c][filled].tolist()))
+
+# Whether find_similar answers from the precomputed table (an O(1) lookup)
+# rather than scoring candidates on the fly
+def precomputed(index: FieldIndex, k: int, scoring: str) -> bool:
+    return scoring == 'exact' and index.neighbors is not None and k <= index.neighbors.k
+
+# Top-k neighbors for each asin in asins. Exact scores are read from the
+# precomputed table when it holds at least k per row; anything else is scored
+# on the fly. Unknown asins are left out.
+def find_similar(index: FieldIndex, asins: List[str], k: int = 10, scoring: str = 'exact') -> Dict[str, List[Tuple[str, float]]]:
+    if precomputed(index, k, scoring):
+        return {asin: index.neighbors.row(index, index.asin_to_index[asin])[:k]
+                for asin in dict.fromkeys(asins) if asin in index.asin_to_index}
+    return batch_similar(index, asins, k, scoring)
+
+# Recompute the rows in cols of neighbors/scores in place, batch_size rows at a
+# time. progress, if given, is called with the fraction of rows done after each
+# batch.
+def fill_neighbor_rows(index: FieldIndex, neighbors: np.ndarray, scores: np.ndarray, cols: np.ndarray, batch_size: int = 2048,
+                       progress: Optional[Callable[[float], None]] = None):
+    k = neighbors.shape[1]
+    for start in range(0, len(cols), batch_size):
+        batch = cols[start:start + batch_size]
+        neighbors[batch] = -1
+        scores[batch] = 0.0
+        # The table is exact: it ignores the query-time candidate caps
+        query, cand, score = top_k_columns(index, batch, k, capped=False)
+        rows, slots = batch[query], rank_in_group(query)
+        neighbors[rows, slots] = cand
+        scores[rows, slots] = score
+        if progress is not None:
+            progress(min(start + batch_size, len(cols)) / len(cols))
+
+# Empty (n, k) neighbor and score arrays; with prefix, memory-mapped .npy files
+# prefix.neighbors.npy and prefix.neighbor_scores.npy (see build_out_of_core)
+def neighbor_arrays(n: int, k: int, prefix: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+    if prefix is None:
+        return np.full((n, k), -1, dtype=np.int32), np.zeros((n, k), dtype=np.float64)
+    neighbors = np.lib.format.open_memmap(prefix + '.neighbors.npy', 'w+', np.int32, (n, k))
+    scores = np.lib.format.open_memmap(prefix + '.neighbor_scores.npy', 'w+', np.float64, (n, k))
+    neighbors[:] = -1
+    return neighbors, scores
+
+# Copy the rows of the representatives of cols (see FieldIndex) to cols,
+# chunk_rows rows at a time: duplicates have the same neighbors
+def copy_group_rows(index: FieldIndex, neighbors: np.ndarray, scores: np.ndarray, cols: np.ndarray, chunk_rows: int = 1 << 16):
+    for start in range(0, len(cols), chunk_rows):
+        rows = cols[start:start + chunk_rows]
+        reps = np.asarray(index.representatives[rows])
+        neighbors[rows] = neighbors[reps]
+        scores[rows] = scores[reps]
+
+# Only the representatives' rows are scored, the others are copied
+def build_neighbor_table(index: FieldIndex, k: int = 10, progress: Optional[Callable[[float], None]] = None,
+                         prefix: Optional[str] = None) -> NeighborTable:
+    n = len(index.asins)
+    neighbors, scores = neighbor_arrays(n, k, prefix)
+    is_rep = np.asarray(index.representatives) == np.arange(n)
+    fill_neighbor_rows(index, neighbors, scores, np.flatnonzero(is_rep), progress=progress)
+    copy_group_rows(index, neighbors, scores, np.flatnonzero(~is_rep))
+    return NeighborTable(neighbors, scores)
+
+# Asins of new_index whose shingles or duplicate group representative differ
+# from old_index, or that are new
+def changed_asins(old_index: FieldIndex, new_index: FieldIndex, chunk_cols: int = 1 << 16) -> Set[str]:
+    new_cols = np.arange(len(new_index.asins))
+    old_cols = np.array([old_index.asin_to_index.get(asin, -1) for asin in new_index.asins.tolist()], dtype=np.int64)
+    common = old_cols >= 0
+    old_sizes, new_sizes = np.diff(old_index.indptr), np.diff(new_index.indptr)
+    same = common & (old_sizes[old_cols] == new_sizes)
+    old_reps = np.asarray(old_index.asins)[old_index.representatives[old_cols[same]]]
+    same[new_cols[same]] = old_reps == np.asarray(new_index.asins)[new_index.representatives[new_cols[same]]]
+    # Compare the shingle ids of equally sized columns element by element,
+    # chunk_cols columns at a time
+    cand_old, cand_new = old_cols[same], new_cols[same]
+    for start in range(0, len(cand_new), chunk_cols):
+        chunk_old, chunk_new = cand_old[start:start + chunk_cols], cand_new[start:start + chunk_cols]
+        old_pos, owner = expand_ranges(old_index.indptr[chunk_old], old_index.indptr[chunk_old + 1])
+        new_pos, _ = expand_ranges(new_index.indptr[chunk_new], new_index.indptr[chunk_new + 1])
+        mismatches = np.bincount(owner[old_index.indices[old_pos] != new_index.indices[new_pos]], minlength=len(chunk_new))
+        same[chunk_new[mismatches > 0]] = False
+    return set(new_index.asins[~same].tolist())
+
+# Bring a neighbor table computed on old_index up to date with new_index, where
+# only the asins in changed were added or had their text or duplicate group
+# representative changed (removed asins are detected from the indexes).
+# Products whose shingles did not change keep their signatures (see
+# get_shingle_ids), so candidate pairs between unchanged products are the same
+# in both indexes and only these rows are recomputed: changed products,
+# products listing a changed or removed product among their neighbors, and
+# products sharing a bucket with a changed product, with their duplicates.
+def refresh_neighbor_table(table: NeighborTable, old_index: FieldIndex, new_index: FieldIndex, changed: Set[str],
+                           progress: Optional[Callable[[float], None]] = None, prefix: Optional[str] = None,
+                           chunk_rows: int = 1 << 16) -> NeighborTable:
+    n, k = len(new_index.asins), table.k
+    changed = set(changed) | {asin for asin in new_index.asin_to_index if asin not in old_index.asin_to_index}
+    old_to_new = np.array([new_index.asin_to_index.get(asin, -1) for asin in old_index.asins.tolist()], dtype=np.int64)
+    stale = old_to_new < 0
+    stale[[old_index.asin_to_index[asin] for asin in changed if asin in old_index.asin_to_index]] = True
+
+    # Carry over the rows of surviving products, renumbered to new columns,
+    # chunk_rows rows at a time
+    neighbors, scores = neighbor_arrays(n, k, prefix)
+    kept = np.flatnonzero(~stale)
+    lists_stale = [np.empty(0, dtype=np.int64)]
+    for start in range(0, len(kept), chunk_rows):
+        rows = kept[start:start + chunk_rows]
+        old_rows = np.asarray(table.neighbors[rows])
+        neighbors[old_to_new[rows]] = np.where(old_rows >= 0, old_to_new[old_rows], -1)
+        scores[old_to_new[rows]] = table.scores[rows]
+        lists_stale.append(rows[(np.where(old_rows >= 0, stale[old_rows], False)).any(axis=1)])
+    lists_stale = np.concatenate(lists_stale)
+
+    changed_cols = np.array(sorted(new_index.asin_to_index[asin] for asin in changed if asin in new_index.asin_to_index), dtype=np.int64)
+    # Empty columns all share one signature but never get neighbors, skip them
+    queried = changed_cols[np.diff(new_index.indptr)[changed_cols] > 0]
+    _, bucket_mates = new_index.lsh.query_pairs(new_index.signatures[queried], capped=False)
+    affected = np.concatenate([changed_cols, old_to_new[lists_stale], bucket_mates])
+    reps = np.asarray(new_index.representatives)
+    affected_reps = np.unique(reps[affected])
+    fill_neighbor_rows(new_index, neighbors, scores, affected_reps, progress=progress)
+    copy_group_rows(new_index, neighbors, scores, np.flatnonzero(np.isin(reps, affected_reps) & (reps != np.arange(n))))
+    return NeighborTable(neighbors, scores)
+
+# Hybrid similarity
+#
+# The hybrid score of two products is the weighted mean of their Jaccard
+# similarities on each field of weights (HYBRID_WEIGHTS by default), computed
+# from the field indexes instead of a third index over the concatenated text.
+# Candidates are the union of the LSH candidates of the fields, each expanded
+# to the duplicate group it represents (the members share the text of that
+# field only, so each is a candidate of its own); scoring works as in
+# top_k_columns, per field. Fields the query product has no text for are
+# left out of its weights, so a product without a description is compared on
+# titles alone. Field indexes built together (prepare_data, update_indexes,
+# snapshots) share their columns, which is what lets scores be combined
+# column by column. Duplicates are collapsed across the weighted fields (see
+# hybrid_top_k_columns).
+HYBRID = 'hybrid'
+HYBRID_WEIGHTS = {'title': 0.5, 'description': 0.5}
+
+def check_weights(indexes: Dict[str, FieldIndex], weights: Optional[Dict[str, float]]) -> Dict[str, float]:
+    weights = HYBRID_WEIGHTS if weights is None else weights
+    if any(field not in indexes for field in weights) or any(weight < 0 for weight in weights.values()) \
+            or not any(weight > 0 for weight in weights.values()):
+        raise ValueError("hybrid weights must map indexed fields (%s) to non-negative numbers, not all zero"
+                         % ', '.join(sorted(indexes)))
+    return {field: float(weight) for field, weight in weights.items() if weight > 0}
+
+# Hybrid scores of the column pairs (left[i], right[i]), exact or estimated
+def hybrid_scores(indexes: Dict[str, FieldIndex], weights: Dict[str, float], left: np.ndarray, right: np.ndarray,
+                  scoring: str = 'exact') -> np.ndarray:
+    total, norm = np.zeros(len(left)), np.zeros(len(left))
+    for field, weight in weights.items():
+        index = indexes[field]
+        sizes = np.diff(index.indptr)
+        if scoring == 'exact':
+            scores = pairwise_jaccard(index.indptr, index.indices, left, right)
+        else:
+            # Empty columns all share one signature, their estimate is meaningless
+            scores = np.where((sizes[left] > 0) & (sizes[right] > 0), estimate_jaccard(index.signatures, left, right), 0.0)
+        total += weight * scores
+        norm += weight * (sizes[left] > 0)
+    return np.where(norm > 0, total / np.maximum(norm, 1e-12), 0.0)
+
+# top_k_columns for the hybrid similarity
+def hybrid_top_k_columns(indexes: Dict[str, FieldIndex], cols: np.ndarray, k: int, scoring: str = 'exact',
+                         weights: Optional[Dict[str, float]] = None, rerank_depth: int = 3,
+                         capped: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    weights = check_weights(indexes, weights)
+    mode = 'online' if capped else 'table'
+    queries, cands, all_votes = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0)]
+    with STAGE_SECONDS.time(mode=mode, stage='candidates'):
+        for field in weights:
+            index = indexes[field]
+            sizes = np.diff(index.indptr)
+            queried = np.flatnonzero(sizes[cols] > 0)
+            if len(queried):
+                query, cand, votes = index.lsh.query_votes(index.signatures[cols[queried]], capped)
+                # Groups count as buckets for the max_bucket cap, and their
+                # members as candidates for max_candidates: the groups with the
+                # most collisions are expanded first
+                limit = int(np.max(index.lsh.max_bucket)) if capped and index.lsh.max_bucket is not None else None
+                max_total = index.lsh.max_candidates if capped else None
+                if max_total is not None:
+                    order = np.lexsort((cand, -votes, query))
+                    query, cand, votes = query[order], cand[order], votes[order]
+                owner, cand = index.group_members(cand, limit, query, max_total)
+                query, votes = query[owner], votes[owner]
+                keep = sizes[cand] > 0
+                queries.append(queried[query][keep])
+                cands.append(cand[keep].astype(np.int64))
+                all_votes.append(votes[keep])
+        n = len(indexes[next(iter(weights))].asins)
+        pairs, inverse = np.unique(np.concatenate(queries) * n + np.concatenate(cands), return_inverse=True)
+        votes = np.bincount(inverse.ravel(), weights=np.concatenate(all_votes), minlength=len(pairs))
+        query, cand = pairs // n, pairs % n
+        # Products whose text is the same in every weighted field are one
+        # hybrid duplicate group: the query's own group is skipped and every
+        # other group is listed once, as its lowest candidate column
+        groups = np.column_stack([query] + [indexes[field].representatives[cand] for field in weights])
+        own = (groups[:, 1:] == np.column_stack([indexes[field].representatives[cols[query]] for field in weights])).all(axis=1)
+        _, first = np.unique(groups, axis=0, return_index=True)
+        keep = np.zeros(len(query), dtype=bool)
+        keep[first] = True
+        keep &= ~own
+        query, cand, votes = query[keep], cand[keep], votes[keep]
+        # The fields' candidates together are capped again, by their
+        # collisions summed over the fields
+        caps = [indexes[field].lsh.max_candidates for field in weights]
+        if capped and None not in caps:
+            order = np.lexsort((cand, -votes, query))
+            keep = np.sort(order[rank_in_group(query[order]) < max(caps)])
+            query, cand = query[keep], cand[keep]
+    CANDIDATES_PER_QUERY.observe_many(np.bincount(query, minlength=len(cols)), mode=mode)
+    if scoring != 'exact':
+        with STAGE_SECONDS.time(mode=mode, stage='minhash_estimate'):
+            scores = hybrid_scores(indexes, weights, cols[query], cand, 'minhash')
+        with STAGE_SECONDS.time(mode=mode, stage='rank'):
+            if scoring == 'minhash':
+                return top_k_pairs(query, cand, scores, k)
+            query, cand, _ = top_k_pairs(query, cand, scores, rerank_depth * k)
+    with STAGE_SECONDS.time(mode=mode, stage='exact_jaccard'):
+        scores = hybrid_scores(indexes, weights, cols[query], cand)
+    with STAGE_SECONDS.time(mode=mode, stage='rank'):
+        return top_k_pairs(query, cand, scores, k)
+
+# batch_similar for the hybrid similarity. Raises ValueError for bad weights.
+def hybrid_similar(indexes: Dict[str, FieldIndex], asins: List[str], k: int = 10, scoring: str = 'exact',
+                   weights: Optional[Dict[str, float]] = None) -> Dict[str, List[Tuple[str, float]]]:
+    index = indexes[FIELDS[0]]
+    found = [asin for asin in dict.fromkeys(asins) if asin in index.asin_to_index]
+    cols = np.array([index.asin_to_index[asin] for asin in found], dtype=np.int64)
+    results = {asin: [] for asin in found}
+    query, cand, scores = hybrid_top_k_columns(indexes, cols, k, scoring, weights)
+    for q, neighbor, score in zip(query.tolist(), index.asins[cand].tolist(), scores.tolist()):
+        results[found[q]].append((neighbor, score))
+    return results
+
+# Top-k neighbors for each asin in asins by an indexed field or HYBRID
+def similar_by_field(indexes: Dict[str, FieldIndex], field: str, asins: List[str], k: int = 10, scoring: str = 'exact',
+                     weights: Optional[Dict[str, float]] = None) -> Dict[str, List[Tuple[str, float]]]:
+    if field == HYBRID:
+        return hybrid_similar(indexes, asins, k, scoring, weights)
+    return find_similar(indexes[field], asins, k, scoring)
+
+# Band/row tuning
+#
+# Two items of Jaccard similarity s share at least one of bands buckets with
+# probability 1 - (1 - s**rows)**bands (the S-curve) when the hash functions
+# behave like random permutations. tune_lsh samples query columns of a built
+# index (duplicate group representatives) and rates every setting with
+# bands * rows <= n_hashes, rows <= max_rows
+# and bands <= 64:
+#   - expected recall: the mean S-curve value over the sampled pairs whose
+#     exact Jaccard is at least threshold;
+#   - observed recall: the share of those pairs that actually collide. The
+#     linear hash functions of MinHash agree less often than Jaccard predicts,
+#     so this is what the choice is based on once there are min_pairs pairs;
+#   - candidates per query: counted from the actual band collisions of the
+#     sampled signatures with the whole field (or max_docs of its columns), so
+#     large buckets such as shared boilerplate descriptions are accounted for.
+# The chosen setting is the one with the fewest candidates among those reaching
+# recall within max_candidates; failing that, the best recall within the
+# budget, or else the fewest candidates. A catalog version gets the setting of
+# the previous one (prefer) as long as it still reaches both targets, so that
+# its neighbor table can be refreshed instead of rebuilt. Queries and columns
+# are sampled by a hash of their asin, so a few changed products only change a
+# few of the samples.
+def s_curve(s: np.ndarray, bands: int, rows: int) -> np.ndarray:
+    return 1.0 - (1.0 - np.asarray(s, dtype=np.float64) ** rows) ** bands
+
+# Columns of asins ordered by a seeded hash of each asin
+def stable_order(asins: np.ndarray, seed: int = 0) -> np.ndarray:
+    keys = np.array([zlib.crc32(asin.encode('utf-8'), seed) for asin in asins.tolist()], dtype=np.int64)
+    return np.argsort(keys, kind='stable')
+
+def tune_lsh(index: FieldIndex, threshold: float = 0.5, recall: float = 0.9, max_candidates: float = 200,
+             max_rows: int = 10, sample_size: int = 100, max_docs: int = 50000, min_pairs: int = 50, seed: int = 0,
+             prefer: Optional[Tuple[int, int]] = None) -> Dict:
+    n_hashes = index.signatures.shape[1]
+    # Only representatives are in the buckets (see FieldIndex)
+    reps = np.flatnonzero(np.asarray(index.representatives) == np.arange(len(index.asins)))
+    n = len(reps)
+    if not n:
+        # Nothing to sample (an empty catalog): keep the index's setting
+        return {'bands': index.lsh.bands, 'rows': index.lsh.rows, 'expected_recall': None, 'observed_recall': None,
+                'recall': None, 'candidates': 0.0, 'threshold': threshold, 'target_recall': recall,
+                'max_candidates': max_candidates, 'queries': 0, 'pairs': 0, 'settings': []}
+    ranked = reps[stable_order(np.asarray(index.asins)[reps], seed)]
+    docs = np.sort(ranked[:max_docs])
+    queries = ranked[np.diff(index.indptr)[ranked] > 0][:sample_size]
+    signatures = np.asarray(index.signatures[docs])
+    max_rows = min(max_rows, n_hashes)
+    band_counts = {rows: min(64, n_hashes // rows) for rows in range(1, max_rows + 1)}
+    # Per rows, the number of sampled docs (and of true neighbors) first colliding in band b
+    collisions = {rows: np.zeros(bands + 1, dtype=np.int64) for rows, bands in band_counts.items()}
+    true_collisions = {rows: np.zeros(bands + 1, dtype=np.int64) for rows, bands in band_counts.items()}
+    true_scores = []
+    for q in queries.tolist():
+        agree = signatures == index.signatures[q]
+        agree[docs == q] = False
+        # Exact Jaccard of the pairs whose MinHash estimate is within 3 standard errors of threshold
+        near = np.flatnonzero(agree.mean(axis=1) >= threshold - 0.15)
+        exact = pairwise_jaccard(index.indptr, index.indices, np.full(len(near), q), docs[near])
+        true = near[exact >= threshold]
+        true_scores.append(exact[exact >= threshold])
+        for rows, bands in band_counts.items():
+            matched = agree[:, :bands * rows].reshape(len(docs), bands, rows).all(axis=2)
+            first = np.where(matched.any(axis=1), matched.argmax(axis=1), bands)
+            collisions[rows] += np.bincount(first, minlength=bands + 1)
+            true_collisions[rows] += np.bincount(first[true], minlength=bands + 1)
+
+    scores = np.concatenate(true_scores) if true_scores else np.empty(0)
+    scale = n / len(docs) / max(len(queries), 1)
+    settings = []
+    for rows, bands_max in band_counts.items():
+        candidates = np.cumsum(collisions[rows])[:bands_max] * scale
+        found = np.cumsum(true_collisions[rows])[:bands_max]
+        for bands in range(1, bands_max + 1):
+            # Without sampled neighbors, rate recall at the threshold itself
+            expected = float(s_curve(scores, bands, rows).mean() if len(scores) else s_curve(threshold, bands, rows))
+            observed = float(found[bands - 1] / len(scores)) if len(scores) else None
+            settings.append({'bands': bands, 'rows': rows, 'expected_recall': expected, 'observed_recall': observed,
+                             'recall': observed if len(scores) >= min_pairs else expected,
+                             'candidates': float(candidates[bands - 1])})
+
+    within_budget = [s for s in settings if s['candidates'] <= max_candidates]
+    feasible = [s for s in within_budget if s['recall'] >= recall]
+    kept = [s for s in feasible if (s['bands'], s['rows']) == tuple(prefer or ())]
+    if kept:
+        best = kept[0]
+    elif feasible:
+        best = min(feasible, key=lambda s: (s['candidates'], -s['recall']))
+    elif within_budget:
+        best = max(within_budget, key=lambda s: (s['recall'], -s['candidates']))
+    else:
+        best = min(settings, key=lambda s: (s['candidates'], -s['recall']))
+    return dict(best, threshold=threshold, target_recall=recall, max_candidates=max_candidates,
+                queries=len(queries), pairs=len(scores), settings=settings)
+
+# Rebuild the buckets of index with another (bands, rows) setting, from the
+# signatures it already has. With memory_budget, they are built out of core
+# into the files at prefix (see build_buckets_out_of_core).
+def retune_index(index: FieldIndex, bands: int, rows: int, prefix: Optional[str] = None, memory_budget: Optional[int] = None):
+    reps = np.flatnonzero(np.asarray(index.representatives) == np.arange(len(index.asins)))
+    if memory_budget is not None:
+        lsh = build_buckets_out_of_core(index.signatures, bands, rows, prefix, memory_budget, reps)
+    else:
+        lsh = LSH(index.signatures.shape[1], bands, rows)
+        lsh.build(index.signatures[reps], reps)
+    index.lsh = lsh
+    index.params = dict(index.params or {}, bands=bands, rows=rows)
+
+# Incremental updates
+#
+# Only added and updated products are shingled and signed. Unchanged columns
+# keep their shingle ids and signatures, the buckets are merged with
+# LSH.updated and the neighbor table is refreshed with refresh_neighbor_table.
+# Indexes are never modified in place (snapshot arrays are read-only memory
+# maps, and requests may be reading them): a new FieldIndex is returned, with a
+# new version.
+
+# Index of field after upserting products (by asin) and deleting asins. Updated
+# products keep their column, new ones are appended in the order given; an
+# asin in both upserts and deletes is upserted.
+def update_index(index: FieldIndex, field: str, upserts: Dict[str, Dict], deletes: Set[str]) -> FieldIndex:
+    params = index.params
+    old_n = len(index.asins)
+    deleted = np.zeros(old_n, dtype=bool)
+    deleted[[index.asin_to_index[asin] for asin in deletes if asin in index.asin_to_index and asin not in upserts]] = True
+    old_to_new = np.where(deleted, -1, np.cumsum(~deleted) - 1)
+    kept = np.flatnonzero(~deleted)
+    added = [asin for asin in upserts if asin not in index.asin_to_index]
+    added_cols = {asin: len(kept) + i for i, asin in enumerate(added)}
+    n = len(kept) + len(added)
+    cols = np.array([old_to_new[index.asin_to_index[asin]] if asin in index.asin_to_index else added_cols[asin]
+                     for asin in upserts], dtype=np.int64)
+
+    # Shingles and signatures of the upserted products only
+    new_hashes, new_indptr, new_indices, new_signatures = sign_texts(
+        [get_product_text(product, field) for product in upserts.values()], params['k'], MinHash(params['n_hashes'], params['seed']))
+
+    # Gather every new column's shingle ids from the old incidence or the new one
+    starts, ends = np.empty(n, dtype=np.int64), np.empty(n, dtype=np.int64)
+    starts[old_to_new[kept]], ends[old_to_new[kept]] = index.indptr[kept], index.indptr[kept + 1]
+    starts[cols], ends[cols] = len(index.indices) + new_indptr[:-1], len(index.indices) + new_indptr[1:]
+    positions, _ = expand_ranges(starts, ends)
+    indices = np.concatenate([index.indices, new_indices])[positions]
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(ends - starts, out=indptr[1:])
+
+    signatures = np.empty((n, index.signatures.shape[1]), dtype=np.uint64)
+    signatures[old_to_new[kept]] = index.signatures[kept]
+    signatures[cols] = new_signatures
+    hashes = np.empty(n, dtype=np.uint64)
+    hashes[old_to_new[kept]] = index.content_hashes[kept]
+    hashes[cols] = new_hashes
+    reps = group_representatives(hashes)
+    asins = np.array(index.asins[kept].tolist() + added, dtype=str)
+
+    # The buckets keep the entries of representatives that are still
+    # representatives and not updated, and insert the new representatives
+    old_reps = np.asarray(index.representatives)
+    lsh_map = old_to_new.copy()
+    lsh_map[[index.asin_to_index[asin] for asin in upserts if asin in index.asin_to_index]] = -1
+    still_rep = np.zeros(old_n, dtype=bool)
+    still_rep[kept] = (old_reps[kept] == kept) & (reps[old_to_new[kept]] == old_to_new[kept])
+    lsh_map[~still_rep] = -1
+    inserted = np.setdiff1d(np.flatnonzero(reps == np.arange(n)), lsh_map[lsh_map >= 0])
+    lsh = index.lsh.updated(lsh_map, signatures[inserted], inserted)
+
+    new_index = FieldIndex(asins, indptr, indices, signatures, lsh, params=params, content_hashes=hashes, representatives=reps)
+    if index.neighbors is not None:
+        # Unchanged products whose group got another representative have
+        # other candidates too
+        moved = asins[reps[old_to_new[kept]]] != index.asins[old_reps[kept]]
+        changed = set(upserts) | set(index.asins[kept[moved]].tolist())
+        new_index.neighbors = refresh_neighbor_table(index.neighbors, index, new_index, changed)
+    return new_index
+
+def update_indexes(indexes: Dict[str, FieldIndex], upserts: Dict[str, Dict], deletes: Set[str]) -> Dict[str, FieldIndex]:
+    with BUILD_PHASE_SECONDS.time(phase='delta_update'):
+        return {field: update_index(index, field, upserts, deletes) for field, index in indexes.items()}
+
+# Stream a JSON-lines delta file (see catalog.parse_delta) into indexes, one
+# batch of batch_size lines at a time
+def apply_delta(indexes: Dict[str, FieldIndex], path: str, batch_size: int = 10000) -> Dict[str, FieldIndex]:
+    for upserts, deletes in read_delta(path, INDEX_FIELDS, batch_size):
+        indexes = update_indexes(indexes, upserts, deletes)
+    return indexes
+
+# Index snapshots
+#
+# A snapshot is a directory of .npy arrays plus manifest.json, named after a key
+# derived from the build parameters and the SHA-256 of the source file, so a
+# changed catalog or changed parameters never load a stale index. Arrays are
+# opened with mmap_mode='r': workers on one host share the page cache instead of
+# each holding a private copy.
+SNAPSHOT_FORMAT = 7
+SNAPSHOT_ARRAYS = ['asins', 'indptr', 'indices', 'signatures', 'band_ptr', 'bucket_keys', 'bucket_offsets', 'bucket_postings',
+                   'neighbors', 'neighbor_scores', 'content_hashes', 'representatives']
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def snapshot_key(source_sha256: str, params: Dict) -> str:
+    key = dict(params, format=SNAPSHOT_FORMAT, source=source_sha256)
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+def save_snapshot(path: str, indexes: Dict[str, FieldIndex], manifest: Dict, tmp: Optional[str] = None):
+    # Write into a temporary sibling and rename, so readers never see a partial
+    # snapshot and concurrent builders simply race to an identical result. tmp
+    # is such a sibling that already holds some of the arrays (build_out_of_core
+    # writes them there): arrays memory-mapped from their file in tmp are kept.
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tmp or tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        for field, index in indexes.items():
+            lsh = index.lsh
+            arrays = {'asins': np.asanyarray(index.asins), 'indptr': index.indptr, 'indices': index.indices,
+                      'signatures': index.signatures, 'band_ptr': lsh.band_ptr, 'bucket_keys': lsh.keys,
+                      'bucket_offsets': lsh.offsets, 'bucket_postings': lsh.postings,
+                      'neighbors': index.neighbors.neighbors, 'neighbor_scores': index.neighbors.scores,
+                      'content_hashes': index.content_hashes, 'representatives': index.representatives}
+            for name in SNAPSHOT_ARRAYS:
+                target = os.path.join(tmp, '%s.%s.npy' % (field, name))
+                array = arrays[name]
+                if isinstance(array, np.memmap) and os.path.abspath(array.filename) == os.path.abspath(target):
+                    array.flush()
+                    continue
+                np.save(target, array)
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.exists(os.path.join(path, 'manifest.json')):
+            raise
+
+def load_snapshot(path: str) -> Dict[str, FieldIndex]:
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    indexes = {}
+    for field in manifest['fields']:
+        arrays = {name: np.load(os.path.join(path, '%s.%s.npy' % (field, name)), mmap_mode='r')
+                  for name in SNAPSHOT_ARRAYS}
+        # Fields tuned by tune_lsh have their own (bands, rows)
+        params = dict(manifest['params'], **{key: value for key, value in manifest.get('lsh', {}).get(field, {}).items()
+                                             if key in ('bands', 'rows')})
+        lsh = LSH.from_arrays(params['rows'], arrays['band_ptr'], arrays['bucket_keys'],
+                              arrays['bucket_offsets'], arrays['bucket_postings'])
+        neighbors = NeighborTable(arrays['neighbors'], arrays['neighbor_scores'])
+        indexes[field] = FieldIndex(arrays['asins'], arrays['indptr'], arrays['indices'], arrays['signatures'], lsh, neighbors,
+                                    os.path.basename(os.path.normpath(path)), params, arrays['content_hashes'],
+                                    arrays['representatives'])
+    return indexes
+
+# Out-of-core build
+#
+# prepare_data holds the whole catalog, its shingles and signatures in memory.
+# build_out_of_core builds the same index (bit-identical arrays) for catalogs
+# larger than RAM: the JSON-lines file is streamed chunk by chunk, shingle ids
+# and signatures are appended to .npy files as each batch is signed, and the
+# buckets are built from the signatures on disk with an external sort: sorted
+# runs of band keys are spilled to disk and merged band by band. Every step
+# works on pieces sized from memory_budget (bytes), so peak memory follows the
+# budget rather than the catalog; what remains proportional to the catalog is
+# per-product bookkeeping of a few dozen bytes per product (the asins, the
+# duplicate groups, and the asin to column map of the loaded FieldIndex).
+MIN_MEMORY_BUDGET = 32 << 20
+
+# Writes a .npy file whose length is only known at the end: rows are appended
+# as they come and the header is filled in by close(). The data goes to
+# path + '.part', renamed to path once complete.
+class NpyWriter:
+    HEADER_BYTES = 128
+
+    def __init__(self, path: str, dtype, row_shape: Tuple[int, ...] = ()):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.rows = 0
+        self.file = open(path + '.part', 'wb')
+        self.file.write(b'\0' * self.HEADER_BYTES)
+
+    def append(self, rows: np.ndarray):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        assert rows.shape[1:] == self.row_shape
+        self.file.write(rows.tobytes())
+        self.rows += len(rows)
+
+    def close(self) -> np.ndarray:
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+                 np.lib.format.dtype_to_descr(self.dtype), (self.rows,) + self.row_shape)
+        padding = self.HEADER_BYTES - 10 - len(header) - 1
+        assert padding >= 0
+        self.file.seek(0)
+        self.file.write(np.lib.format.MAGIC_PREFIX + b'\x01\x00' + np.uint16(self.HEADER_BYTES - 10).tobytes()
+                        + (header + ' ' * padding + '\n').encode('latin1'))
+        self.file.close()
+        os.replace(self.path + '.part', self.path)
+        return np.load(self.path, mmap_mode='r')
+
+# Write the CSR incidence and signatures of the columns source (rows of the
+# arrays read) to prefix.indptr/indices/signatures.npy, chunk_cols columns
+# at a time
+def gather_columns(prefix: str, indptr: np.ndarray, indices: np.ndarray, signatures: np.ndarray, source: np.ndarray,
+                   chunk_cols: int):
+    indptr_out = NpyWriter(prefix + '.indptr.npy', np.int64)
+    indices_out = NpyWriter(prefix + '.indices.npy', indices.dtype)
+    signatures_out = NpyWriter(prefix + '.signatures.npy', signatures.dtype, signatures.shape[1:])
+    indptr_out.append(np.zeros(1, dtype=np.int64))
+    total = 0
+    for start in range(0, len(source), chunk_cols):
+        cols = source[start:start + chunk_cols]
+        positions, _ = expand_ranges(indptr[cols], indptr[cols + 1])
+        lengths = np.asarray(indptr[cols + 1] - indptr[cols])
+        indptr_out.append(total + np.cumsum(lengths))
+        total += int(lengths.sum())
+        indices_out.append(indices[positions])
+        signatures_out.append(signatures[cols])
+    indptr_out.close(), indices_out.close(), signatures_out.close()
+
+# Buckets of the signatures (n, n_hashes) with the given setting, built with an
+# external sort and written to prefix.band_ptr/bucket_keys/bucket_offsets/
+# bucket_postings.npy; returns the LSH over these files. The same arrays as
+# LSH.build, for any memory_budget; cols, if given, are the (ascending)
+# columns to put in the buckets, by default all of them.
+#
+# Runs: chunks of columns are sorted per band (LSH.sort_block) and stored band
+# by band in two (bands, n) spill files. Merge: for each band, a window of
+# every run is read; the smallest last (key, run) of the windows bounds what is
+# certainly complete, every window gives up its elements up to that bound and
+# these are sorted together (stable, so equal keys keep ascending columns) and
+# appended to the buckets. The window of the bounding run is always used up,
+# so each step makes progress.
+def build_buckets_out_of_core(signatures: np.ndarray, bands: int, rows: int, prefix: str, memory_budget: int,
+                              cols: Optional[np.ndarray] = None) -> LSH:
+    n, n_hashes = signatures.shape
+    n = n if cols is None else len(cols)
+    lsh = LSH(n_hashes, bands, rows)
+    spill = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(prefix)), prefix='.runs-')
+    try:
+        # Signature rows, their band keys, the sort order and sorted copies
+        run_cols = max(1, memory_budget // (4 * 8 * n_hashes + 40 * bands))
+        run_keys = np.lib.format.open_memmap(os.path.join(spill, 'keys.npy'), 'w+', np.uint64, (bands, n))
+        run_postings = np.lib.format.open_memmap(os.path.join(spill, 'postings.npy'), 'w+', np.int32, (bands, n))
+        run_starts = np.arange(0, n, run_cols, dtype=np.int64)
+        for start in run_starts.tolist():
+            if cols is None:
+                block_keys, block_cols = lsh.sort_block(signatures[start:start + run_cols], start)
+            else:
+                block_keys, block_cols = lsh.sort_block(signatures[cols[start:start + run_cols]], cols=cols[start:start + run_cols])
+            run_keys[:, start:start + len(block_keys)] = block_keys.T
+            run_postings[:, start:start + len(block_keys)] = block_cols.T
+        run_keys.flush(), run_postings.flush()
+        run_ends = np.minimum(run_starts + run_cols, n)
+        # The windows of all runs together, as read and merged
+        window = max(1, memory_budget // (48 * max(len(run_starts), 1)))
+
+        offset_dtype = np.int32 if bands * n < 2**31 else np.int64
+        keys_out = NpyWriter(prefix + '.bucket_keys.npy', np.uint64)
+        offsets_out = NpyWriter(prefix + '.bucket_offsets.npy', offset_dtype)
+        postings_out = NpyWriter(prefix + '.bucket_postings.npy', np.int32)
+        for band_idx in range(bands):
+            band_keys, band_postings = run_keys[band_idx], run_postings[band_idx]
+            positions, emitted, last_key, buckets = run_starts.copy(), 0, None, 0
+            while True:
+                live = np.flatnonzero(positions < run_ends).tolist()
+                if not live:
+                    break
+                windows = [band_keys[positions[r]:min(positions[r] + window, run_ends[r])] for r in live]
+                bound = int(np.argmin([w[-1] for w in windows]))  # first of equal keys: the smallest run
+                taken = [int(np.searchsorted(w, windows[bound][-1], side='right' if i <= bound else 'left'))
+                         for i, w in enumerate(windows)]
+                merged_keys = np.concatenate([w[:t] for w, t in zip(windows, taken)])
+                merged_postings = np.concatenate([band_postings[positions[r]:positions[r] + t] for r, t in zip(live, taken)])
+                if len(live) > 1:
+                    order = np.argsort(merged_keys, kind='stable')
+                    merged_keys, merged_postings = merged_keys[order], merged_postings[order]
+                new = np.r_[last_key is None or merged_keys[0] != last_key, merged_keys[1:] != merged_keys[:-1]]
+                starts = np.flatnonzero(new)
+                keys_out.append(merged_keys[starts])
+                offsets_out.append(starts + emitted + band_idx * n)
+                postings_out.append(merged_postings)
+                emitted += len(merged_keys)
+                last_key = merged_keys[-1]
+                buckets += len(starts)
+                positions[live] += taken
+            lsh.band_ptr[band_idx + 1] = lsh.band_ptr[band_idx] + buckets
+        offsets_out.append(np.array([bands * n]))
+    finally:
+        shutil.rmtree(spill, ignore_errors=True)
+    # Written like the other arrays, so files of an index being retuned are
+    # replaced rather than overwritten while they are mapped
+    band_ptr_out = NpyWriter(prefix + '.band_ptr.npy', np.int64)
+    band_ptr_out.append(lsh.band_ptr)
+    return LSH.from_arrays(rows, band_ptr_out.close(), keys_out.close(), offsets_out.close(), postings_out.close())
+
+# prepare_data for the JSON-lines file source_path, writing the index arrays
+# to directory (named like in a snapshot) instead of holding them in memory.
+# Products without an asin are skipped and an asin that occurs more than once
+# keeps the column of its first occurrence and the text of its last, as in
+# prepare_data. The returned indexes are memory-mapped from directory and have
+# no neighbor tables yet.
+def build_out_of_core(source_path: str, directory: str, memory_budget: int, k_shingle: int = 3, n_hashes: int = 100,
+                      bands: int = 20, rows: int = 5, seed: int = 42) -> Dict[str, FieldIndex]:
+    if memory_budget < MIN_MEMORY_BUDGET:
+        raise ValueError("memory_budget must be at least %d bytes" % MIN_MEMORY_BUDGET)
+    params = {'k': k_shingle, 'n_hashes': n_hashes, 'bands': bands, 'rows': rows, 'seed': seed}
+    minhasher = MinHash(n_hashes, seed)
+    # Raw JSON read at a time (its parsed text, shingle ids and their hashing
+    # take several times its size), products signed per batch, and shingle ids
+    # hashed at a time by MinHash.signatures
+    chunk_bytes = memory_budget // 32
+    batch_rows = max(1, memory_budget // (8 * 8 * n_hashes))
+    chunk_nnz = max(1, memory_budget // (8 * 8 * n_hashes))
+
+    staged = os.path.join(directory, '.staged') + os.sep
+    os.makedirs(staged, exist_ok=True)
+    writers = {field: (NpyWriter(staged + field + '.indptr.npy', np.int64), NpyWriter(staged + field + '.indices.npy', np.uint32),
+                       NpyWriter(staged + field + '.signatures.npy', np.uint64, (n_hashes,)),
+                       NpyWriter(staged + field + '.content_hashes.npy', np.uint64)) for field in FIELDS}
+    totals = dict.fromkeys(FIELDS, 0)
+    for indptr_out, _, _, _ in writers.values():
+        indptr_out.append(np.zeros(1, dtype=np.int64))
+    asin_chunks = []
+    with BUILD_PHASE_SECONDS.time(phase='shingle_minhash'):
+        for chunk in read_chunks(source_path, chunk_bytes):
+            products = [p for p in parse_chunk(chunk, INDEX_FIELDS) if 'asin' in p]
+            for start in range(0, len(products), batch_rows):
+                batch = products[start:start + batch_rows]
+                asin_chunks.append(np.array([p['asin'] for p in batch]))
+                for field, (indptr_out, indices_out, signatures_out, hashes_out) in writers.items():
+                    hashes, indptr, indices, signatures = sign_texts([get_product_text(p, field) for p in batch], k_shingle,
+                                                                     minhasher, chunk_nnz)
+                    indptr_out.append(totals[field] + indptr[1:])
+                    totals[field] += len(indices)
+                    indices_out.append(indices)
+                    signatures_out.append(signatures)
+                    hashes_out.append(hashes)
+    arrays = {field: [writer.close() for writer in field_writers] for field, field_writers in writers.items()}
+
+    indexes = {}
+    with BUILD_PHASE_SECONDS.time(phase='merge_buckets'):
+        all_asins = np.concatenate(asin_chunks) if asin_chunks else np.array([])
+        # Columns: first occurrences in file order, each read from the last occurrence
+        unique, first = np.unique(all_asins, return_index=True)
+        if len(unique) < len(all_asins):
+            order = np.argsort(first)
+            _, last_reversed = np.unique(all_asins[::-1], return_index=True)
+            asins, source = unique[order], (len(all_asins) - 1 - last_reversed)[order]
+        else:
+            asins, source = all_asins, None
+        del all_asins, asin_chunks, unique, first
+        for field in FIELDS:
+            prefix = os.path.join(directory, field)
+            np.save(prefix + '.asins.npy', asins)
+            indptr, indices, signatures, hashes = arrays.pop(field)
+            if source is not None:
+                gather_columns(prefix, indptr, indices, signatures, source, batch_rows)
+            else:
+                for name in ('indptr', 'indices', 'signatures', 'content_hashes'):
+                    os.replace(staged + '%s.%s.npy' % (field, name), '%s.%s.npy' % (prefix, name))
+            # Duplicate groups: a representative per product
+            if source is not None:
+                np.save(prefix + '.content_hashes.npy', hashes[source])
+            np.save(prefix + '.representatives.npy', group_representatives(np.load(prefix + '.content_hashes.npy')))
+            del indptr, indices, signatures, hashes
+            signatures = np.load(prefix + '.signatures.npy', mmap_mode='r')
+            representatives = np.load(prefix + '.representatives.npy', mmap_mode='r')
+            reps = np.flatnonzero(representatives == np.arange(len(representatives)))
+            lsh = build_buckets_out_of_core(signatures, bands, rows, prefix, memory_budget, reps)
+            del reps
+            indexes[field] = FieldIndex(np.load(prefix + '.asins.npy', mmap_mode='r'),
+                                        np.load(prefix + '.indptr.npy', mmap_mode='r'),
+                                        np.load(prefix + '.indices.npy', mmap_mode='r'), signatures, lsh, params=params,
+                                        content_hashes=np.load(prefix + '.content_hashes.npy', mmap_mode='r'),
+                                        representatives=representatives)
+    shutil.rmtree(staged, ignore_errors=True)
+    return indexes
+
+# Most recent snapshot in snapshot_dir built with the same parameters from
+# another version of the source, or None
+def previous_snapshot(snapshot_dir: str, params: Dict) -> Optional[str]:
+    best, best_mtime = None, 0.0
+    for name in os.listdir(snapshot_dir) if os.path.isdir(snapshot_dir) else []:
+        manifest_path = os.path.join(snapshot_dir, name, 'manifest.json')
+        if name.startswith('.') or not os.path.exists(manifest_path):
+            continue
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('format') == SNAPSHOT_FORMAT and manifest.get('params') == params:
+            mtime = os.path.getmtime(manifest_path)
+            if mtime > best_mtime:
+                best, best_mtime = os.path.join(snapshot_dir, name), mtime
+    return best
+
+def load_or_build_index(source_path: str, products: Optional[List[Dict]], snapshot_dir: str = 'index_snapshot',
+                        k_shingle: int = 3, n_hashes: int = 100, bands: int = 20, rows: int = 5, seed: int = 42,
+                        top_k: int = 10, workers: Optional[int] = None, tuning: Optional[Dict] = None,
+                        progress: Optional[Callable[[str, str, float], None]] = None,
+                        memory_budget: Optional[int] = None) -> Dict[str, FieldIndex]:
+    # tuning holds tune_lsh arguments (threshold, recall, max_candidates, ...);
+    # when given, every field gets the (bands, rows) setting tune_lsh picks.
+    # progress, if given, is called with (field, phase, fraction of the phase
+    # done) as the build goes through the phases of BUILD_PHASE_SECONDS.
+    # With memory_budget (bytes), the index is built out of core from
+    # source_path (products is not used and may be None) straight into the
+    # snapshot directory, neighbor tables included.
+    def report(phase: str, fraction: float = 0.0, fields: List[str] = FIELDS):
+        if progress is not None:
+            for field in fields:
+                progress(field, phase, fraction)
+
+    params = {'k': k_shingle, 'n_hashes': n_hashes, 'bands': bands, 'rows': rows, 'seed': seed, 'top_k': top_k,
+              'tuning': tuning}
+    source_sha256 = file_sha256(source_path)
+    path = os.path.join(snapshot_dir, snapshot_key(source_sha256, params))
+    if os.path.exists(os.path.join(path, 'manifest.json')):
+        report('load_snapshot')
+        with BUILD_PHASE_SECONDS.time(phase='load_snapshot'):
+            return load_snapshot(path)
+
+    report('shingle_minhash')
+    tmp, prefixes = None, dict.fromkeys(FIELDS)
+    if memory_budget is not None:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=snapshot_dir, prefix='.tmp-')
+        prefixes = {field: os.path.join(tmp, field) for field in FIELDS}
+        indexes = build_out_of_core(source_path, tmp, memory_budget, k_shingle, n_hashes, bands, rows, seed)
+    else:
+        indexes = prepare_data(products, k_shingle, n_hashes, bands, rows, seed, workers)
+    # The neighbor tables of the previous catalog version only need the rows
+    # touched by changed products to be recomputed, as long as the field's
+    # buckets use the same setting: tuning keeps that setting if it can
+    previous = previous_snapshot(snapshot_dir, params)
+    old_indexes = load_snapshot(previous) if previous else {}
+    settings = {}
+    with BUILD_PHASE_SECONDS.time(phase='tune'):
+        for field, index in indexes.items():
+            report('tune', fields=[field])
+            if tuning is not None:
+                old_index = old_indexes.get(field)
+                prefer = (old_index.lsh.bands, old_index.lsh.rows) if old_index is not None else None
+                tuned = tune_lsh(index, **dict(tuning, prefer=prefer))
+                if (tuned['bands'], tuned['rows']) != (bands, rows):
+                    retune_index(index, tuned['bands'], tuned['rows'], prefixes[field], memory_budget)
+                settings[field] = {key: value for key, value in tuned.items() if key != 'settings'}
+            else:
+                settings[field] = {'bands': bands, 'rows': rows}
+            settings[field]['buckets'] = index.lsh.bucket_stats()
+
+    with BUILD_PHASE_SECONDS.time(phase='neighbors'):
+        for field, index in indexes.items():
+            old_index = old_indexes.get(field)
+            report('neighbors', fields=[field])
+            field_progress = lambda fraction, field=field: report('neighbors', fraction, [field])
+            if old_index is not None and (old_index.lsh.bands, old_index.lsh.rows) == (index.lsh.bands, index.lsh.rows):
+                index.neighbors = refresh_neighbor_table(old_index.neighbors, old_index, index, changed_asins(old_index, index),
+                                                         field_progress, prefixes[field])
+            else:
+                index.neighbors = build_neighbor_table(index, top_k, field_progress, prefixes[field])
+
+    manifest = {'format': SNAPSHOT_FORMAT, 'source': os.path.basename(source_path), 'source_sha256': source_sha256,
+                'params': params, 'fields': FIELDS, 'lsh': settings}
+    report('save_snapshot')
+    with BUILD_PHASE_SECONDS.time(phase='save_snapshot'):
+        save_snapshot(path, indexes, manifest, tmp)
+    report('load_snapshot')
+    with BUILD_PHASE_SECONDS.time(phase='load_snapshot'):
+        return load_snapshot(path)
+
+# Byte count from a number with an optional K, M or G suffix (powers of 1024)
+def parse_size(text: str) -> int:
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*', text.lower())
+    if not match:
+        raise argparse.ArgumentTypeError("invalid size: %r" % text)
+    return int(float(match.group(1)) * 1024 ** ' kmg'.index(match.group(2) or ' '))
+
+# Build a snapshot ahead of time: python recommender.py meta_Appliances.json
+# (--memory-budget 512M for catalogs that do not fit in memory)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the LSH index snapshot for a catalog file")
+    parser.add_argument("source", nargs="?", default="meta_Appliances.json")
+    parser.add_argument("--snapshot-dir", default="index_snapshot")
+    parser.add_argument("--workers", type=int, default=None, help="build processes (default: one per core)")
+    parser.add_argument("--tune", action="store_true", help="pick (bands, rows) per field with tune_lsh")
+    parser.add_argument("--threshold", type=float, default=0.5, help="tuning: Jaccard similarity of a true neighbor")
+    parser.add_argument("--recall", type=float, default=0.9, help="tuning: expected share of true neighbors found")
+    parser.add_argument("--max-candidates", type=float, default=200, help="tuning: candidates per query budget")
+    parser.add_argument("--memory-budget", type=parse_size, default=None,
+                        help="build out of core, streaming the catalog, within about this much memory (e.g. 512M)")
+    args = parser.parse_args()
+    products = load_catalog(args.source, INDEX_FIELDS) if args.memory_budget is None else None
+    tuning = {'threshold': args.threshold, 'recall': args.recall, 'max_candidates': args.max_candidates} if args.tune else None
+    indexes = load_or_build_index(args.source, products, args.snapshot_dir, workers=args.workers, tuning=tuning,
+                                  memory_budget=args.memory_budget)
+    for field, index in indexes.items():
+        stats = index.lsh.bucket_stats()
+        print("%-12s bands=%d rows=%d  %d buckets, size p50 %.0f p99 %.0f max %d" % (
+              field, index.lsh.bands, index.lsh.rows, stats['buckets'], stats.get('p50', 0), stats.get('p99', 0), stats.get('max', 0)))
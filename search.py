@@ -0,0 +1,196 @@
+import re
+import copy
+import heapq
+from array import array
+from bisect import bisect_left, insort
+from itertools import islice
+from typing import List, Dict, Iterator, Set, Tuple
+
+TOKEN_RE = re.compile(r'\w+')
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+# Typeahead index over product titles.
+#
+# Results are ranked in two tiers, each in catalog order:
+#   1. every query token is the prefix of a title token (word-start matches),
+#      looked up in the sorted term array and the terms' posting lists;
+#   2. the query is a substring of the lowercased title (mid-word matches, as
+#      the old linear scan did), found through a trigram index. Queries shorter
+#      than 3 characters only use tier 1.
+# Both tiers walk their postings in ascending order and stop as soon as limit
+# results are found. Short prefixes of model numbers and the like can match a
+# term count that grows with the catalog, so a query token only merges the
+# postings of its first MAX_PREFIX_TERMS terms (in term order, the token itself
+# first), and each tier checks at most MAX_SCANNED_DOCS documents: the cost of
+# a query does not grow with the catalog.
+MAX_PREFIX_TERMS = 256
+MAX_SCANNED_DOCS = 4096
+
+# Documents are numbered in catalog order. updated() gives a new index with
+# product changes applied: changed documents keep their number, new ones are
+# numbered after the last, and deleted ones are left as unnumbered gaps, so
+# results are the same as those of an index built from the changed catalog.
+class SearchIndex:
+    def __init__(self, products: List[Dict], ngram: int = 3):
+        self.ngram = ngram
+        self.asins = []
+        self.titles = []
+        self.lowered = []
+        # ' tok1 tok2 ...' per title: a token prefix check is one substring test
+        self.token_strings = []
+        # asin -> its documents (an asin may occur more than once)
+        self.docs = {}
+        self.size = 0
+        self.postings = {}
+        self.grams = {}
+        for product in products:
+            if 'asin' in product:
+                self.add(product)
+        self.terms = sorted(self.postings)
+
+    def __len__(self) -> int:
+        return self.size
+
+    # Lowercased title, ' tok1 tok2 ...' string, distinct tokens and distinct
+    # ngrams of title
+    def keys(self, title: str) -> Tuple[str, str, List[str], List[str]]:
+        lowered = title.lower()
+        tokens = tokenize(title)
+        grams = list(dict.fromkeys(lowered[i:i + self.ngram] for i in range(len(lowered) - self.ngram + 1)))
+        return lowered, ' ' + ' '.join(tokens), list(dict.fromkeys(tokens)), grams
+
+    # Append product as a new document (the term array is not updated)
+    def add(self, product: Dict):
+        doc = len(self.asins)
+        title = product.get('title', '')
+        lowered, token_string, tokens, grams = self.keys(title)
+        self.asins.append(product['asin'])
+        self.titles.append(title)
+        self.lowered.append(lowered)
+        self.token_strings.append(token_string)
+        self.docs.setdefault(product['asin'], []).append(doc)
+        self.size += 1
+        for token in tokens:
+            self.postings.setdefault(token, array('i')).append(doc)
+        for gram in grams:
+            self.grams.setdefault(gram, array('i')).append(doc)
+
+    # A new index with upserts (products by asin) and deletes (asins) applied.
+    # This index is not modified: the new one shares every posting list that
+    # does not change.
+    def updated(self, upserts: Dict[str, Dict], deletes: Set[str]) -> 'SearchIndex':
+        index = copy.copy(self)
+        index.asins, index.titles, index.lowered = list(self.asins), list(self.titles), list(self.lowered)
+        index.token_strings, index.docs = list(self.token_strings), dict(self.docs)
+        # Documents leaving (-) and joining (+) each term and ngram
+        changes = {'postings': {}, 'grams': {}}
+
+        def change(doc, title, sign):
+            _, _, tokens, grams = self.keys(title)
+            for kind, keys in (('postings', tokens), ('grams', grams)):
+                for key in keys:
+                    docs = changes[kind].setdefault(key, {})
+                    docs[doc] = docs.get(doc, 0) + sign
+
+        for asin in deletes:
+            for doc in index.docs.pop(asin, []):
+                change(doc, self.titles[doc], -1)
+                index.asins[doc], index.titles[doc], index.lowered[doc], index.token_strings[doc] = None, '', '', ''
+                index.size -= 1
+        for asin, product in upserts.items():
+            docs = index.docs.get(asin)
+            if docs is None:
+                docs = index.docs[asin] = [len(index.asins)]
+                index.asins.append(asin)
+                index.titles.append('')
+                index.lowered.append('')
+                index.token_strings.append('')
+                index.size += 1
+            title = product.get('title', '')
+            lowered, token_string, _, _ = self.keys(title)
+            for doc in docs:
+                change(doc, index.titles[doc], -1)
+                change(doc, title, +1)
+                index.titles[doc], index.lowered[doc], index.token_strings[doc] = title, lowered, token_string
+
+        # Changed posting lists are copied, edited in place and dropped once empty
+        index.postings, index.grams = dict(self.postings), dict(self.grams)
+        new_terms, gone_terms = [], set()
+        for kind, keys in changes.items():
+            lists = getattr(index, kind)
+            for key, docs in keys.items():
+                docs = {doc: sign for doc, sign in docs.items() if sign}
+                if not docs:
+                    continue
+                postings = array('i', lists.get(key, ()))
+                for doc, sign in sorted(docs.items()):
+                    if sign > 0:
+                        insort(postings, doc)
+                    else:
+                        del postings[bisect_left(postings, doc)]
+                if postings:
+                    if kind == 'postings' and key not in lists:
+                        new_terms.append(key)
+                    lists[key] = postings
+                elif key in lists:
+                    del lists[key]
+                    if kind == 'postings':
+                        gone_terms.add(key)
+        if new_terms or gone_terms:
+            terms = [term for term in self.terms if term not in gone_terms] if gone_terms else self.terms
+            index.terms = sorted(terms + new_terms)
+        return index
+
+    # Range of the (at most MAX_PREFIX_TERMS) first terms starting with prefix
+    def prefix_range(self, prefix: str) -> range:
+        lo = bisect_left(self.terms, prefix)
+        hi = bisect_left(self.terms, prefix + '\U0010ffff', lo, min(lo + MAX_PREFIX_TERMS, len(self.terms)))
+        return range(lo, hi)
+
+    # Documents (ascending, without repeats) having a token that starts with prefix
+    def prefix_docs(self, prefix: str) -> Iterator[int]:
+        terms = self.prefix_range(prefix)
+        last = -1
+        for doc in heapq.merge(*(self.postings[self.terms[t]] for t in terms)):
+            if doc != last:
+                last = doc
+                yield doc
+
+    def token_matches(self, tokens: List[str]) -> Iterator[int]:
+        # Walk the most selective token's documents, check the others in place
+        counts = [sum(len(self.postings[self.terms[t]]) for t in self.prefix_range(token)) for token in tokens]
+        rarest = min(range(len(tokens)), key=counts.__getitem__)
+        others = [' ' + token for i, token in enumerate(tokens) if i != rarest]
+        for doc in islice(self.prefix_docs(tokens[rarest]), MAX_SCANNED_DOCS):
+            token_string = self.token_strings[doc]
+            if all(other in token_string for other in others):
+                yield doc
+
+    def substring_matches(self, query: str) -> Iterator[int]:
+        grams = [query[i:i + self.ngram] for i in range(len(query) - self.ngram + 1)]
+        postings = [self.grams.get(gram) for gram in grams]
+        if not all(postings):
+            return
+        for doc in islice(min(postings, key=len), MAX_SCANNED_DOCS):
+            if query in self.lowered[doc]:
+                yield doc
+
+    def search(self, query: str, limit: int = 10) -> List[Dict]:
+        query = query.lower()
+        tokens = tokenize(query)
+        found = []
+        if tokens:
+            for doc in self.token_matches(tokens):
+                found.append(doc)
+                if len(found) >= limit:
+                    break
+        if len(found) < limit and len(query) >= self.ngram:
+            seen = set(found)
+            for doc in self.substring_matches(query):
+                if doc not in seen:
+                    found.append(doc)
+                    if len(found) >= limit:
+                        break
+        return [{"asin": self.asins[doc], "title": self.titles[doc]} for doc in found]
@@ -0,0 +1,304 @@
+import os
+import json
+import zlib
+import shutil
+import argparse
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Dict, Tuple, Optional
+
+import numpy as np
+
+from catalog import load_catalog, INDEX_FIELDS
+from recommender import (prepare_data, save_snapshot, load_snapshot, file_sha256, snapshot_key, expand_ranges,
+                         pairwise_jaccard, estimate_jaccard, top_k_pairs, rank_in_group, NeighborTable,
+                         FIELDS, SCORING_MODES, SNAPSHOT_FORMAT)
+
+# Sharded LSH index
+#
+# The catalog is partitioned into n_shards by a stable hash of the asin, or of
+# the top-level category (category[0]) so that a category stays on one shard.
+# Every shard is an ordinary index snapshot of its products (prepare_data with
+# the same parameters, so the signatures are those of the unsharded index)
+# plus positions.npy, the catalog position of each of its columns. Shards have
+# no neighbor tables (k = 0): neighbors span shards.
+#
+# A query fans out in two steps: the shard owning each queried asin returns
+# its signature and shingle ids, then every shard scores the queries against
+# its own buckets and returns its local top-k, which are merged by score and
+# then catalog position. Scores and tie order are those of batch_similar on
+# the unsharded index without candidate caps (max_bucket, max_candidates):
+# every colliding product is a candidate, scored by the same rules. Duplicate
+# groups (recommender.FieldIndex) are per shard; the merge keeps the first of
+# each group by catalog position, its representative in the unsharded index,
+# and every shard skips the queried product's own group.
+#
+# Each shard is served by its own worker process (spawned, so it inherits
+# neither the threads nor the memory of the caller), which memory-maps only
+# its shard; reload_shard swaps in a rebuilt shard while the others keep
+# serving.
+SHARDS_FORMAT = 1
+PARTITIONS = ['asin', 'category']
+
+def shard_of(key: str, n_shards: int) -> int:
+    return zlib.crc32(key.encode('utf-8')) % n_shards
+
+def partition_key(product: Dict, by: str) -> str:
+    if by == 'asin':
+        return product['asin']
+    category = product.get('category') or ['']
+    return str(category[0])
+
+# Products of the catalog in column order (duplicate asins keep their first
+# position and last product, as in prepare_data), split into shards: per
+# shard, the catalog positions and products
+def partition_products(products: List[Dict], n_shards: int, by: str = 'asin') -> List[Tuple[np.ndarray, List[Dict]]]:
+    if by not in PARTITIONS:
+        raise ValueError("by must be one of %s" % ', '.join(PARTITIONS))
+    catalog = list({p['asin']: p for p in products if 'asin' in p}.values())
+    owners = np.array([shard_of(partition_key(p, by), n_shards) for p in catalog], dtype=np.int64)
+    shards = []
+    for shard in range(n_shards):
+        positions = np.flatnonzero(owners == shard)
+        shards.append((positions, [catalog[i] for i in positions.tolist()]))
+    return shards
+
+# Build the shards of source_path into directory: directory/shards.json lists
+# the shard snapshots, one subdirectory each. only, if given, rebuilds just
+# these shards of an existing set (same n_shards, by and parameters) and keeps
+# the others. Returns the manifest.
+def build_shards(source_path: str, products: List[Dict], directory: str = 'index_shards', n_shards: int = 4, by: str = 'asin',
+                 only: Optional[List[int]] = None, k_shingle: int = 3, n_hashes: int = 100, bands: int = 20, rows: int = 5,
+                 seed: int = 42, workers: Optional[int] = 1) -> Dict:
+    params = {'k': k_shingle, 'n_hashes': n_hashes, 'bands': bands, 'rows': rows, 'seed': seed}
+    manifest = {'format': SHARDS_FORMAT, 'by': by, 'n_shards': n_shards, 'params': params, 'fields': FIELDS,
+                'shards': [None] * n_shards}
+    manifest_path = os.path.join(directory, 'shards.json')
+    os.makedirs(directory, exist_ok=True)
+    if only is not None:
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        if {key: previous.get(key) for key in ('format', 'by', 'n_shards', 'params')} != \
+           {key: manifest[key] for key in ('format', 'by', 'n_shards', 'params')}:
+            raise ValueError("only: %s was built with other settings" % manifest_path)
+        manifest['shards'] = previous['shards']
+
+    source_sha256 = file_sha256(source_path)
+    for shard, (positions, shard_products) in enumerate(partition_products(products, n_shards, by)):
+        if only is not None and shard not in only:
+            continue
+        indexes = prepare_data(shard_products, k_shingle, n_hashes, bands, rows, seed, workers)
+        for index in indexes.values():
+            index.neighbors = NeighborTable(np.empty((len(index.asins), 0), dtype=np.int32),
+                                            np.empty((len(index.asins), 0), dtype=np.float64))
+        name = 'shard-%d-%s' % (shard, snapshot_key(source_sha256, dict(params, by=by, shard=shard, n_shards=n_shards)))
+        path = os.path.join(directory, name)
+        if not os.path.exists(os.path.join(path, 'manifest.json')):
+            save_snapshot(path, indexes, {'format': SNAPSHOT_FORMAT, 'source': os.path.basename(source_path),
+                                          'source_sha256': source_sha256, 'params': params, 'fields': FIELDS,
+                                          'shard': shard, 'n_shards': n_shards, 'by': by})
+            np.save(os.path.join(path, 'positions.npy'), positions)
+        manifest['shards'][shard] = name
+
+    # Replace the manifest in one step, then drop the shard snapshots it no
+    # longer lists (processes still serving them keep their mappings)
+    tmp = manifest_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, manifest_path)
+    for name in os.listdir(directory):
+        if name.startswith('shard-') and name not in manifest['shards']:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    return manifest
+
+# One loaded shard: its field indexes and the catalog position of each column
+class Shard:
+    def __init__(self, path: str):
+        self.path = path
+        self.indexes = load_snapshot(path)
+        self.positions = np.load(os.path.join(path, 'positions.npy'), mmap_mode='r')
+
+    # Signatures, shingle ids (CSR), content hashes and catalog positions of
+    # the asins of field held by this shard; returns (asins found, positions,
+    # signatures, indptr, indices, content hashes)
+    def lookup(self, field: str, asins: List[str]) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        index = self.indexes[field]
+        found = [asin for asin in asins if asin in index.asin_to_index]
+        cols = np.array([index.asin_to_index[asin] for asin in found], dtype=np.int64)
+        positions, _ = expand_ranges(index.indptr[cols], index.indptr[cols + 1])
+        indptr = np.zeros(len(cols) + 1, dtype=np.int64)
+        np.cumsum(np.diff(index.indptr)[cols], out=indptr[1:])
+        return (found, np.asarray(self.positions[cols], dtype=np.int64), np.asarray(index.signatures[cols]), indptr,
+                np.asarray(index.indices[positions]), np.asarray(index.content_hashes[cols]))
+
+    # Local top-k of the queries (signatures, CSR shingle ids and content
+    # hashes, as returned by lookup) among this shard's columns, scored as in
+    # top_k_columns. Returns (query, catalog position, asin, content hash,
+    # score, estimate): with rerank, the best rerank_depth * k by MinHash
+    # estimate with their exact scores, otherwise the best k by score.
+    def top_k(self, field: str, signatures: np.ndarray, indptr: np.ndarray, indices: np.ndarray, hashes: np.ndarray,
+              k: int, scoring: str = 'exact', rerank_depth: int = 3) -> Tuple[np.ndarray, ...]:
+        index = self.indexes[field]
+        sizes = np.diff(index.indptr)
+        query, cand = index.lsh.query_pairs(signatures, capped=False)
+        keep = (index.content_hashes[cand] != hashes[query]) & (sizes[cand] > 0)
+        query, cand = query[keep], cand[keep]
+        # Queries and the distinct candidates as one small CSR and signature
+        # matrix, so that the batch scoring functions apply unchanged
+        distinct, inverse = np.unique(cand, return_inverse=True)
+        cand_positions, _ = expand_ranges(index.indptr[distinct], index.indptr[distinct + 1])
+        local_indptr = np.concatenate([indptr, indptr[-1] + np.cumsum(sizes[distinct])])
+        local_indices = np.concatenate([indices, index.indices[cand_positions]])
+        right = len(signatures) + inverse.ravel()
+        if scoring == 'exact':
+            query, right, scores = top_k_pairs(query, right, pairwise_jaccard(local_indptr, local_indices, query, right), k)
+            estimates = scores
+        else:
+            local_signatures = np.concatenate([signatures, np.asarray(index.signatures[distinct])])
+            depth = k if scoring == 'minhash' else rerank_depth * k
+            query, right, estimates = top_k_pairs(query, right, estimate_jaccard(local_signatures, query, right), depth)
+            scores = estimates if scoring == 'minhash' else pairwise_jaccard(local_indptr, local_indices, query, right)
+        cols = distinct[right - len(signatures)]
+        return (query, np.asarray(self.positions[cols], dtype=np.int64), np.asarray(index.asins[cols]).astype(str),
+                np.asarray(index.content_hashes[cols]), scores, estimates)
+
+# Worker process side: the shard is loaded once, when the process starts
+_shard = None
+
+def _load_shard(path: str):
+    global _shard
+    _shard = Shard(path)
+
+def _call_shard(method: str, *args):
+    return getattr(_shard, method)(*args)
+
+# Positions in (query, hashes) of the first entry of each query's duplicate
+# groups, ascending
+def first_of_groups(query: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    _, first = np.unique(np.column_stack([query.astype(np.uint64), hashes]), axis=0, return_index=True)
+    return np.sort(first)
+
+# Merge the local top-k of every shard: per query, the best k by score, ties
+# in catalog order (with rerank, first the best rerank_depth * k by estimate),
+# one entry per duplicate group
+def merge_top_k(parts: List[Tuple[np.ndarray, ...]], k: int, scoring: str = 'exact',
+                rerank_depth: int = 3) -> Tuple[np.ndarray, ...]:
+    query, positions, asins, hashes, scores, estimates = (np.concatenate([part[i] for part in parts]) for i in range(6))
+    order = np.lexsort((positions, -(estimates if scoring == 'rerank' else scores), query))
+    order = order[first_of_groups(query[order], hashes[order])]
+    query, asins, scores = query[order], asins[order], scores[order]
+    if scoring == 'rerank':
+        top = rank_in_group(query) < rerank_depth * k
+        query, asins, scores = query[top], asins[top], scores[top]
+        # Stable: equal scores keep the estimate order, as in top_k_columns
+        order = np.lexsort((-scores, query))
+        query, asins, scores = query[order], asins[order], scores[order]
+    top = rank_in_group(query) < k
+    return query[top], asins[top], scores[top]
+
+# Client of a sharded index directory (see build_shards). With processes
+# False, the shards are loaded in this process and queried from a thread pool
+# instead of worker processes.
+class ShardedIndex:
+    def __init__(self, directory: str = 'index_shards', processes: bool = True):
+        self.directory = directory
+        self.processes = processes
+        with open(os.path.join(directory, 'shards.json')) as f:
+            self.manifest = json.load(f)
+        self.by, self.n_shards = self.manifest['by'], self.manifest['n_shards']
+        self.threads = None if processes else ThreadPoolExecutor(self.n_shards)
+        self.shards = [self.open_shard(name) for name in self.manifest['shards']]
+
+    def open_shard(self, name: str):
+        path = os.path.join(self.directory, name)
+        if not self.processes:
+            return Shard(path)
+        executor = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'), initializer=_load_shard,
+                                       initargs=(path,))
+        # Start the process and load the shard now rather than on the first query
+        executor.submit(_call_shard, 'lookup', FIELDS[0], []).result()
+        return executor
+
+    def call(self, shard: int, method: str, *args) -> Future:
+        if self.processes:
+            return self.shards[shard].submit(_call_shard, method, *args)
+        return self.threads.submit(getattr(self.shards[shard], method), *args)
+
+    # Load shard again from the (rebuilt) directory; queries keep going to the
+    # old one until the new one is loaded
+    def reload_shard(self, shard: int):
+        with open(os.path.join(self.directory, 'shards.json')) as f:
+            manifest = json.load(f)
+        replacement = self.open_shard(manifest['shards'][shard])
+        old, self.shards[shard] = self.shards[shard], replacement
+        self.manifest['shards'][shard] = manifest['shards'][shard]
+        if self.processes:
+            old.shutdown(wait=False)
+
+    # Top-k neighbors of field for each asin in asins, as batch_similar.
+    # Unknown asins are left out.
+    def similar(self, field: str, asins: List[str], k: int = 10, scoring: str = 'exact',
+                rerank_depth: int = 3) -> Dict[str, List[Tuple[str, float]]]:
+        if scoring not in SCORING_MODES:
+            raise ValueError("scoring must be one of %s" % ', '.join(SCORING_MODES))
+        asins = list(dict.fromkeys(asins))
+        # Products are found on the shard their asin hashes to; by category,
+        # every shard is asked
+        if self.by == 'asin':
+            asked = {}
+            for asin in asins:
+                asked.setdefault(shard_of(asin, self.n_shards), []).append(asin)
+        else:
+            asked = dict.fromkeys(range(self.n_shards), asins)
+        lookups = [self.call(shard, 'lookup', field, shard_asins) for shard, shard_asins in asked.items()]
+        found, hashes, signatures, indptrs, indices = [], [], [], [], []
+        for future in lookups:
+            shard_found, _, shard_signatures, shard_indptr, shard_indices, shard_hashes = future.result()
+            found += shard_found
+            hashes.append(shard_hashes)
+            signatures.append(shard_signatures)
+            indptrs.append(np.diff(shard_indptr))
+            indices.append(shard_indices)
+        order = {asin: i for i, asin in enumerate(asins)}
+        results = {asin: [] for asin in sorted(found, key=order.get)}
+        sizes = np.concatenate(indptrs) if indptrs else np.empty(0, dtype=np.int64)
+        # Products without shingles get no neighbors
+        if not sizes.any():
+            return results
+        indptr = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=indptr[1:])
+        queried = np.flatnonzero(sizes > 0)
+        hashes, signatures = np.concatenate(hashes)[queried], np.concatenate(signatures)[queried]
+        query_indptr = np.zeros(len(queried) + 1, dtype=np.int64)
+        np.cumsum(sizes[queried], out=query_indptr[1:])
+        query_indices = np.concatenate(indices)[expand_ranges(indptr[queried], indptr[queried + 1])[0]]
+
+        parts = [self.call(shard, 'top_k', field, signatures, query_indptr, query_indices, hashes, k, scoring, rerank_depth)
+                 for shard in range(self.n_shards)]
+        query, cand_asins, scores = merge_top_k([future.result() for future in parts], k, scoring, rerank_depth)
+        for q, neighbor, score in zip(query.tolist(), cand_asins.tolist(), scores.tolist()):
+            results[found[queried[q]]].append((neighbor, score))
+        return results
+
+    def close(self):
+        for shard in self.shards:
+            if self.processes:
+                shard.shutdown()
+        if self.threads is not None:
+            self.threads.shutdown()
+
+# Build or rebuild shards: python sharding.py meta_Appliances.json --shards 4
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a sharded LSH index for a catalog file")
+    parser.add_argument("source", nargs="?", default="meta_Appliances.json")
+    parser.add_argument("--dir", default="index_shards")
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--by", choices=PARTITIONS, default='asin', help="partition by asin hash or by top-level category")
+    parser.add_argument("--only", type=int, action="append", help="rebuild only this shard (repeatable)")
+    parser.add_argument("--workers", type=int, default=None, help="build processes per shard (default: one per core)")
+    args = parser.parse_args()
+    products = load_catalog(args.source, INDEX_FIELDS + ['category'])
+    manifest = build_shards(args.source, products, args.dir, args.shards, args.by, args.only, workers=args.workers)
+    for shard, name in enumerate(manifest['shards']):
+        index = load_snapshot(os.path.join(args.dir, name))[FIELDS[0]]
+        print("shard %d: %d products  %s" % (shard, len(index.asins), name))
@@ -0,0 +1,69 @@
+import os
+import sys
+import random
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import synthetic_catalog
+
+BRANDS = ['Whirlpool', 'GE', 'Frigidaire', 'Samsung', 'LG']
+CATEGORIES = [['Appliances', 'Parts & Accessories'], ['Appliances', 'Refrigerators'], ['Appliances', 'Washers & Dryers']]
+
+# Synthetic products with listing fields, a few exact duplicates (the same
+# title and description as another product) and a few without a title
+@pytest.fixture
+def products():
+    rng = random.Random(1)
+    products = synthetic_catalog(600, seed=1)
+    for product in products:
+        product['brand'] = rng.choice(BRANDS)
+        product['category'] = list(rng.choice(CATEGORIES))
+    for product in rng.sample(products, 40):
+        source = rng.choice(products)
+        product['title'] = source['title']
+        product['description'] = list(source.get('description', []))
+    for product in rng.sample(products, 10):
+        del product['title']
+    return products
+
+# A delta for products: changed titles, descriptions, brands and categories,
+# products turned into duplicates of others, new products (some duplicates
+# too) and deletes, as (upserts by asin, deleted asins)
+@pytest.fixture
+def delta(products):
+    rng = random.Random(2)
+    upserts = {}
+    for product in rng.sample(products, 30):
+        changed = dict(product, title='%s %s' % (product.get('title', ''), rng.choice(['Kit', 'Pack of 2', 'OEM'])))
+        changed['brand'] = rng.choice(BRANDS)
+        changed['category'] = list(rng.choice(CATEGORIES))
+        upserts[product['asin']] = changed
+    for product in rng.sample(products, 10):
+        source = rng.choice(products)
+        upserts[product['asin']] = dict(product, title=source.get('title', ''), description=list(source.get('description', [])))
+    for i, source in enumerate(rng.sample(products, 20)):
+        new = dict(source, asin='N%09d' % i)
+        if i % 2:
+            new['title'] = new.get('title', '') + ' Replacement'
+        upserts[new['asin']] = new
+    deletes = {product['asin'] for product in rng.sample(products, 25) if product['asin'] not in upserts}
+    return upserts, deletes
+
+# The catalog after applying delta to products, in the order a delta keeps
+def changed_catalog(products, upserts, deletes):
+    changed = [upserts.get(p['asin'], p) for p in products if p['asin'] not in deletes]
+    return changed + [p for asin, p in upserts.items() if asin not in {p['asin'] for p in products}]
+
+def assert_same_index(index, expected, neighbors=True):
+    assert index.asins.tolist() == expected.asins.tolist()
+    assert index.params == expected.params
+    for name in ['indptr', 'indices', 'signatures', 'content_hashes', 'representatives']:
+        np.testing.assert_array_equal(getattr(index, name), getattr(expected, name), err_msg=name)
+    for name in ['band_ptr', 'keys', 'offsets', 'postings']:
+        np.testing.assert_array_equal(getattr(index.lsh, name), getattr(expected.lsh, name), err_msg='lsh.' + name)
+    if neighbors:
+        np.testing.assert_array_equal(index.neighbors.neighbors, expected.neighbors.neighbors)
+        np.testing.assert_array_equal(index.neighbors.scores, expected.neighbors.scores)
@@ -0,0 +1,58 @@
+from conftest import assert_same_index, changed_catalog
+from final import ServingState
+from recommender import prepare_data, build_neighbor_table, update_indexes, FIELDS
+
+QUERIES = ['', 'a', 'ab', 'kit', 'pack of', 'replacement', 'oem kit', 'xyz', 'er', 'ing ']
+
+def build(products):
+    indexes = prepare_data(products, bands=10, rows=4)
+    for index in indexes.values():
+        index.neighbors = build_neighbor_table(index, k=5)
+    return indexes
+
+def test_update_indexes_matches_rebuild(products, delta):
+    upserts, deletes = delta
+    updated = update_indexes(build(products), upserts, deletes)
+    rebuilt = build(changed_catalog(products, upserts, deletes))
+    for field in FIELDS:
+        assert_same_index(updated[field], rebuilt[field])
+
+def test_update_indexes_in_batches_matches_rebuild(products, delta):
+    upserts, deletes = delta
+    indexes = build(products)
+    items = list(upserts.items())
+    indexes = update_indexes(indexes, dict(items[:25]), set())
+    indexes = update_indexes(indexes, dict(items[25:]), deletes)
+    rebuilt = build(changed_catalog(products, upserts, deletes))
+    for field in FIELDS:
+        assert_same_index(indexes[field], rebuilt[field])
+
+def test_serving_state_update_matches_rebuild(products, delta):
+    upserts, deletes = delta
+    before = ServingState(products, build(products))
+    state, n_deleted = before.updated(upserts, deletes)
+    changed = changed_catalog(products, upserts, deletes)
+    rebuilt = ServingState(changed, build(changed))
+
+    assert n_deleted == len(deletes)
+    assert state.products == rebuilt.products
+    assert state.store.by_asin == rebuilt.store.by_asin
+    assert state.store.by_brand == rebuilt.store.by_brand
+    assert state.store.by_category == rebuilt.store.by_category
+    assert state.listing_views == rebuilt.listing_views
+    assert state.detail_views == rebuilt.detail_views
+    assert len(state.search_index) == len(rebuilt.search_index)
+    titles = [p.get('title', '') for p in changed[::7]]
+    for query in QUERIES + titles + [title[:3] for title in titles] + [title[2:9] for title in titles]:
+        assert state.search_index.search(query, 10) == rebuilt.search_index.search(query, 10), query
+    for field in FIELDS:
+        assert_same_index(state.indexes[field], rebuilt.indexes[field])
+
+def test_serving_state_update_leaves_old_state(products, delta):
+    upserts, deletes = delta
+    before = ServingState(products, build(products))
+    snapshot = (list(before.products), {brand: list(products) for brand, products in before.store.by_brand.items()},
+                dict(before.listing_views), [before.search_index.search(query, 10) for query in QUERIES])
+    before.updated(upserts, deletes)
+    assert snapshot == (before.products, before.store.by_brand, before.listing_views,
+                        [before.search_index.search(query, 10) for query in QUERIES])
@@ -0,0 +1,18 @@
+import numpy as np
+
+from recommender import prepare_data, hybrid_top_k_columns
+
+# Boilerplate descriptions shared by large duplicate groups: every group
+# member is a candidate of its own, yet a query gets at most max_candidates
+def test_hybrid_candidates_stay_within_cap(products):
+    for i, product in enumerate(products):
+        product['description'] = ['boilerplate warranty text number %d for replacement parts' % (i % 4)]
+    indexes = prepare_data(products, bands=10, rows=4)
+    for index in indexes.values():
+        index.lsh.max_bucket, index.lsh.max_candidates = 100, 30
+    cols = np.arange(len(products))
+    query, _, _ = hybrid_top_k_columns(indexes, cols, len(products), 'minhash')
+    counts = np.bincount(query, minlength=len(cols))
+    assert counts.max() == 30
+    uncapped, _, _ = hybrid_top_k_columns(indexes, cols, len(products), 'minhash', capped=False)
+    assert np.bincount(uncapped, minlength=len(cols)).max() > 100
@@ -0,0 +1,8 @@
+from final import ServingState
+
+def test_listing_rows_of_a_repeated_asin_show_their_own_product():
+    products = [{'asin': 'D1', 'title': 'First copy'}, {'asin': 'D2', 'title': 'Other'}, {'asin': 'D1', 'title': 'Second copy'}]
+    state = ServingState(products, {})
+    page, _ = state.store.page(1, 40)
+    assert [state.listing_row(product)['title'] for product in page] == ['First copy', 'Other', 'Second copy']
+    assert state.detail_views['D1']['title'] == 'First copy'
@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+import recommender
+from conftest import assert_same_index
+from recommender import prepare_data, build_out_of_core, retune_index, FIELDS
+
+# A budget this small splits the catalog into many chunks, batches and bucket runs
+BUDGET = 64 << 10
+
+@pytest.fixture
+def catalog(tmp_path, products, monkeypatch):
+    monkeypatch.setattr(recommender, 'MIN_MEMORY_BUDGET', 0)
+    # A few asins occur twice: the first position and the last product win
+    lines = products + [dict(product, title='Updated ' + product.get('title', '')) for product in products[5:300:60]]
+    path = tmp_path / 'catalog.json'
+    path.write_text(''.join(json.dumps(product) + '\n' for product in lines))
+    return str(path), lines
+
+def test_build_out_of_core_matches_prepare_data(tmp_path, catalog):
+    path, lines = catalog
+    directory = tmp_path / 'build'
+    directory.mkdir()
+    built = build_out_of_core(path, str(directory), BUDGET, bands=10, rows=4)
+    expected = prepare_data(lines, bands=10, rows=4)
+    for field in FIELDS:
+        assert_same_index(built[field], expected[field], neighbors=False)
+
+def test_retune_out_of_core_matches_prepare_data(tmp_path, catalog):
+    path, lines = catalog
+    directory = tmp_path / 'build'
+    directory.mkdir()
+    built = build_out_of_core(path, str(directory), BUDGET, bands=10, rows=4)
+    expected = prepare_data(lines, bands=20, rows=3)
+    for field in FIELDS:
+        retune_index(built[field], 20, 3, str(directory / ('retuned-' + field)), BUDGET)
+        assert_same_index(built[field], expected[field], neighbors=False)
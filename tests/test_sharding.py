@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+from recommender import prepare_data, batch_similar, FIELDS, SCORING_MODES
+from sharding import build_shards, ShardedIndex
+
+@pytest.fixture
+def source(tmp_path, products):
+    path = tmp_path / 'catalog.json'
+    path.write_text(''.join(json.dumps(product) + '\n' for product in products))
+    return str(path)
+
+@pytest.mark.parametrize('by', ['asin', 'category'])
+def test_sharded_similar_matches_batch_similar(tmp_path, products, source, by):
+    build_shards(source, products, str(tmp_path / 'shards'), n_shards=3, by=by, bands=10, rows=4)
+    indexes = prepare_data(products, bands=10, rows=4)
+    asins = [product['asin'] for product in products] + ['unknown']
+    sharded = ShardedIndex(str(tmp_path / 'shards'), processes=False)
+    try:
+        for field in FIELDS:
+            for scoring in SCORING_MODES:
+                assert sharded.similar(field, asins, 5, scoring) == batch_similar(indexes[field], asins, 5, scoring), \
+                    (field, scoring)
+    finally:
+        sharded.close()
+
+def test_sharded_worker_processes_match_batch_similar(tmp_path, products, source):
+    build_shards(source, products, str(tmp_path / 'shards'), n_shards=2, bands=10, rows=4)
+    indexes = prepare_data(products, bands=10, rows=4)
+    asins = [product['asin'] for product in products[::5]]
+    sharded = ShardedIndex(str(tmp_path / 'shards'))
+    try:
+        assert sharded.similar('title', asins, 5) == batch_similar(indexes['title'], asins, 5)
+    finally:
+        sharded.close()
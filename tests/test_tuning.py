@@ -0,0 +1,18 @@
+from conftest import changed_catalog
+from recommender import prepare_data, tune_lsh, update_indexes, FIELDS
+
+def test_tune_lsh_without_representatives_keeps_setting(products):
+    indexes = update_indexes(prepare_data(products, bands=10, rows=4), {}, {p['asin'] for p in products})
+    for field in FIELDS:
+        tuned = tune_lsh(indexes[field])
+        assert (tuned['bands'], tuned['rows']) == (10, 4)
+        assert tuned['queries'] == tuned['pairs'] == 0
+
+def test_small_delta_keeps_tuned_setting(products):
+    upserts = {p['asin']: dict(p, title=p.get('title', '') + ' Kit') for p in products[::30]}
+    before = prepare_data(products)
+    after = prepare_data(changed_catalog(products, upserts, set()))
+    for field in FIELDS:
+        tuned = tune_lsh(before[field], max_candidates=200)
+        retuned = tune_lsh(after[field], max_candidates=200, prefer=(tuned['bands'], tuned['rows']))
+        assert (retuned['bands'], retuned['rows']) == (tuned['bands'], tuned['rows'])
@@ -0,0 +1,29 @@
+import gc
+import os
+
+from final import create_app
+
+# Production entry point, in one of two modes (see the concurrency model in
+# final.py), with threads per worker:
+#
+#   gunicorn --preload --workers 4 --threads 8 wsgi:app
+#       The master loads the catalog and indexes before forking the workers,
+#       which share them. Workers accept requests once everything is loaded.
+#
+#   INDEX_WARMUP=background gunicorn --workers 4 --threads 8 wsgi:app
+#       Every worker loads the catalog, serves the listing and search at once
+#       and loads the indexes in the background; route similarity traffic by
+#       GET /ready. Build the snapshot ahead of time (python recommender.py
+#       CATALOG) so that workers only load it. Do not combine with --preload:
+#       the warm-up thread would not survive the fork.
+#
+# CATALOG_PATH and SNAPSHOT_DIR select the catalog file and the snapshot
+# directory, SCORING_WORKERS the size of each worker's scoring pool.
+app = create_app(os.environ.get("CATALOG_PATH", "meta_Appliances.json"),
+                 os.environ.get("SNAPSHOT_DIR", "index_snapshot"),
+                 scoring_workers=int(os.environ.get("SCORING_WORKERS", "4")),
+                 background=os.environ.get("INDEX_WARMUP") == "background")
+
+# Objects that exist now are left out of garbage collection: collections in
+# forked workers would otherwise touch, and so copy, every page holding them
+gc.freeze()